@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Write-behind ack coalescing, shared by the threaded and asyncio server engines.
+
+A durable /ack_message commits an UPDATE of the subscriber's row before it is answered. A
+coalesced ack only raises the subscriber's offset in memory and is answered right away; the
+pending offsets of every subscriber are written with one ack_flush() call every flush_ms
+milliseconds, or as soon as flush_acks acks are waiting. Acks are monotonic, so however many
+acks of a partition arrive within a flush window only the highest one is written.
+
+The mode is chosen per subscriber (topic_subscriber.ack_mode, set on /subscribe) and can be
+overridden per request with ack_mode=durable|coalesced. Only plain subscribers are coalesced,
+consumer group members always ack durably. The coalescer learns a subscriber's topic,
+partitions and mode from the row returned by its first durable ack, so the first ack after a
+server start is always committed right away.
+
+Pending offsets are passed to get_message() and merged into /ack_fetch acks, so a subscriber
+never gets a message it acked again while its ack waits to be flushed. What a server holds in
+memory is lost if it crashes: those messages are delivered again (at least once, like an ack
+that never arrived). topic_reset() flushes the local acks first and drops the pending acks of
+the topic in every other server process.
+"""
+import logging
+import os
+import threading
+
+ACK_FLUSH_MS = float(os.environ.get('ACK_FLUSH_MS', 50))
+ACK_FLUSH_ACKS = int(os.environ.get('ACK_FLUSH_ACKS', 1000))
+
+ACK_MODES = ('durable', 'coalesced')
+
+
+def highest_offsets(*pairs) -> tuple:
+    """
+    Merge parallel (partitions, offsets) lists, keeping the highest offset of each partition.
+    """
+    merged = {}
+    for partitions, offsets in pairs:
+        for partition, offset in zip(partitions, offsets):
+            merged[partition] = max(offset, merged.get(partition, offset))
+    return list(merged), list(merged.values())
+
+FLUSH_SQL = """select ack_flush(%s::int[], %s::int[], %s::bigint[]);"""
+
+
+class QAckCoalescer:
+    """
+    Pending coalesced acks. Thread safe; the engines run the flushes (see QAckFlushWorker).
+    """
+    def __init__(self, flush_ms: float=ACK_FLUSH_MS, flush_acks: int=ACK_FLUSH_ACKS, on_due=None):
+        self.flush_ms = flush_ms
+        self.flush_acks = flush_acks
+        self.on_due = on_due            # called when flush_acks acks are waiting
+        self._lock = threading.Lock()
+        self._subscribers = {}          # subscriber id -> last known topic_subscriber row of a plain subscriber
+        self._pending = {}              # subscriber id -> {partition: offset} not flushed yet
+        self._flushing = {}             # the same for the flush in progress
+        self._pending_acks = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.offsets_flushed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.flush_ms > 0
+
+    def learn(self, row: dict):
+        """
+        Remember a plain subscriber from the row a durable ack_message() returned.
+        """
+        if not row or row.get('group_id') is not None:
+            return
+        with self._lock:
+            self._subscribers[row['id']] = dict(row)
+
+    def ack(self, subscriber_id: int, partition: int, offset: int, mode: str=None) -> dict:
+        """
+        Coalesce an ack when the subscriber is known and its (or the requested) mode is coalesced.
+        Returns the subscriber row as ack_message() would, or None when the ack must be made durably.
+        """
+        with self._lock:
+            row = self._subscribers.get(subscriber_id)
+            if not self.enabled or row is None or (mode or row.get('ack_mode')) != 'coalesced' \
+                    or partition not in row['partitions']:
+                return None
+            pending = self._pending.setdefault(subscriber_id, {})
+            pending[partition] = max(offset, pending.get(partition, offset))
+            self.coalesced += 1
+            self._pending_acks += 1
+            due = self._pending_acks >= self.flush_acks
+            res = dict(row)
+            res['_offsets'] = self._merged(subscriber_id, row['_offsets'])
+        if due and self.on_due is not None:
+            self.on_due()
+        return res
+
+    def offsets(self, subscriber_id: int) -> tuple:
+        """
+        Acks of the subscriber not flushed yet as parallel (partitions, offsets) lists.
+        """
+        with self._lock:
+            merged = dict(self._flushing.get(subscriber_id, {}))
+            for partition, offset in self._pending.get(subscriber_id, {}).items():
+                merged[partition] = max(offset, merged.get(partition, offset))
+        return list(merged), list(merged.values())
+
+    def merge_offsets(self, subscriber_id: int, offsets: list) -> list:
+        """
+        offsets (offsets[p] for partition p) raised to the acks not flushed yet.
+        """
+        with self._lock:
+            return self._merged(subscriber_id, offsets)
+
+    def settle(self, subscriber_id: int, partitions: list, offsets: list):
+        """
+        Drop pending acks a durable ack of the subscriber has covered.
+        """
+        with self._lock:
+            pending = self._pending.get(subscriber_id)
+            if pending is None:
+                return
+            for partition, offset in zip(partitions, offsets):
+                if partition in pending and pending[partition] <= offset:
+                    del pending[partition]
+            if not pending:
+                del self._pending[subscriber_id]
+
+    def take(self) -> tuple:
+        """
+        Start a flush: the pending acks as parallel (subscriber ids, partitions, offsets) lists.
+        They stay visible to offsets() until done() is called.
+        """
+        with self._lock:
+            self._flushing = self._pending
+            self._pending = {}
+            self._pending_acks = 0
+            subscriber_ids, partitions, offsets = [], [], []
+            for subscriber_id, pending in self._flushing.items():
+                for partition, offset in pending.items():
+                    subscriber_ids.append(subscriber_id)
+                    partitions.append(partition)
+                    offsets.append(offset)
+            return subscriber_ids, partitions, offsets
+
+    def done(self, ok: bool):
+        """
+        Finish the flush started by take(). A failed flush is retried with the next one.
+        """
+        with self._lock:
+            flushing, self._flushing = self._flushing, {}
+            if not flushing:
+                return
+            if not ok:
+                self.flush_errors += 1
+                for subscriber_id, offsets in flushing.items():
+                    pending = self._pending.setdefault(subscriber_id, {})
+                    for partition, offset in offsets.items():
+                        pending[partition] = max(offset, pending.get(partition, offset))
+                return
+            self.flushes += 1
+            for subscriber_id, offsets in flushing.items():
+                self.offsets_flushed += len(offsets)
+                row = self._subscribers.get(subscriber_id)
+                if row is not None:
+                    row['_offsets'] = list(row['_offsets'])
+                    for partition, offset in offsets.items():
+                        row['_offsets'][partition] = max(offset, row['_offsets'][partition])
+
+    def forget(self, subscriber_id: int):
+        with self._lock:
+            self._subscribers.pop(subscriber_id, None)
+            self._pending.pop(subscriber_id, None)
+
+    def discard_topic(self, topic: str):
+        """
+        Drop what is known and pending of the subscribers of topic, e.g. after it was reset or deleted.
+        """
+        with self._lock:
+            for subscriber_id in [i for i, row in self._subscribers.items() if row['topic'] == topic]:
+                del self._subscribers[subscriber_id]
+                self._pending.pop(subscriber_id, None)
+
+    def metrics(self) -> list:
+        """
+        Collector for QMetrics.register_collector().
+        """
+        with self._lock:
+            pending = sum(len(offsets) for offsets in self._pending.values())
+            return [
+                ('queue_acks_coalesced_total', 'counter', 'Acks held in memory instead of committed right away.',
+                 [({}, self.coalesced)]),
+                ('queue_ack_flushes_total', 'counter', 'Batched writes of coalesced acks.', [({}, self.flushes)]),
+                ('queue_ack_flush_errors_total', 'counter', 'Batched writes of coalesced acks that failed and were retried.',
+                 [({}, self.flush_errors)]),
+                ('queue_ack_offsets_flushed_total', 'counter', 'Subscriber partition offsets written by ack flushes.',
+                 [({}, self.offsets_flushed)]),
+                ('queue_ack_pending', 'gauge', 'Subscriber partition offsets waiting to be flushed.', [({}, pending)]),
+            ]
+
+    # called with self._lock held
+
+    def _merged(self, subscriber_id: int, offsets: list) -> list:
+        merged = list(offsets)
+        for source in (self._flushing, self._pending):
+            for partition, offset in source.get(subscriber_id, {}).items():
+                if partition < len(merged):
+                    merged[partition] = max(offset, merged[partition])
+        return merged
+
+
+class QAckFlushWorker:
+    """
+    Flushes a QAckCoalescer every flush_ms milliseconds (or when it is due) on a daemon thread,
+    using connections from a QConnectionPool.
+    """
+    def __init__(self, db_pool, coalescer: QAckCoalescer):
+        self.db_pool = db_pool
+        self.coalescer = coalescer
+        self.coalescer.on_due = self.wake
+        self._flush_lock = threading.Lock()
+        self._due = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._log = logging.getLogger(__name__)
+
+    def start(self):
+        if self._thread is None and self.coalescer.enabled:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='ack-flush-worker', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._due.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        # what is left is written before the pool closes
+        self.flush()
+
+    def wake(self):
+        self._due.set()
+
+    def flush(self):
+        """
+        Write the pending acks now. Returns once they (and any flush already running) are committed or failed.
+        """
+        with self._flush_lock:
+            subscriber_ids, partitions, offsets = self.coalescer.take()
+            if not subscriber_ids:
+                self.coalescer.done(True)
+                return
+            try:
+                with self.db_pool.connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(FLUSH_SQL, (subscriber_ids, partitions, offsets))
+            except Exception as e:
+                self.coalescer.done(False)
+                self._log.error(f'Ack flush of {len(offsets)} offsets failed: {e}')
+                return
+            self.coalescer.done(True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._due.wait(self.coalescer.flush_ms / 1000.0)
+            self._due.clear()
+            if not self._stop.is_set():
+                self.flush()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Admission control and per-topic publish rate limits, shared by the threaded and asyncio server
+engines.
+
+A server takes at most ADMISSION_MAX_CONNECTIONS connections (default 1024). A connection over
+the limit is answered 503 and closed before its request is read, so a burst of connections
+cannot pile up handler threads. At most ADMISSION_MAX_IN_FLIGHT requests (default 128) are
+handled at once. A request over that limit is answered 503 before any work is done. A
+long-polling request does not count while it is parked waiting for a publish, because it holds
+no database connection then. It counts again once it wakes, even if that briefly puts the
+server over the limit. /metrics is always answered, so a server can be watched while it is
+overloaded. 0 disables either limit.
+
+Publishes to a topic take tokens from the topic's bucket, one per message. The bucket fills at
+TOPIC_PUBLISH_RATE messages per second (0, the default, means no limit) up to
+TOPIC_PUBLISH_BURST tokens (default one second's worth). TOPIC_PUBLISH_RATES overrides the limit
+per topic, e.g. `orders=500,audit=50:200` (rate[:burst]). A publish with too few tokens is
+answered 429. A batch larger than the burst is let through when the bucket is full, and the
+following publishes wait until the bucket is refilled. In pre-fork mode every worker has its
+own limits and buckets.
+
+Rejected requests get a Retry-After header (seconds, at least ADMISSION_RETRY_AFTER for
+overload, default 1). The server sends that header only when it did nothing with the request,
+so clients may retry any method on 429 and 503 responses that carry it.
+"""
+import math
+import os
+import threading
+import time
+
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 128))
+ADMISSION_MAX_CONNECTIONS = int(os.environ.get('ADMISSION_MAX_CONNECTIONS', 1024))
+# listen backlog of the threaded server: connections the kernel queues before they are accepted
+ADMISSION_ACCEPT_BACKLOG = int(os.environ.get('ADMISSION_ACCEPT_BACKLOG', 128))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+
+TOPIC_PUBLISH_RATE = float(os.environ.get('TOPIC_PUBLISH_RATE', 0))
+TOPIC_PUBLISH_BURST = float(os.environ.get('TOPIC_PUBLISH_BURST', 0))
+TOPIC_PUBLISH_RATES = os.environ.get('TOPIC_PUBLISH_RATES', '')
+
+# routes that are admitted whatever the load
+ADMISSION_EXEMPT_ROUTES = ('metrics',)
+
+
+def retry_after(seconds: float) -> str:
+    """
+    Retry-After header value: whole seconds, at least 1.
+    """
+    return str(max(1, int(math.ceil(seconds))))
+
+
+def parse_topic_rates(spec: str) -> dict:
+    """
+    topic -> (rate, burst) from `topic=rate[:burst],...`, a burst of 0 meaning one second's worth.
+    """
+    rates = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        topic, _, limit = item.partition('=')
+        rate, _, burst = limit.partition(':')
+        rates[topic.strip()] = (float(rate), float(burst or 0))
+    return rates
+
+
+class QAdmission:
+    """
+    Counts the connections and the requests in flight of a server and rejects those over the
+    limits. Thread safe.
+    """
+    def __init__(self, max_in_flight: int=ADMISSION_MAX_IN_FLIGHT, max_connections: int=ADMISSION_MAX_CONNECTIONS):
+        self.max_in_flight = max_in_flight
+        self.max_connections = max_connections
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.connections = 0
+        self.rejected = {'in_flight': 0, 'connections': 0, 'topic_rate': 0}
+
+    def connect(self) -> bool:
+        """
+        Count a new connection. Returns False, without counting it, when there are too many.
+        """
+        with self._lock:
+            if self.max_connections and self.connections >= self.max_connections:
+                self.rejected['connections'] += 1
+                return False
+            self.connections += 1
+            return True
+
+    def disconnect(self):
+        with self._lock:
+            self.connections -= 1
+
+    def enter(self) -> bool:
+        """
+        Count a request about to be handled. Returns False, without counting it, when too many are.
+        """
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                self.rejected['in_flight'] += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def resume(self):
+        """
+        Count a request again after leave(), whatever the limit: it was admitted already.
+        """
+        with self._lock:
+            self.in_flight += 1
+
+    def topic_rejected(self):
+        with self._lock:
+            self.rejected['topic_rate'] += 1
+
+    def metrics(self) -> list:
+        """
+        Collector for QMetrics.register_collector().
+        """
+        return [('queue_requests_in_flight', 'gauge', 'Requests being handled, parked long-polls excluded.',
+                 [({}, self.in_flight)]),
+                ('queue_connections_open', 'gauge', 'Client connections being served.', [({}, self.connections)]),
+                ('queue_admission_rejected_total', 'counter', 'Requests and connections rejected, by limit.',
+                 [({'reason': reason}, count) for reason, count in sorted(self.rejected.items())])]
+
+
+class QTokenBucket:
+    def __init__(self, rate: float, burst: float=0):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+
+    def take(self, count: int) -> float:
+        """
+        Take count tokens. Returns 0 when they were taken, else the seconds until they would be there.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        # a batch larger than the burst only needs a full bucket, and leaves it in debt
+        needed = min(count, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= count
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+
+class QTopicLimiter:
+    """
+    A token bucket per topic. Thread safe.
+    """
+    def __init__(self, rate: float=TOPIC_PUBLISH_RATE, burst: float=TOPIC_PUBLISH_BURST, overrides: dict=None):
+        self.rate = rate
+        self.burst = burst
+        self.overrides = parse_topic_rates(TOPIC_PUBLISH_RATES) if overrides is None else overrides
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0 or any(rate > 0 for rate, _ in self.overrides.values())
+
+    def take(self, topic: str, count: int=1) -> float:
+        """
+        Take tokens for count messages published to topic. Returns 0 when they may be published,
+        else the seconds to wait.
+        """
+        rate, burst = self.overrides.get(topic, (self.rate, self.burst))
+        if rate <= 0:
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.get(topic)
+            if bucket is None:
+                bucket = self._buckets[topic] = QTokenBucket(rate, burst)
+            return bucket.take(count)
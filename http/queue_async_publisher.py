@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Asyncio publisher client with pipelined publishing.
+
+publish() returns once the message is written to the server, with a future of its delivery
+confirmation: the partition and offset it was stored at. Up to max_in_flight publishes are
+unconfirmed at any time, spread over `connections` pipelined connections (see
+queue_async_session.py). publish() waits for a confirmation before it sends more.
+
+The server handles the requests of a connection in order, and messages with the same key are
+always sent on the same connection, so they are stored in the order they were published.
+Messages without a key are spread over the connections. A publish that fails (an error status
+or a broken connection) fails its confirmation. It is not retried, because it may have been
+stored, and the publishes pipelined behind it on a broken connection fail as well.
+
+Like QPublisher, large request bodies are compressed once the server has listed the codings it
+accepts, unless compression is False.
+
+Usage::
+    async with QAsyncPublisher(max_in_flight=64) as publisher:
+        confirmations = [await publisher.publish('orders', json.dumps(order), key=order['customer']) for order in orders]
+        for confirmation in asyncio.as_completed(confirmations):
+            print(await confirmation)     # {'partition': 2, 'offset': 118}
+"""
+import asyncio
+import json
+import logging
+import os
+import zlib
+
+from queue_async_session import QAsyncSession
+from queue_compression import compress, response_encoding
+from queue_session import DEFAULT_POOL_SIZE, DEFAULT_RETRIES
+from queue_wire import FRAMES_CONTENT_TYPE, encode_messages
+
+PUBLISHER_URL = os.environ.get('PUBLISHER_URL', 'http://queues-server:8888')
+
+DEFAULT_MAX_IN_FLIGHT = 32
+DEFAULT_CONNECTIONS = 4
+
+
+class ContentTypeError(Exception):
+    pass
+
+
+class QAsyncPublisher:
+    def __init__(self, max_in_flight: int=DEFAULT_MAX_IN_FLIGHT, connections: int=DEFAULT_CONNECTIONS,
+                 pool_size: int=DEFAULT_POOL_SIZE, retries: int=DEFAULT_RETRIES, frames: bool=True,
+                 url: str=PUBLISHER_URL, compression: bool=True):
+        self.url = url
+        self.max_in_flight = max(1, max_in_flight)
+        self._session = QAsyncSession(url, pool_size, retries)
+        self._connections = [self._session.connection() for _ in range(max(1, connections))]
+        self._next_connection = 0
+        self.frames = frames
+        self._server_frames = False
+        self.compression = compression
+        self._server_encodings = None
+        # created on first use, inside the event loop that runs the client
+        self._slots = None
+        self._in_flight = set()
+        self._log = logging.getLogger(__file__)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _request(self, path: str, params: dict, method: str='post'):
+        if method == 'post':
+            body, headers = self._body(json.dumps(params).encode('utf-8'), 'application/json')
+            res = await self._session.request(method, path, data=body, headers=headers)
+        else:
+            res = await self._session.request(method, path, params=params)
+        return self._handle_response(res)
+
+    def _body(self, body: bytes, content_type: str) -> tuple:
+        """
+        The request body, compressed when it is worth it, and its headers.
+        """
+        headers = {'Content-type': content_type}
+        encoding = response_encoding(self._server_encodings, len(body)) if self.compression else None
+        if encoding:
+            body = compress(body, encoding)
+            headers['Content-Encoding'] = encoding
+        return body, headers
+
+    def _handle_response(self, res):
+        res.raise_for_status()
+        if not self._server_frames and FRAMES_CONTENT_TYPE in res.headers.get('accept-post', ''):
+            self._server_frames = True
+        if self._server_encodings is None and 'accept-encoding' in res.headers:
+            self._server_encodings = res.headers['accept-encoding']
+        if res.body:
+            if res.headers.get('content-type') == 'application/json':
+                return res.json()
+            raise ContentTypeError(f'Expected "application/json" but got {res.headers.get("content-type")}')
+
+    async def create_topic(self, topic: str, description: str, **policy):
+        """
+        policy takes the optional partitions, segment_size, retention_ms, retention_messages and retention_acked settings,
+        and compression ('gzip' or 'deflate') to store the topic's large messages compressed
+        """
+        data = await self._request('/topic', dict(policy, topic=topic, description=description))
+        self._log.info(f"Topic {data['topic']} created")
+
+    async def delete_topic(self, topic: str):
+        await self._request('/topic_delete', {'topic': topic})
+
+    async def reset_topic(self, topic: str, offset: int):
+        await self.flush()
+        await self._request('/topic_reset', {'topic': topic, 'offset': offset})
+
+    async def publish(self, topic: str, message: str, key: str=None) -> asyncio.Future:
+        """
+        Send one message. Returns a future of {'partition', 'offset'} once it has been written.
+        """
+        return await self._publish('/publish', topic, [message], key, self._publish_confirmation)
+
+    async def publish_many(self, topic: str, messages: list, key: str=None) -> asyncio.Future:
+        """
+        Send a list of messages as one batch, all to the same partition. Returns a future of
+        {'partition', 'first_offset', 'last_offset', 'count'} once it has been written.
+        """
+        return await self._publish('/publish_batch', topic, list(messages), key, self._batch_confirmation)
+
+    def _publish_confirmation(self, res) -> dict:
+        self._handle_response(res)
+        return {'partition': int(res.headers.get('x-partition', 0)), 'offset': int(res.headers['x-offset'])}
+
+    def _batch_confirmation(self, res) -> dict:
+        data = self._handle_response(res)
+        return {'partition': data.get('partition', 0), 'first_offset': data['first_offset'],
+                'last_offset': data['last_offset'], 'count': data['count']}
+
+    async def _publish(self, path: str, topic: str, messages: list, key: str, confirm) -> asyncio.Future:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+        await self._slots.acquire()
+        try:
+            params = {'topic': topic, 'key': key}
+            if self.frames and self._server_frames:
+                body, headers = self._body(encode_messages(messages), FRAMES_CONTENT_TYPE)
+                response = await self._session.send('POST', path, params=params, data=body, headers=headers,
+                                                    connection=self._connection_for(key))
+            else:
+                data = dict(params, messages=messages) if path == '/publish_batch' else dict(params, message=messages[0])
+                body, headers = self._body(json.dumps(data).encode('utf-8'), 'application/json')
+                response = await self._session.send('POST', path, data=body, headers=headers,
+                                                    connection=self._connection_for(key))
+        except BaseException:
+            self._slots.release()
+            raise
+        confirmation = asyncio.ensure_future(self._confirm(response, confirm))
+        self._in_flight.add(confirmation)
+        confirmation.add_done_callback(self._confirmed)
+        return confirmation
+
+    async def _confirm(self, response: asyncio.Future, confirm) -> dict:
+        return confirm(await response)
+
+    def _confirmed(self, confirmation: asyncio.Future):
+        self._in_flight.discard(confirmation)
+        self._slots.release()
+        if not confirmation.cancelled() and confirmation.exception() is not None:
+            self._log.error(f'Publish failed: {confirmation.exception()}')
+
+    def _connection_for(self, key: str):
+        if key is not None:
+            # the same key always takes the same connection, so its messages keep their order
+            return self._connections[zlib.crc32(key.encode('utf-8')) % len(self._connections)]
+        self._next_connection = (self._next_connection + 1) % len(self._connections)
+        return self._connections[self._next_connection]
+
+    async def flush(self):
+        """
+        Wait until every publish sent so far is confirmed or failed. Raises the first failure.
+        """
+        if self._in_flight:
+            results = await asyncio.gather(*self._in_flight, return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+
+    async def close(self):
+        try:
+            await self.flush()
+        finally:
+            await self._session.close()
@@ -0,0 +1,1378 @@
+#!/usr/bin/env python3
+"""
+Asyncio server engine for the queue server.
+
+Serves the same routes and JSON contracts as QRequestHandler in queue_server.py, but every
+connection is a coroutine on one event loop instead of an OS thread, and the database is
+reached through an asyncpg connection pool. Long-polling /get_message requests are parked on
+asyncio events woken by a single LISTEN connection, so tens of thousands of idle or waiting
+subscribers cost a few KB each instead of a thread stack each.
+
+Usage::
+    ./queue_server.py --engine asyncio [<port>]
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+import json
+import logging
+import os
+import resource
+import time
+import zlib
+from urllib.parse import urlparse, parse_qs
+
+import asyncpg
+
+from queue_admission import ADMISSION_EXEMPT_ROUTES, ADMISSION_RETRY_AFTER, QAdmission, QTopicLimiter, retry_after
+from queue_acks import ACK_MODES, FLUSH_SQL, QAckCoalescer, highest_offsets
+from queue_cache import QTailCache
+from queue_compression import (ACCEPT_ENCODING, ENCODINGS, compress, compressor, decompress, encode_payload, plain_rows,
+                               response_encoding)
+from queue_lag import QLagCache, lag_report
+from queue_listing import is_stream_request, list_query, next_page
+from queue_logging import PER_REQUEST, logging_metrics, setup_logging, stop_logging
+from queue_metrics import QMetrics
+from queue_retention import RETENTION_INTERVAL, RETENTION_MAX_SEGMENTS, RETENTION_SQL, TOPICS_SQL, RetentionStats
+from queue_statements import HOT_STATEMENTS
+from queue_stream import (STREAM_CREDIT_POLL_MS, STREAM_CREDITS, STREAM_FORMATS, STREAM_HEARTBEAT_MS, STREAM_MAX_CREDITS,
+                          QStreamRegistry, QStreamWindow, encode_events, heartbeat, stream_format)
+from queue_wire import (ACCEPT_POST, ENCODED_FRAMES_CONTENT_TYPE, FRAMES_CONTENT_TYPE, accepts_encoded_frames, accepts_frames,
+                        decode_messages, encode_rows)
+
+DEFAULT_PORT = 8888
+
+# default is to use the docker networking from docker-compose
+DB_URI = os.environ.get('DB_URI', 'postgresql://queues@db:5432/queues')
+
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 2))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 20))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5.0))
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', 3600.0))
+PUBLISH_BATCH_MAX = int(os.environ.get('PUBLISH_BATCH_MAX', 1000))
+TOPIC_MAX_PARTITIONS = 1024
+GET_MESSAGE_MAX_WAIT_MS = int(os.environ.get('GET_MESSAGE_MAX_WAIT_MS', 30000))
+GET_MESSAGE_MAX = 20
+STREAM_FETCH_SIZE = int(os.environ.get('STREAM_FETCH_SIZE', 500))
+
+# connection handling limits
+ASYNC_LISTEN_BACKLOG = int(os.environ.get('ASYNC_LISTEN_BACKLOG', 4096))
+ASYNC_KEEPALIVE_TIMEOUT = float(os.environ.get('ASYNC_KEEPALIVE_TIMEOUT', 75.0))
+ASYNC_MAX_BODY_SIZE = int(os.environ.get('ASYNC_MAX_BODY_SIZE', 16 * 1024 * 1024))
+
+PUBLISH_CHANNEL = 'topic_publish'
+TOPIC_CHANGE_CHANNEL = 'topic_change'
+
+POST_ROUTES = ['publish', 'publish_batch', 'ack_message', 'ack_fetch', 'group_fetch', 'group_ack', 'topic_reset', 'topic_retention', 'unsubscribe', 'topic']
+DELETE_ROUTES = ['topic_delete', 'unsubscribe']
+
+
+def numbered_placeholders(sql: str) -> str:
+    # psycopg2 style %s placeholders to asyncpg $1, $2, ...
+    parts = sql.split('%s')
+    return ''.join(part + (f'${i + 1}' if i < len(parts) - 1 else '') for i, part in enumerate(parts))
+
+
+class QAsyncServer:
+    """
+    Owns the event loop resources shared by every connection: the asyncpg pool, the
+    notification listener that wakes long-polling requests, the tail cache and the ack coalescer.
+    """
+    def __init__(self, dsn: str=DB_URI, min_size: int=DB_POOL_MIN_SIZE, max_size: int=DB_POOL_MAX_SIZE,
+                 acquire_timeout: float=DB_POOL_TIMEOUT, max_lifetime: float=DB_POOL_MAX_LIFETIME):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.max_lifetime = max_lifetime
+        self.db_pool = None
+        self._server = None
+        self._listen_conn = None
+        self._listen_epoch = 0
+        self._listen_task = None
+        self._retention_task = None
+        self._ack_task = None
+        self._ack_due = None
+        self._ack_flush_lock = None
+        self.retention_stats = RetentionStats()
+        self.tail_cache = QTailCache()
+        self.acks = QAckCoalescer(on_due=self._wake_ack_flush)
+        self._generations = {}    # topic -> count of publish notifications seen
+        self._topic_events = {}   # topic -> asyncio.Event set (and replaced) on the next publish
+        self._publish_waiters = 0
+        # topic -> compression setting, which cannot change while the topic exists
+        self._compression = {}
+        self._connections = 0
+        self._stat_in_use = 0
+        self._stat_waiters = 0
+        self._stat_acquires = 0
+        self._stat_timeouts = 0
+        self._stat_wait_total = 0.0
+        self._stat_wait_max = 0.0
+        self.metrics = QMetrics()
+        self.metrics.register_collector(self._resource_metrics)
+        self.metrics.register_collector(logging_metrics)
+        self.metrics.register_collector(self.retention_stats.metrics)
+        self.metrics.register_collector(self.tail_cache.metrics)
+        self.metrics.register_collector(self.acks.metrics)
+        self.lag_cache = QLagCache()
+        self.metrics.register_collector(self.lag_cache.metrics)
+        # bounds the connections and the requests handled at once, see queue_admission.py
+        self.admission = QAdmission()
+        self.topic_limiter = QTopicLimiter()
+        self.metrics.register_collector(self.admission.metrics)
+        # open /stream responses, woken by acks, see queue_stream.py
+        self.streams = QStreamRegistry()
+        self.metrics.register_collector(self.streams.metrics)
+
+    async def start(self, host: str='', port: int=DEFAULT_PORT):
+        self.db_pool = await asyncpg.create_pool(self.dsn,
+                                                 min_size=self.min_size,
+                                                 max_size=self.max_size,
+                                                 max_inactive_connection_lifetime=self.max_lifetime)
+        self._listen_task = asyncio.ensure_future(self._listen_loop())
+        if RETENTION_INTERVAL > 0:
+            self._retention_task = asyncio.ensure_future(self._retention_loop())
+        self._ack_due = asyncio.Event()
+        self._ack_flush_lock = asyncio.Lock()
+        if self.acks.enabled:
+            self._ack_task = asyncio.ensure_future(self._ack_flush_loop())
+        self._server = await asyncio.start_server(self._serve_connection, host or None, port,
+                                                  backlog=ASYNC_LISTEN_BACKLOG, reuse_address=True)
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+        if self._retention_task is not None:
+            self._retention_task.cancel()
+        if self._ack_task is not None:
+            self._ack_task.cancel()
+            # what is left is written before the pool closes
+            await self.flush_acks()
+        if self._listen_conn is not None and not self._listen_conn.is_closed():
+            await self._listen_conn.close()
+        if self.db_pool is not None:
+            await self.db_pool.close()
+
+    @asynccontextmanager
+    async def connection(self):
+        """
+        Acquire a pooled connection inside a transaction, tracking the same stats as QConnectionPool.
+        """
+        start = time.monotonic()
+        self._stat_waiters += 1
+        try:
+            conn = await self.db_pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self._stat_timeouts += 1
+            raise
+        finally:
+            self._stat_waiters -= 1
+        waited = time.monotonic() - start
+        self._stat_acquires += 1
+        self._stat_wait_total += waited
+        self._stat_wait_max = max(self._stat_wait_max, waited)
+        self._stat_in_use += 1
+        try:
+            async with conn.transaction():
+                yield conn
+        finally:
+            self._stat_in_use -= 1
+            await self.db_pool.release(conn)
+
+    def pool_stats(self) -> dict:
+        size = self.db_pool.get_size()
+        return {
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'size': size,
+            'idle': self.db_pool.get_idle_size(),
+            'in_use': self._stat_in_use,
+            'waiters': self._stat_waiters,
+            'acquires': self._stat_acquires,
+            'timeouts': self._stat_timeouts,
+            'wait_seconds_total': self._stat_wait_total,
+            'wait_seconds_max': self._stat_wait_max,
+            'wait_seconds_avg': self._stat_wait_total / self._stat_acquires if self._stat_acquires else 0.0,
+            'connections': self._connections,
+        }
+
+    def _resource_metrics(self) -> list:
+        return [
+            ('queue_db_pool_connections', 'gauge', 'Open database connections in the pool, by state.',
+             [({'state': 'in_use'}, self._stat_in_use), ({'state': 'idle'}, self.db_pool.get_idle_size())]),
+            ('queue_db_pool_waiters', 'gauge', 'Requests waiting for a database connection.',
+             [({}, self._stat_waiters)]),
+            ('queue_db_pool_wait_seconds_total', 'counter', 'Total time spent waiting for a database connection.',
+             [({}, self._stat_wait_total)]),
+            ('queue_db_pool_timeouts_total', 'counter', 'Database connection acquires that timed out.',
+             [({}, self._stat_timeouts)]),
+            ('queue_long_poll_waiters', 'gauge', 'Requests parked waiting for a publish notification.',
+             [({}, self._publish_waiters)]),
+            ('queue_open_connections', 'gauge', 'Open client connections.',
+             [({}, self._connections)]),
+        ]
+
+    async def topic_compression(self, conn, topic: str) -> str:
+        """
+        The compression setting of topic, looked up once per topic. None for a topic that does not exist.
+        """
+        compression = self._compression.get(topic, False)
+        if compression is False:
+            row = await conn.fetchrow(HOT_STATEMENTS['q_topic_compression'], topic)
+            if row is None:
+                return None
+            compression = self._compression[topic] = row['compression']
+        return compression
+
+    # -- publish notifications --
+
+    def generation(self, topic: str) -> int:
+        return self._generations.get(topic, 0)
+
+    @property
+    def listen_epoch(self) -> int:
+        """
+        Count of listener connections made, None while disconnected. See QTailCache.
+        """
+        if self._listen_conn is None or self._listen_conn.is_closed():
+            return None
+        return self._listen_epoch
+
+    async def wait_for_publish(self, topic: str, generation: int, timeout: float) -> bool:
+        if self._generations.get(topic, 0) != generation:
+            return True
+        event = self._topic_events.get(topic)
+        if event is None:
+            event = self._topic_events[topic] = asyncio.Event()
+        if self._listen_conn is None or self._listen_conn.is_closed():
+            timeout = min(timeout, 1.0)
+        self._publish_waiters += 1
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._publish_waiters -= 1
+        return True
+
+    def _wake(self, topic: str):
+        self._generations[topic] = self._generations.get(topic, 0) + 1
+        event = self._topic_events.pop(topic, None)
+        if event is not None:
+            event.set()
+
+    def _on_notify(self, conn, pid, channel, payload):
+        try:
+            data = json.loads(payload)
+            topic = data['topic']
+        except (ValueError, KeyError, TypeError):
+            data = {}
+            topic = payload
+        if channel == TOPIC_CHANGE_CHANNEL:
+            self.tail_cache.invalidate(topic)
+            if data.get('event') in ('reset', 'delete'):
+                self.acks.discard_topic(topic)
+                self.streams.close_topic(topic)
+            if data.get('event') == 'delete':
+                self._compression.pop(topic, None)
+            return
+        if 'offset' in data:
+            self.tail_cache.advance(topic, data.get('partition', 0), data['offset'])
+        self._wake(topic)
+
+    async def _listen_loop(self):
+        while True:
+            try:
+                if self._listen_conn is None or self._listen_conn.is_closed():
+                    self._listen_conn = await asyncpg.connect(self.dsn)
+                    await self._listen_conn.add_listener(PUBLISH_CHANNEL, self._on_notify)
+                    await self._listen_conn.add_listener(TOPIC_CHANGE_CHANNEL, self._on_notify)
+                    self._listen_epoch += 1
+                    logging.info(f'Listening for notifications on {PUBLISH_CHANNEL}, {TOPIC_CHANGE_CHANNEL}')
+                    # notifications may have been missed while disconnected
+                    for topic in list(self._topic_events):
+                        self._wake(topic)
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                logging.error(f'Notification listener connection failed: {e}')
+                self._listen_conn = None
+            await asyncio.sleep(1.0)
+
+    # -- coalesced acks, see queue_acks.py --
+
+    def _wake_ack_flush(self):
+        if self._ack_due is not None:
+            self._ack_due.set()
+
+    async def flush_acks(self):
+        """
+        Write the pending acks now. Returns once they (and any flush already running) are committed or failed.
+        """
+        async with self._ack_flush_lock:
+            subscriber_ids, partitions, offsets = self.acks.take()
+            if not subscriber_ids:
+                self.acks.done(True)
+                return
+            try:
+                async with self.db_pool.acquire() as conn:
+                    await conn.execute(numbered_placeholders(FLUSH_SQL), subscriber_ids, partitions, offsets)
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                self.acks.done(False)
+                logging.error(f'Ack flush of {len(offsets)} offsets failed: {e}')
+                return
+            self.acks.done(True)
+
+    async def _ack_flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._ack_due.wait(), self.acks.flush_ms / 1000.0)
+            except asyncio.TimeoutError:
+                pass
+            self._ack_due.clear()
+            await self.flush_acks()
+
+    # -- retention, see queue_retention.py --
+
+    async def _retention_loop(self):
+        while True:
+            await asyncio.sleep(RETENTION_INTERVAL)
+            start = time.monotonic()
+            try:
+                async with self.db_pool.acquire() as conn:
+                    topics = [r['topic'] for r in await conn.fetch(TOPICS_SQL)]
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                self.retention_stats.record_error()
+                logging.error(f'Retention run failed: {e}')
+                continue
+            for topic in topics:
+                try:
+                    async with self.db_pool.acquire() as conn:
+                        async with conn.transaction():
+                            row = await conn.fetchrow(numbered_placeholders(RETENTION_SQL), topic, RETENTION_MAX_SEGMENTS)
+                except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                    self.retention_stats.record_error()
+                    logging.error(f'Retention failed for topic {topic}: {e}')
+                    continue
+                if row:
+                    self.retention_stats.record(dict(row))
+                    if row['segments_dropped']:
+                        logging.info(f'Retention dropped {row["segments_dropped"]} segments ({row["rows_reclaimed"]} messages, '
+                                     f'{row["bytes_reclaimed"]} bytes) of topic {topic}')
+            self.retention_stats.record_run(time.monotonic() - start)
+
+    # -- HTTP/1.1 connection handling --
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if not self.admission.connect():
+            handler = QAsyncRequestHandler(self, 'GET', '', {}, b'')
+            handler._retry_later(HTTPStatus.SERVICE_UNAVAILABLE, ADMISSION_RETRY_AFTER, 'Too many connections, try again later')
+            try:
+                await self._write_response(writer, 'HTTP/1.1', handler.response, keep_alive=False)
+            except ConnectionError:
+                pass
+            writer.close()
+            return
+        self._connections += 1
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), ASYNC_KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    break
+                method, target, version = parts
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length') or 0)
+                if length > ASYNC_MAX_BODY_SIZE:
+                    handler = QAsyncRequestHandler(self, method, target, headers, b'')
+                    handler.send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                       {'http_status': HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'error_message': 'Request body too large'})
+                    await self._write_response(writer, version, handler.response, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                connection_header = headers.get('connection', '').lower()
+                if version == 'HTTP/1.1':
+                    keep_alive = connection_header != 'close'
+                else:
+                    keep_alive = connection_header == 'keep-alive'
+
+                start = time.perf_counter()
+                handler = QAsyncRequestHandler(self, method.upper(), target, headers, body)
+                try:
+                    await handler.handle()
+                except Exception as e:
+                    logging.exception(f'Unhandled error for {method} {target}')
+                    handler.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
+                                       {'http_status': HTTPStatus.INTERNAL_SERVER_ERROR, 'error_message': str(e)})
+                try:
+                    keep_alive = await self._write_response(writer, version, handler.response, keep_alive)
+                finally:
+                    # observed after the write so that streamed responses are timed to their last chunk
+                    self.metrics.observe(handler.route, handler.command, int(handler.response[0]), time.perf_counter() - start,
+                                         db=handler.db_time, serialize=handler.serialize_time)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self._connections -= 1
+            self.admission.disconnect()
+            writer.close()
+
+    async def _write_response(self, writer: asyncio.StreamWriter, version: str, response: tuple, keep_alive: bool) -> bool:
+        """
+        Write a response. A body that is an async iterator of bytes is streamed with chunked
+        encoding (or until close for HTTP/1.0). Returns whether the connection can be reused.
+        """
+        status, headers, body = response
+        status = HTTPStatus(status)
+        streaming = not isinstance(body, (bytes, bytearray))
+        chunked = streaming and version == 'HTTP/1.1'
+        if streaming and not chunked:
+            keep_alive = False
+        lines = [f'{version if version in ("HTTP/1.0", "HTTP/1.1") else "HTTP/1.1"} {status.value} {status.phrase}']
+        for name, value in headers.items():
+            lines.append(f'{name}: {value}')
+        # tells clients they may publish with the framed format, see queue_wire.py
+        lines.append(f'Accept-Post: {ACCEPT_POST}')
+        # and compress their request bodies, see queue_compression.py
+        lines.append(f'Accept-Encoding: {ACCEPT_ENCODING}')
+        if chunked:
+            lines.append('Transfer-Encoding: chunked')
+        elif not streaming:
+            lines.append(f'Content-Length: {len(body)}')
+        if keep_alive and version == 'HTTP/1.0':
+            lines.append('Connection: keep-alive')
+        elif not keep_alive:
+            lines.append('Connection: close')
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        if not streaming:
+            writer.write(head + body)
+            await writer.drain()
+            return keep_alive
+
+        writer.write(head)
+        try:
+            async for chunk in body:
+                if not chunk:
+                    continue
+                writer.write(f'{len(chunk):X}\r\n'.encode('latin-1') + chunk + b'\r\n' if chunked else chunk)
+                await writer.drain()
+        finally:
+            await body.aclose()
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        return keep_alive
+
+
+class QAsyncRequestHandler:
+    """
+    Per-request handler mirroring QRequestHandler: routes map to do_<route> coroutines and the
+    request parameters come from the query string or the JSON body.
+    """
+    def __init__(self, server: QAsyncServer, command: str, path: str, headers: dict, body: bytes):
+        self.server = server
+        self.command = command
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self._query_params = {}
+        self.response = (HTTPStatus.OK, {}, b'')
+        # only known routes become metric labels, so made up paths cannot grow the label set
+        self.route = 'unknown'
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self._admitted = False
+
+    @asynccontextmanager
+    async def _connection(self):
+        start = time.perf_counter()
+        try:
+            async with self.server.connection() as conn:
+                yield conn
+        finally:
+            self.db_time += time.perf_counter() - start
+
+    def _serialize(self, data) -> bytes:
+        start = time.perf_counter()
+        body = json.dumps(data, default=str).encode('utf-8')
+        self.serialize_time += time.perf_counter() - start
+        return body
+
+    def _set_response(self, status: int=HTTPStatus.OK, headers: dict={'Content-type': 'application/json'}, body: bytes=b''):
+        headers = dict(headers)
+        compressible = ('application/json', FRAMES_CONTENT_TYPE, ENCODED_FRAMES_CONTENT_TYPE)
+        if isinstance(body, bytes) and headers.get('Content-type') in compressible:
+            encoding = response_encoding(self.headers.get('accept-encoding'), len(body))
+            if encoding:
+                start = time.perf_counter()
+                body = compress(body, encoding)
+                self.serialize_time += time.perf_counter() - start
+                headers['Content-Encoding'] = encoding
+                headers['Vary'] = 'Accept-Encoding'
+        self.response = (status, headers, body)
+
+    def _send_json(self, data, status: int=HTTPStatus.OK):
+        self._set_response(status, body=self._serialize(data))
+
+    def _send_messages(self, rows: list, unwrap: bool=False):
+        """
+        Send fetched messages framed when the client accepts it, else as JSON (a single message
+        unwrapped from the list with unwrap, as /get_message always did).
+        """
+        if not accepts_frames(self.headers.get('accept')):
+            rows = plain_rows(rows)
+            self._send_json(rows[0] if unwrap and len(rows) == 1 else rows)
+            return
+        # version 2 frames carry messages stored compressed as they are
+        version = 2 if accepts_encoded_frames(self.headers.get('accept')) else 1
+        start = time.perf_counter()
+        body = encode_rows(rows, version)
+        self.serialize_time += time.perf_counter() - start
+        self._set_response(headers={'Content-type': ENCODED_FRAMES_CONTENT_TYPE if version == 2 else FRAMES_CONTENT_TYPE},
+                           body=body)
+
+    def _retry_later(self, status: int, seconds: float, err_msg: str):
+        # Retry-After promises the client that nothing was done, so any request may be sent again
+        self._set_response(status, headers={'Content-type': 'application/json', 'Retry-After': retry_after(seconds)},
+                           body=self._serialize({'http_status': status, 'error_message': err_msg}))
+
+    def _rate_limited(self, topic: str, count: int) -> bool:
+        """
+        Take count messages from the publish rate limit of topic. Answers 429 and returns True when
+        the topic is over its limit.
+        """
+        wait = self.server.topic_limiter.take(topic, count)
+        if wait:
+            self.server.admission.topic_rejected()
+            logging.warning('Publish rate limit of topic %s exceeded, retry after %.3fs', topic, wait)
+            self._retry_later(HTTPStatus.TOO_MANY_REQUESTS, wait, f'Publish rate limit of topic {topic} exceeded, try again later')
+        return bool(wait)
+
+    def send_error(self, status: int, data: dict={}):
+        if data:
+            self._send_json(data, status)
+        else:
+            self._set_response(status, headers={})
+
+    async def handle(self):
+        logging.info('%s request, Path: %s', self.command, self.path, extra=PER_REQUEST)
+        if self.command == 'GET':
+            await self.handle_route()
+        elif self.command in ('POST', 'PUT'):
+            await self.handle_route(allowed_routes=POST_ROUTES)
+        elif self.command == 'DELETE':
+            await self.handle_route(allowed_routes=DELETE_ROUTES)
+        else:
+            self.send_error(
+                HTTPStatus.NOT_IMPLEMENTED,
+                {'http_status': HTTPStatus.NOT_IMPLEMENTED, 'error_message': "Unsupported command"})
+
+    async def handle_route(self, allowed_routes=[]):
+        parsed_path = urlparse(self.path)
+
+        content_encoding = self.headers.get('content-encoding', 'identity').strip().lower()
+        if self.body and content_encoding != 'identity':
+            if content_encoding not in ENCODINGS:
+                self.send_error(
+                    HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+                    {'http_status': HTTPStatus.UNSUPPORTED_MEDIA_TYPE, 'error_message': f'Unsupported Content-Encoding "{content_encoding}", use one of {ACCEPT_ENCODING}'})
+                return
+            try:
+                self.body = decompress(self.body, content_encoding)
+            except ValueError as e:
+                self.send_error(HTTPStatus.BAD_REQUEST, {'http_status': HTTPStatus.BAD_REQUEST, 'error_message': str(e)})
+                return
+
+        if self.command == 'POST':
+            content_type = self.headers.get('content-type')
+            if content_type == FRAMES_CONTENT_TYPE:
+                # framed messages to publish, everything else is in the query string
+                self._query_params = parse_qs(parsed_path.query)
+                try:
+                    messages = decode_messages(self.body)
+                except ValueError as e:
+                    self.send_error(HTTPStatus.BAD_REQUEST, {'http_status': HTTPStatus.BAD_REQUEST, 'error_message': str(e)})
+                    return
+                self._query_params['messages'] = messages
+                if len(messages) == 1:
+                    self._query_params['message'] = messages[0]
+            elif content_type != 'application/json':
+                self.send_error(
+                    HTTPStatus.BAD_REQUEST,
+                    {'http_status': HTTPStatus.BAD_REQUEST, 'error_message': f'POST command only accepts "application/json" or "{FRAMES_CONTENT_TYPE}" content type. (Got "{content_type}")'} )
+                return
+            else:
+                try:
+                    self._query_params = json.loads(self.body.decode('utf-8')) if self.body else {}
+                except ValueError as e:
+                    self.send_error(
+                        HTTPStatus.BAD_REQUEST,
+                        {'http_status': HTTPStatus.BAD_REQUEST, 'error_message': f'Invalid JSON body: {e}'})
+                    return
+        else:
+            self._query_params = parse_qs(parsed_path.query)
+
+        route = parsed_path.path.split('/')[-1:]
+        if route:
+            route = route[0]
+        else:
+            route = '___no_method_here'
+        route_method = 'do_' + route
+        if not hasattr(self, route_method):
+            self.send_error(
+                HTTPStatus.NOT_IMPLEMENTED,
+                {'http_status': HTTPStatus.NOT_IMPLEMENTED, 'error_message': f"Unsupported route ({route})"} )
+            return
+
+        self.route = route
+        if not allowed_routes or route in allowed_routes:
+            if route not in ADMISSION_EXEMPT_ROUTES:
+                if not self.server.admission.enter():
+                    logging.warning('Rejected /%s, %d requests in flight', route, self.server.admission.in_flight)
+                    self._retry_later(HTTPStatus.SERVICE_UNAVAILABLE, ADMISSION_RETRY_AFTER, 'Server busy, try again later')
+                    return
+                self._admitted = True
+            try:
+                await getattr(self, route_method)()
+            except asyncio.TimeoutError:
+                logging.error(f'Timed out after {self.server.acquire_timeout:.3f}s waiting for a database connection')
+                self.send_error(
+                    HTTPStatus.SERVICE_UNAVAILABLE,
+                    {'http_status': HTTPStatus.SERVICE_UNAVAILABLE, 'error_message': 'No database connection available, try again later'})
+            finally:
+                if self._admitted:
+                    self.server.admission.leave()
+                    self._admitted = False
+        else:
+            err_msg = f"Unsupported route ({route}) for {self.command}"
+            logging.error(err_msg)
+            self.send_error(
+                HTTPStatus.UNAUTHORIZED,
+                {'http_status': HTTPStatus.UNAUTHORIZED, 'error_message': err_msg})
+
+    def _param(self, name: str, default=None):
+        value = self._query_params.get(name, default)
+        return value[0] if isinstance(value, (list, tuple)) else value
+
+    def _int_params(self, **names) -> tuple:
+        """
+        Convert the named parameters (name=default) to ints. Returns (values, error messages).
+        """
+        values = {}
+        err_msg = []
+        for name, default in names.items():
+            value = self._param(name, default)
+            try:
+                values[name] = int(value)
+            except (TypeError, ValueError):
+                err_msg.append(f'Expected integer value for the {name} parameter. Got [{value}].')
+        return values, err_msg
+
+    def _unprocessable(self, err_msg: str):
+        logging.error(err_msg)
+        self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY,
+                        {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
+
+    async def _do_list(self, table_name: str):
+        stream = is_stream_request(self._query_params, self.headers.get('accept'))
+        try:
+            sql, values, limit = list_query(table_name, self._query_params, stream)
+        except ValueError as e:
+            self._unprocessable(str(e))
+            return
+        sql = numbered_placeholders(sql)
+
+        if stream:
+            headers = {'Content-type': 'application/x-ndjson'}
+            encoding = response_encoding(self.headers.get('accept-encoding'), float('inf'))
+            if encoding:
+                headers.update({'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
+            self._set_response(headers=headers, body=self._stream_rows(table_name, sql, values, encoding))
+            return
+
+        async with self._connection() as conn:
+            res = [dict(r) for r in await conn.fetch(sql, *values)]
+        logging.info('Got %d records from table %s', len(res), table_name, extra=PER_REQUEST)
+        if table_name == 'topic_message':
+            res = plain_rows(res)
+        self._send_json(res)
+        next_path = next_page(table_name, self._query_params, res, limit)
+        if next_path:
+            self.response[1]['X-Next-Page'] = next_path
+
+    async def _stream_rows(self, table_name: str, sql: str, values: list, encoding: str=None):
+        count = 0
+        # every chunk is flushed through the compressor, so rows still go out as they are read
+        comp = compressor(encoding) if encoding else None
+        async with self._connection() as conn:
+            batch = []
+            async for record in conn.cursor(sql, *values, prefetch=STREAM_FETCH_SIZE):
+                start = time.perf_counter()
+                row = dict(record)
+                if table_name == 'topic_message':
+                    row, = plain_rows([row])
+                batch.append(json.dumps(row, default=str) + '\n')
+                self.serialize_time += time.perf_counter() - start
+                if len(batch) >= STREAM_FETCH_SIZE:
+                    count += len(batch)
+                    data = ''.join(batch).encode('utf-8')
+                    yield comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH) if comp else data
+                    batch = []
+            if batch:
+                count += len(batch)
+                data = ''.join(batch).encode('utf-8')
+                yield comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH) if comp else data
+        if comp:
+            yield comp.flush()
+        logging.info('Streamed %d records from table %s', count, table_name, extra=PER_REQUEST)
+
+    # list topics route: /topics?after_topic=<topic>&limit=<limit>&stream=<0|1>
+    async def do_topics(self):
+        await self._do_list("topic")
+
+    # list messages route: /topic_messages?topic=<topic>&partition=<partition>&after_partition=<partition>&after_offset=<offset>&limit=<limit>&stream=<0|1>
+    async def do_topic_messages(self):
+        await self._do_list("topic_message")
+
+    # list subscribers route: /topic_subscribers?topic=<topic>&after_id=<id>&limit=<limit>&stream=<0|1>
+    async def do_topic_subscribers(self):
+        await self._do_list("topic_subscriber")
+
+    # subscriber lag route: /lag?topic=<topic>
+    # per topic and subscriber: head and committed offsets, message lag and age of the oldest unacked message
+    async def do_lag(self):
+        topic = self._param('topic') or None
+        rows = self.server.lag_cache.get(topic)
+        if rows is None:
+            async with self._connection() as conn:
+                rows = [dict(r) for r in await conn.fetch("""select * from topic_lag($1);""", topic)]
+            self.server.lag_cache.put(topic, rows)
+        self._send_json(lag_report(rows))
+
+    # Prometheus metrics route: /metrics
+    async def do_metrics(self):
+        body = self.server.metrics.render().encode('utf-8')
+        self._set_response(headers={'Content-type': 'text/plain; version=0.0.4; charset=utf-8'}, body=body)
+
+    # connection pool statistics route: /pool_stats
+    async def do_pool_stats(self):
+        self._send_json(self.server.pool_stats())
+
+    # create topic route: /topic?topic=<name>&description=<description>&partitions=<n>&segment_size=<n>&retention_ms=<ms>&retention_messages=<count>&retention_acked=<0|1>&compression=<gzip|deflate>
+    async def do_topic(self):
+        new_topic = self._param('topic')
+        new_topic_desc = self._param('description')
+        if not (new_topic and new_topic_desc):
+            self._unprocessable("Missing parameters topic, description")
+            return
+        policy, err_msg = self._retention_params('segment_size', 'partitions')
+        if (policy.get('partitions') or 1) > TOPIC_MAX_PARTITIONS:
+            err_msg.append(f'A topic can have at most {TOPIC_MAX_PARTITIONS} partitions. Got [{policy["partitions"]}].')
+        compression = self._param('compression') or None
+        if compression is not None and compression not in ENCODINGS:
+            err_msg.append(f'Expected one of {", ".join(ENCODINGS)} for the compression parameter. Got [{compression}].')
+        if err_msg:
+            self._unprocessable('<br>'.join(err_msg))
+            return
+        try:
+            async with self._connection() as conn:
+                res = await conn.fetchval("""select topic_create($1, $2, $3, $4, $5, $6, $7, $8);""", new_topic, new_topic_desc,
+                                          policy['segment_size'], policy['retention_ms'], policy['retention_messages'],
+                                          policy['retention_acked'], policy['partitions'], compression)
+        except asyncpg.IntegrityConstraintViolationError:
+            self._unprocessable(f'The topic "{new_topic}" already exists')
+            return
+        if res == new_topic:
+            logging.info(f"Created topic '{new_topic}'")
+            self._send_json({'topic': new_topic, 'partitions': policy['partitions'] or 1,
+                             'message': f'Topic "{new_topic}" created'})
+        else:
+            self._unprocessable(f'Unknown error -- topic {new_topic} creation failed')
+
+    def _retention_params(self, *extra) -> tuple:
+        """
+        Optional retention policy parameters (plus the extra integer parameters named), missing
+        ones as None. Returns (values, error messages).
+        """
+        values = {}
+        err_msg = []
+        for name in ('retention_ms', 'retention_messages') + extra:
+            value = self._param(name)
+            if value in (None, '', 0, '0'):
+                values[name] = None
+                continue
+            try:
+                values[name] = int(value)
+            except (TypeError, ValueError):
+                err_msg.append(f'Expected integer value for the {name} parameter. Got [{value}].')
+                continue
+            if values[name] < 0:
+                err_msg.append(f'Expected a positive value for the {name} parameter. Got [{value}].')
+        acked = self._param('retention_acked', False)
+        values['retention_acked'] = acked is True or str(acked).lower() in ('1', 'true', 'yes')
+        return values, err_msg
+
+    # retention policy route: /topic_retention?topic=<topic>&retention_ms=<ms>&retention_messages=<count>&retention_acked=<0|1>
+    # replaces the policy of the topic, a missing or 0 limit turns it off
+    async def do_topic_retention(self):
+        target_topic = self._param('topic')
+        if not target_topic:
+            self._unprocessable("Missing parameter: topic")
+            return
+        policy, err_msg = self._retention_params()
+        if err_msg:
+            self._unprocessable('<br>'.join(err_msg))
+            return
+        async with self._connection() as conn:
+            res = await conn.fetchrow("""select * from topic_set_retention($1, $2, $3, $4);""", target_topic,
+                                      policy['retention_ms'], policy['retention_messages'], policy['retention_acked'])
+        if res is None:
+            self._unprocessable(f'The topic "{target_topic}" does not exist')
+            return
+        logging.info(f'Set retention of topic {target_topic} to {policy}')
+        self._send_json({name: res[name] for name in ('topic', 'segment_size', 'retention_ms', 'retention_messages', 'retention_acked')})
+
+    # delete topic route: /topic_delete?topic=<topic>
+    async def do_topic_delete(self):
+        target_topic = self._param('topic')
+        if not target_topic:
+            self._unprocessable("Missing parameter: topic")
+            return
+        logging.info(f"Deleting topic {target_topic}")
+        async with self._connection() as conn:
+            await conn.execute("""select topic_delete($1);""", target_topic)
+        self.server._compression.pop(target_topic, None)
+        self.server.tail_cache.invalidate(target_topic)
+        self.server.acks.discard_topic(target_topic)
+        if self.command == 'GET':
+            self._send_json({'message': f'Topic "{target_topic}" deleted'})
+        else:
+            self._set_response(headers={})
+
+    # save message route: /publish?topic=<topic>&message=<message>&key=<key>
+    # messages with the same key go to the same partition of the topic, messages without one are spread round-robin
+    async def do_publish(self):
+        target_topic = self._param('topic')
+        message = self._param('message')
+        if not target_topic or message is None:
+            self._unprocessable("Missing parameters topic, message")
+            return
+        if self._rate_limited(target_topic, 1):
+            return
+        try:
+            async with self._connection() as conn:
+                compression = await self.server.topic_compression(conn, target_topic)
+                payload = encode_payload(message, compression) if compression else None
+                if payload is None:
+                    res = await conn.fetchrow(HOT_STATEMENTS['q_save_message'], target_topic, message,
+                                              self._param('key'), None, None)
+                else:
+                    res = await conn.fetchrow(HOT_STATEMENTS['q_save_message'], target_topic, None,
+                                              self._param('key'), payload, compression)
+        except asyncpg.IntegrityConstraintViolationError:
+            self._unprocessable(f'Topic "{target_topic}" does not exist')
+            return
+        if res is None or res['_offset'] is None:
+            self._unprocessable(f"Failed to save message to topic {target_topic}")
+            return
+        self.server.tail_cache.publish(self.server.listen_epoch, dict(res))
+        if self.command == 'GET':
+            self._send_json({'message': f'Saved message to topic "{target_topic}" at partition {res["_partition"]} offset {res["_offset"]}',
+                             'partition': res['_partition'],
+                             'offset': res['_offset']})
+        else:
+            self._set_response(headers={'X-Partition': str(res['_partition']), 'X-Offset': str(res['_offset'])})
+
+    # save message batch route: /publish_batch?topic=<topic>&messages=<message>&messages=<message>...&key=<key>
+    # the whole batch goes to one partition
+    async def do_publish_batch(self):
+        target_topic = self._param('topic')
+        messages = self._query_params.get('messages')
+        if not target_topic or not messages:
+            self._unprocessable("Missing parameters topic, messages")
+            return
+        if not isinstance(messages, (list, tuple)) or not all(isinstance(m, str) for m in messages):
+            self._unprocessable("Parameter messages must be a list of strings")
+            return
+        if len(messages) > PUBLISH_BATCH_MAX:
+            self._unprocessable(f"Batch of {len(messages)} messages exceeds the limit of {PUBLISH_BATCH_MAX}")
+            return
+        if self._rate_limited(target_topic, len(messages)):
+            return
+        try:
+            async with self._connection() as conn:
+                compression = await self.server.topic_compression(conn, target_topic)
+                payloads = [encode_payload(m, compression) for m in messages] if compression else []
+                if any(p is not None for p in payloads):
+                    res = await conn.fetchrow(HOT_STATEMENTS['q_save_messages'], target_topic,
+                                              [m if p is None else None for m, p in zip(messages, payloads)],
+                                              self._param('key'), payloads, [None if p is None else compression for p in payloads])
+                else:
+                    res = await conn.fetchrow(HOT_STATEMENTS['q_save_messages'], target_topic, list(messages),
+                                              self._param('key'), None, None)
+        except asyncpg.IntegrityConstraintViolationError:
+            self._unprocessable(f'Topic "{target_topic}" does not exist')
+            return
+        if res is None or res['first_offset'] is None:
+            self._unprocessable(f"Failed to save messages to topic {target_topic}")
+            return
+        self._send_json({'topic': target_topic,
+                         'partition': res['_partition'],
+                         'first_offset': res['first_offset'],
+                         'last_offset': res['last_offset'],
+                         'count': len(messages)})
+
+    # subscribe route: /subscribe?topic=<topic>&group=<group>&partitions=<partition>&partitions=<partition>...&ack_mode=<durable|coalesced>
+    # members of the same group share the group offsets and each message is handed to one of them.
+    # Without partitions the subscriber consumes every partition of the topic
+    async def do_subscribe(self):
+        target_topic = self._param('topic')
+        group = self._param('group') or None
+        if not target_topic:
+            self._unprocessable("Missing 'topic' parameter")
+            return
+        partitions, err_msg = self._int_list('partitions')
+        ack_mode, ack_err = self._ack_mode()
+        err_msg += ack_err
+        if err_msg:
+            self._unprocessable('<br>'.join(err_msg))
+            return
+        try:
+            async with self._connection() as conn:
+                res = await conn.fetchval("""select topic_subscribe($1, $2, $3::int[], $4);""", target_topic, group,
+                                          partitions or None, ack_mode)
+        except asyncpg.IntegrityConstraintViolationError:
+            self._unprocessable(f'The topic "{target_topic}" does not exist')
+            return
+        except asyncpg.InvalidParameterValueError as e:
+            self._unprocessable(e.message)
+            return
+        data = {'topic': target_topic, 'subscriber_id': res}
+        if group:
+            data['group'] = group
+        if partitions:
+            data['partitions'] = sorted(set(partitions))
+        if ack_mode:
+            data['ack_mode'] = ack_mode
+        self._send_json(data)
+
+    # unsubscribe route: /unsubscribe?subscriber_id=<id>
+    async def do_unsubscribe(self):
+        if not self._param('subscriber_id'):
+            self._unprocessable("Missing parameter: subscriber_id")
+            return
+        values, err_msg = self._int_params(subscriber_id=None)
+        if err_msg:
+            self._unprocessable('<br>'.join(err_msg))
+            return
+        subscriber_id = values['subscriber_id']
+        logging.info(f"Deleting subscriber {subscriber_id}")
+        async with self._connection() as conn:
+            await conn.execute("""select unsubscribe($1);""", subscriber_id)
+        self.server.acks.forget(subscriber_id)
+        self.server.streams.close_subscriber(subscriber_id)
+        if self.command == 'GET':
+            self._send_json({'message': f'Subscriber "{subscriber_id}" deleted'})
+        else:
+            self._set_response(headers={})
+
+    # get message route: /get_message?subscriber_id=<subscriber_id>&num_messages=1&wait_ms=0
+    # &after_partitions=<partition>&after_offsets=<offset>... reads past offsets already delivered without acking them
+    async def do_get_message(self):
+        if not self._param('subscriber_id'):
+            self._unprocessable("Missing 'topic' parameter")
+            return
+        values, err_msg = self._int_params(subscriber_id=None, num_messages=1, wait_ms=0)
+        after_partitions, after_offsets, after_err = self._after_offsets()
+        err_msg += after_err
+        if err_msg:
+            self._unprocessable('<br>'.join(err_msg))
+            return
+        # acks still held by the ack coalescer count as made, and so does the client's read cursor
+        after = (after_partitions, after_offsets)
+        pending_partitions, pending_offsets = highest_offsets(self.server.acks.offsets(values['subscriber_id']), after)
+        res = await self._get_messages(values['subscriber_id'], values['wait_ms'],
+                                       HOT_STATEMENTS['q_get_message'],
+                                       (values['subscriber_id'], values['num_messages'], pending_partitions, pending_offsets),
+                                       cached_messages=max(1, min(values['num_messages'], GET_MESSAGE_MAX)), after=after)
+        logging.info('Fetched %d messages for subscriber %s', len(res), values['subscriber_id'], extra=PER_REQUEST)
+        self._send_messages(res, unwrap=True)
+
+    # ack and fetch route: /ack_fetch?subscriber_id=<subscriber_id>&offset=<offset>&partition=<partition>&num_messages=20&wait_ms=0
+    # or with the last processed offset of several partitions: &partitions=<partition>&offsets=<offset>&partitions=<partition>&offsets=<offset>...
+    async def do_ack_fetch(self):
+        if not self._param('subscriber_id'):
+            self._unprocessable("Missing parameter: subscriber_id")
+            return
+        values, err_msg = self._int_params(subscriber_id=None, num_messages=1, wait_ms=0)
+        # without an offset nothing is acked, e.g. on the first fetch
+        partitions, offsets, ack_err = self._partition_offsets()
+        err_msg += ack_err
+        if err_msg:
+            self._unprocessable('<br>'.join(err_msg))
+            return
+        # the ack is committed with the first fetch, later polls only fetch. Coalesced acks of the
+        # subscriber still waiting for a flush are committed along with it
+        pending_partitions, pending_offsets = self.server.acks.offsets(values['subscriber_id'])
+        res = await self._get_messages(values['subscriber_id'], values['wait_ms'],
+                                       HOT_STATEMENTS['q_ack_fetch'],
+                                       (values['subscriber_id'], partitions + pending_partitions, offsets + pending_offsets,
+                                        values['num_messages']),
+                                       (values['subscriber_id'], [], [], values['num_messages']))
+        self.server.acks.settle(values['subscriber_id'], pending_partitions, pending_offsets)
+        self.server.streams.acked(values['subscriber_id'], partitions, offsets)
+        logging.info('Acked offsets %s of partitions %s and fetched %d messages for subscriber %s', offsets, partitions,
+                     len(res), values['subscriber_id'], extra=PER_REQUEST)
+        # always a list, unlike /get_message which unwraps a single message
+        self._send_messages(res)
+
+    async def _get_messages(self, subscriber_id: int, wait_ms: int, sql: str, args: tuple, poll_args: tuple=None,
+                            cached_messages: int=None, after: tuple=((), ())) -> list:
+        wait_ms = max(0, min(wait_ms, GET_MESSAGE_MAX_WAIT_MS))
+        deadline = time.monotonic() + wait_ms / 1000.0
+        cache = self.server.tail_cache
+        topic = None
+        generation = None
+        while True:
+            async with self._connection() as conn:
+                subscriber = None
+                if cached_messages and cache.enabled:
+                    # the offsets are read on every check, acks may come through any server process
+                    subscriber = await conn.fetchrow(HOT_STATEMENTS['q_subscriber'],
+                                                     subscriber_id)
+                    if subscriber is None:
+                        return []
+                    topic = subscriber['topic']
+                elif wait_ms and topic is None:
+                    topic = await conn.fetchval(HOT_STATEMENTS['q_subscriber_topic'], subscriber_id)
+                    if topic is None:
+                        return []
+                if wait_ms and generation is None:
+                    generation = self.server.generation(topic)
+                
+                res = None
+                if subscriber is not None and subscriber['group_id'] is None:
+                    epoch = self.server.listen_epoch
+                    offsets = self.server.acks.merge_offsets(subscriber_id, subscriber['_offsets'])
+                    for partition, offset in zip(*after):
+                        if partition < len(offsets):
+                            offsets[partition] = max(offset, offsets[partition])
+                    res = cache.read(epoch, topic, subscriber['partitions'], offsets, cached_messages)
+                if res is None:
+                    res = [dict(r) for r in await conn.fetch(sql, *args)]
+                    if subscriber is not None and subscriber['group_id'] is None:
+                        cache.fill(epoch, topic, subscriber['partitions'], offsets, cached_messages, res)
+
+            remaining = deadline - time.monotonic()
+            if res or remaining <= 0:
+                return res
+            # a parked long-poll holds no database connection, so it does not count as in flight
+            if self._admitted:
+                self.server.admission.leave()
+            try:
+                await self.server.wait_for_publish(topic, generation, remaining)
+            finally:
+                if self._admitted:
+                    self.server.admission.resume()
+            generation = self.server.generation(topic)
+            args = poll_args or args
+
+    # stream route: /stream?subscriber_id=<subscriber_id>&credits=<n>&format=<ndjson|sse>&heartbeat_ms=<ms>
+    # pushes messages as they are published, at most credits of them delivered and not acked, see queue_stream.py
+    async def do_stream(self):
+        if not self._param('subscriber_id'):
+            self._unprocessable("Missing parameter: subscriber_id")
+            return
+        values, err_msg = self._int_params(subscriber_id=None, credits=STREAM_CREDITS, heartbeat_ms=STREAM_HEARTBEAT_MS)
+        if not err_msg and not 0 < values['credits'] <= STREAM_MAX_CREDITS:
+            err_msg.append(f'Expected between 1 and {STREAM_MAX_CREDITS} credits. Got [{values["credits"]}].')
+        if not err_msg and values['heartbeat_ms'] <= 0:
+            err_msg.append(f'Expected a positive heartbeat_ms. Got [{values["heartbeat_ms"]}].')
+        try:
+            fmt = stream_format(self._param('format'), self.headers.get('accept'))
+        except ValueError as e:
+            err_msg.append(str(e))
+        if not err_msg:
+            async with self._connection() as conn:
+                subscriber = await conn.fetchrow(HOT_STATEMENTS['q_subscriber'], values['subscriber_id'])
+            if subscriber is None:
+                err_msg.append(f'Subscriber {values["subscriber_id"]} does not exist')
+            elif subscriber['group_id'] is not None:
+                err_msg.append(f'Subscriber {values["subscriber_id"]} is a consumer group member, those claim messages with /group_fetch')
+        if err_msg:
+            self._unprocessable('<br>'.join(err_msg))
+            return
+        window = QStreamWindow(values['subscriber_id'], subscriber['topic'], values['credits'])
+        headers = {'Content-type': STREAM_FORMATS[fmt]}
+        encoding = response_encoding(self.headers.get('accept-encoding'), float('inf'))
+        if encoding:
+            headers.update({'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
+        self._set_response(headers=headers, body=self._stream_messages(window, fmt, values['heartbeat_ms'] / 1000.0, encoding))
+
+    async def _stream_messages(self, window: QStreamWindow, fmt: str, heartbeat_interval: float, encoding: str=None):
+        """
+        Yield message chunks until the stream is closed, like QRequestHandler._stream_messages().
+        Runs after the route returned, so a stream is never counted as in flight.
+        """
+        subscriber_id = window.subscriber_id
+        acks = self.server.acks
+        comp = compressor(encoding) if encoding else None
+        wake = asyncio.Event()
+        self.server.streams.register(window, wake.set)
+        last_write = time.monotonic()
+        try:
+            try:
+                while not window.closed:
+                    wake.clear()
+                    available = window.available
+                    data = None
+                    if available > 0:
+                        # taken before the read, so a publish during it is not missed
+                        generation = self.server.generation(window.topic)
+                        pending_partitions, pending_offsets = highest_offsets(acks.offsets(subscriber_id), window.after())
+                        async with self._connection() as conn:
+                            rows = [dict(r) for r in await conn.fetch(HOT_STATEMENTS['q_get_message'], subscriber_id,
+                                                                      min(available, GET_MESSAGE_MAX), pending_partitions,
+                                                                      pending_offsets)]
+                        if rows:
+                            window.delivered(rows)
+                            self.server.streams.count_delivered(len(rows))
+                            data = encode_events(plain_rows(rows), fmt)
+                    if data is None:
+                        timeout = min(max(0.0, last_write + heartbeat_interval - time.monotonic()), STREAM_CREDIT_POLL_MS / 1000.0)
+                        if available > 0:
+                            await self.server.wait_for_publish(window.topic, generation, timeout)
+                        else:
+                            try:
+                                await asyncio.wait_for(wake.wait(), timeout)
+                            except asyncio.TimeoutError:
+                                # acks made through other server processes only show in the committed offsets
+                                async with self._connection() as conn:
+                                    subscriber = await conn.fetchrow(HOT_STATEMENTS['q_subscriber'], subscriber_id)
+                                if subscriber is None:
+                                    break
+                                window.committed(acks.merge_offsets(subscriber_id, subscriber['_offsets']))
+                        if time.monotonic() - last_write < heartbeat_interval:
+                            continue
+                        # the subscriber may have been deleted through another server process
+                        async with self._connection() as conn:
+                            if await conn.fetchval(HOT_STATEMENTS['q_subscriber_topic'], subscriber_id) is None:
+                                break
+                        data = heartbeat(fmt)
+                    last_write = time.monotonic()
+                    yield comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH) if comp else data
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                # the response has started, ending it is all that is left to tell the client
+                logging.error('Stream of subscriber %s failed: %s', subscriber_id, e)
+            if comp:
+                yield comp.flush()
+        finally:
+            self.server.streams.unregister(window)
+            logging.info('Streamed %d messages to subscriber %s', window.sent, subscriber_id)
+
+    def _int_list(self, name: str) -> tuple:
+        """
+        Integer list parameter, from repeated query parameters or a JSON list. Returns (values, error messages).
+        """
+        value = self._query_params.get(name) or []
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        try:
+            return [int(v) for v in value], []
+        except (TypeError, ValueError):
+            return [], [f'Expected a list of integers for the {name} parameter. Got [{value}].']
+
+    def _ack_mode(self) -> tuple:
+        """
+        The ack_mode parameter, None when not given. Returns (value, error messages).
+        """
+        value = self._param('ack_mode') or None
+        if value is not None and value not in ACK_MODES:
+            return None, [f'Expected one of {", ".join(ACK_MODES)} for the ack_mode parameter. Got [{value}].']
+        return value, []
+
+    def _partition_offsets(self) -> tuple:
+        """
+        Offsets to ack as parallel partitions and offsets lists, from the offsets and partitions list
+        parameters or a single offset and partition. Partitions default to 0, the only partition of an
+        unpartitioned topic. Returns (partitions, offsets, error messages).
+        """
+        offsets, err_msg = self._int_list('offsets')
+        partitions, partitions_err = self._int_list('partitions')
+        err_msg += partitions_err
+        if not offsets and self._param('offset') is not None:
+            values, single_err = self._int_params(offset=None, partition=0)
+            err_msg += single_err
+            if not single_err:
+                offsets, partitions = [values['offset']], [values['partition']]
+        if not partitions:
+            partitions = [0] * len(offsets)
+        if len(partitions) != len(offsets):
+            err_msg.append(f'Expected one partition per offset. Got {len(partitions)} partitions and {len(offsets)} offsets.')
+        return partitions, offsets, err_msg
+
+    def _after_offsets(self) -> tuple:
+        """
+        Read cursor of /get_message as parallel partitions and offsets lists, from the after_partitions
+        and after_offsets parameters. Returns (partitions, offsets, error messages).
+        """
+        offsets, err_msg = self._int_list('after_offsets')
+        partitions, partitions_err = self._int_list('after_partitions')
+        err_msg += partitions_err
+        if not partitions:
+            partitions = [0] * len(offsets)
+        if len(partitions) != len(offsets):
+            err_msg.append(f'Expected one partition per offset. Got {len(partitions)} after_partitions and {len(offsets)} after_offsets.')
+        return partitions, offsets, err_msg
+
+    # consumer group claim route: /group_fetch?subscriber_id=<subscriber_id>&partitions=<partition>&offsets=<offset>...&num_messages=20&lease_ms=<ms>&wait_ms=0
+    # acks the given messages and leases the next messages no other member of the group holds
+    async def do_group_fetch(self):
+        if not self._param('subscriber_id'):
+            self._unprocessable("Missing parameter: subscriber_id")
+            return
+        values, err_msg = self._int_params(subscriber_id=None, num_messages=1, wait_ms=0)
+        # without lease_ms the group default applies
+        lease_ms = None
+        if self._param('lease_ms') is not None:
+            lease, lease_err = self._int_params(lease_ms=None)
+            lease_ms = lease.get('lease_ms')
+            err_msg += lease_err
+        partitions, offsets, ack_err = self._partition_offsets()
+        err_msg += ack_err
+        if err_msg:
+            self._unprocessable('<br>'.join(err_msg))
+            return
+        # the acks are committed with the first claim, later polls only claim
+        res = await self._get_messages(values['subscriber_id'], values['wait_ms'],
+                                       HOT_STATEMENTS['q_group_fetch'],
+                                       (values['subscriber_id'], partitions, offsets, values['num_messages'], lease_ms),
+                                       (values['subscriber_id'], [], [], values['num_messages'], lease_ms))
+        logging.info('Acked %d and claimed %d messages for subscriber %s', len(offsets), len(res),
+                     values['subscriber_id'], extra=PER_REQUEST)
+        self._send_messages(res)
+
+    # consumer group ack route: /group_ack?subscriber_id=<subscriber_id>&partitions=<partition>&offsets=<offset>&partitions=<partition>&offsets=<offset>...
+    async def do_group_ack(self):
+        if not self._param('subscriber_id'):
+            self._unprocessable("Missing parameter: subscriber_id")
+            return
+        values, err_msg = self._int_params(subscriber_id=None)
+        partitions, offsets, ack_err = self._partition_offsets()
+        err_msg += ack_err
+        if err_msg:
+            self._unprocessable('<br>'.join(err_msg))
+            return
+        async with self._connection() as conn:
+            res = await conn.fetchval(HOT_STATEMENTS['q_group_ack'], values['subscriber_id'],
+                                      partitions, offsets)
+        if res is None:
+            self._unprocessable(f'Subscriber {values["subscriber_id"]} is not a member of a consumer group')
+            return
+        self._send_json({'subscriber_id': values['subscriber_id'], 'acked': len(offsets), 'group_offsets': list(res)})
+
+    # ack_message route: /ack_message?subscriber_id=<subscriber_id>&offset=<offset>&partition=<partition>&ack_mode=<durable|coalesced>
+    # a coalesced ack is answered before it is committed, see queue_acks.py
+    async def do_ack_message(self):
+        if not (self._param('subscriber_id') and self._param('offset')):
+            self._unprocessable("Missing parameter: topic")
+            return
+        values, err_msg = self._int_params(subscriber_id=None, offset=None, partition=0)
+        ack_mode, ack_err = self._ack_mode()
+        err_msg += ack_err
+        if err_msg:
+            self._unprocessable('<br>'.join(err_msg))
+            return
+        acks = self.server.acks
+        if ack_mode != 'durable':
+            res = acks.ack(values['subscriber_id'], values['partition'], values['offset'], ack_mode)
+            if res is not None:
+                self.server.streams.acked(values['subscriber_id'], [values['partition']], [values['offset']])
+                self._send_json(res)
+                return
+        async with self._connection() as conn:
+            res = await conn.fetchrow(HOT_STATEMENTS['q_ack_message'], values['subscriber_id'], values['offset'],
+                                      values['partition'])
+        res = dict(res) if res is not None else None
+        # the row tells the coalescer the subscriber's topic, partitions and ack mode for its next acks
+        acks.learn(res)
+        acks.settle(values['subscriber_id'], [values['partition']], [values['offset']])
+        if res is not None:
+            self.server.streams.acked(values['subscriber_id'], [values['partition']], [values['offset']])
+        self._send_json(res)
+
+    # topic_reset route: /topic_reset?topic=<topic>&offset=<offset>
+    async def do_topic_reset(self):
+        target_topic = self._param('topic')
+        if not target_topic:
+            self._unprocessable("Missing 'topic' parameter")
+            return
+        values, err_msg = self._int_params(offset=1)
+        if err_msg:
+            self._unprocessable('<br>'.join(err_msg))
+            return
+        offset = values['offset']
+        # coalesced acks made before the reset must not land after it
+        await self.server.flush_acks()
+        async with self._connection() as conn:
+            res = await conn.fetchval("""select topic_reset($1, $2);""", target_topic, offset - 1)
+        self.server.tail_cache.invalidate(target_topic)
+        self.server.acks.discard_topic(target_topic)
+        logging.info(f'Set {res} subscribers of topic {target_topic} to reprocess any messages starting at offset {offset}')
+        if self.command == 'GET':
+            self._send_json({'topic': target_topic, 'offset': offset, 'subscriber_count': res})
+        else:
+            self._set_response(headers={})
+
+
+def raise_open_file_limit():
+    # every connection is a file descriptor, so allow as many as the hard limit permits
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run(port: int=DEFAULT_PORT):
+    setup_logging()
+    raise_open_file_limit()
+    server = QAsyncServer()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.start(port=port))
+    logging.info('Starting asyncio httpd...\n')
+    try:
+        loop.run_until_complete(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    loop.run_until_complete(server.close())
+    logging.info('Stopping asyncio httpd...\n')
+    stop_logging()
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) == 2:
+        run(port=int(argv[1]))
+    else:
+        run()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+HTTP/1.1 client connections on asyncio streams for the asyncio publisher and subscriber clients.
+
+Like the requests.Session of queue_session.py, a QAsyncSession keeps connections to the queue
+server open between calls. A QAsyncConnection can be pipelined: requests are written as soon
+as they are sent, and a reader task hands the responses, which HTTP/1.1 returns in request
+order, to their requests. Both server engines handle the requests of one connection in order.
+
+Failures to connect are retried for every method. Once a request has been written, read errors
+and 502/503/504 responses are only retried for idempotent methods, so a POSTed message is never
+published twice. 429 and 503 responses with a Retry-After header are retried for every method,
+after the jittered Retry-After delay, like in queue_session.py. Pipelined requests (send()) are
+not retried at all.
+"""
+import asyncio
+import collections
+import json
+import time
+from urllib.parse import urlencode, urlparse
+
+from queue_session import DEFAULT_POOL_SIZE, DEFAULT_RETRIES, IDEMPOTENT_METHODS, RETRY_AFTER_STATUSES, jittered
+
+# seconds after which an idle connection is opened again before use, below the server's KEEPALIVE_TIMEOUT
+IDLE_TIMEOUT = 60.0
+
+RETRY_STATUSES = (502, 503, 504)
+
+
+class QHTTPError(Exception):
+    def __init__(self, status: int, body: bytes):
+        super().__init__(f'HTTP {status}: {body[:200].decode("utf-8", "replace")}')
+        self.status = status
+        self.body = body
+
+
+class QAsyncResponse:
+    def __init__(self, status: int, headers: dict, body: bytes):
+        self.status = status
+        # names are lower case
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise QHTTPError(self.status, self.body)
+
+
+class QAsyncConnection:
+    """
+    One pipelined HTTP/1.1 connection. send() writes a request and returns a future of its
+    response. If the connection breaks, every request still waiting for its response fails with
+    ConnectionError, and the next send() opens a new connection.
+    """
+    def __init__(self, host: str, port: int, idle_timeout: float=IDLE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self._reader = None
+        self._writer = None
+        self._waiting = collections.deque()     # response futures, in request order
+        self._reader_task = None
+        # created on first use, inside the event loop that runs the client
+        self._write_lock = None
+        self._last_used = 0.0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._waiting)
+
+    async def connect(self):
+        """
+        Open the connection if it is not open. Raises OSError.
+        """
+        if self._writer is not None and not self._waiting and time.monotonic() - self._last_used > self.idle_timeout:
+            # the server may be closing it right now
+            self.close()
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            self._reader_task = asyncio.ensure_future(self._read_responses(self._reader))
+
+    async def send(self, method: str, target: str, headers: dict=None, body: bytes=b'') -> asyncio.Future:
+        """
+        Write a request (connecting first if needed) and return a future of its QAsyncResponse.
+        Requests sent one after the other are written in that order. Raises OSError when the
+        connection cannot be opened, nothing has been sent then.
+        """
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            await self.connect()
+            lines = [f'{method} {target} HTTP/1.1', f'Host: {self.host}:{self.port}', f'Content-Length: {len(body)}']
+            lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+            response = asyncio.get_event_loop().create_future()
+            self._waiting.append(response)
+            self._last_used = time.monotonic()
+            writer = self._writer
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        try:
+            await writer.drain()
+        except OSError:
+            # the reader task fails the waiting responses when the connection breaks
+            pass
+        return response
+
+    async def _read_responses(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                response = await self._read_response(reader)
+                if response is None:
+                    break
+                self._last_used = time.monotonic()
+                waiter = self._waiting.popleft()
+                if not waiter.done():
+                    waiter.set_result(response)
+                connection = response.headers.get('connection', '').lower()
+                if connection == 'close':
+                    break
+            error = ConnectionError('The server closed the connection')
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+            error = ConnectionError(f'Connection to {self.host}:{self.port} failed: {e}')
+        except asyncio.CancelledError:
+            error = ConnectionError('The connection was closed')
+        if reader is self._reader:
+            self._drop()
+        while self._waiting:
+            waiter = self._waiting.popleft()
+            if not waiter.done():
+                waiter.set_exception(error)
+
+    async def _read_response(self, reader: asyncio.StreamReader) -> QAsyncResponse:
+        status_line = await reader.readline()
+        if not status_line:
+            return None
+        status = int(status_line.decode('latin-1').split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        else:
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return QAsyncResponse(status, headers, body)
+
+    def _drop(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        self._reader_task = None
+
+    def close(self):
+        task = self._reader_task
+        self._drop()
+        if task is not None:
+            task.cancel()
+
+
+class QAsyncSession:
+    """
+    Pool of up to pool_size connections to the server at base_url for request/response calls,
+    plus pipelined connections handed out by connection().
+    """
+    def __init__(self, base_url: str, pool_size: int=DEFAULT_POOL_SIZE, retries: int=DEFAULT_RETRIES,
+                 backoff_factor: float=0.2):
+        url = urlparse(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self._slots = None
+        self._idle = []
+        self._connections = []
+
+    def connection(self) -> QAsyncConnection:
+        """
+        A connection of its own, e.g. to pipeline requests on. Closed with the session.
+        """
+        conn = QAsyncConnection(self.host, self.port)
+        self._connections.append(conn)
+        return conn
+
+    async def request(self, method: str, path: str, params: dict=None, json_data=None, data: bytes=None,
+                      headers: dict=None) -> QAsyncResponse:
+        """
+        Send a request and wait for its response. params go in the query string, json_data or data
+        in the body.
+        """
+        method = method.upper()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pool_size)
+        for attempt in range(self.retries + 1):
+            async with self._slots:
+                conn = self._idle.pop() if self._idle else QAsyncConnection(self.host, self.port)
+                try:
+                    response = await (await self.send(method, path, params, json_data, data, headers, conn))
+                except asyncio.CancelledError:
+                    # the response would arrive on a connection nobody reads any more
+                    conn.close()
+                    raise
+                except (OSError, asyncio.TimeoutError):
+                    conn.close()
+                    if method not in IDEMPOTENT_METHODS or attempt == self.retries:
+                        raise
+                    await self._backoff(attempt)
+                    continue
+                self._idle.append(conn)
+            if attempt < self.retries:
+                delay = self._retry_after(response)
+                if delay is not None:
+                    await asyncio.sleep(delay)
+                    continue
+                if response.status in RETRY_STATUSES and method in IDEMPOTENT_METHODS:
+                    await self._backoff(attempt)
+                    continue
+            return response
+
+    async def send(self, method: str, path: str, params: dict=None, json_data=None, data: bytes=None,
+                   headers: dict=None, connection: QAsyncConnection=None) -> asyncio.Future:
+        """
+        Write a request on connection (pipelined behind the requests already sent on it) and return
+        a future of its response. Opening the connection is retried, the request itself is not.
+        """
+        headers = dict(headers or {})
+        target = path
+        if params:
+            target += '?' + urlencode({k: v for k, v in params.items() if v is not None}, doseq=True)
+        body = b''
+        if json_data is not None:
+            body = json.dumps(json_data).encode('utf-8')
+            headers['Content-type'] = 'application/json'
+        elif data is not None:
+            body = data
+        for attempt in range(self.retries + 1):
+            try:
+                return await connection.send(method, target, headers, body)
+            except OSError:
+                if attempt == self.retries:
+                    raise
+                await self._backoff(attempt)
+
+    def _retry_after(self, response: QAsyncResponse) -> float:
+        """
+        Seconds to wait before sending a rejected request again, None if it was not rejected.
+        """
+        if response.status not in RETRY_AFTER_STATUSES:
+            return None
+        try:
+            return jittered(float(response.headers['retry-after']))
+        except (KeyError, ValueError):
+            return None
+
+    async def _backoff(self, attempt: int):
+        await asyncio.sleep(jittered(self.backoff_factor * (2 ** attempt)))
+
+    async def close(self):
+        for conn in self._idle + self._connections:
+            conn.close()
+        self._idle = []
+        self._connections = []
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Asyncio subscriber client with prefetching and concurrent message handlers.
+
+consume(handler) runs `await handler(message)` for up to `concurrency` messages at a time.
+Messages are fetched batch_size at a time, and the next batch is fetched while the current one
+is handled. For that, plain subscribers read with /get_message after the offsets already
+delivered (after_partitions/after_offsets), which does not ack them. Consumer group members
+claim the next batch with /group_fetch, so prefetched messages are leased too. lease_ms must
+cover the handling of two batches then.
+
+Acks are committed in offset order. The offset acked for a partition is the highest one below
+which every delivered message has been handled, however the handlers finish. Plain subscribers
+ack it with /ack_message (durable or coalesced, like QSubscriber). Group members ack the
+handled messages with /group_ack. One ack request is in flight at a time, and acks that come
+in meanwhile are sent together with the next one.
+
+A handler that raises stops consume(). The error is raised once the running handlers are done.
+The failed message and everything after it in its partition are not acked, so they are
+delivered again.
+
+Usage::
+    async def handle(message):
+        await do_something(message['message'])
+
+    subscriber = QAsyncSubscriber('orders', concurrency=16)
+    await subscriber.consume(handle)
+"""
+import asyncio
+import collections
+import logging
+import os
+import sys
+
+from queue_async_session import QAsyncSession
+from queue_session import DEFAULT_POOL_SIZE, DEFAULT_RETRIES
+from queue_wire import ACCEPT_FRAMES, decode_rows, frames_version
+
+PUBLISHER_URL = os.environ.get('PUBLISHER_URL', 'http://queues-server:8888')
+
+DEFAULT_CONCURRENCY = 8
+
+
+class ContentTypeError(Exception):
+    pass
+
+
+class UnsubscribedError(Exception):
+    pass
+
+
+class QAsyncSubscriber:
+    def __init__(self, topic: str, sleep_time: int=1, exit_after: int=10, wait_ms: int=1000, batch_size: int=20,
+                 concurrency: int=DEFAULT_CONCURRENCY, group: str=None, lease_ms: int=None,
+                 pool_size: int=DEFAULT_POOL_SIZE, retries: int=DEFAULT_RETRIES, partitions: list=None,
+                 ack_mode: str=None, frames: bool=True, url: str=PUBLISHER_URL):
+        self._session = QAsyncSession(url, pool_size, retries)
+        self.topic = topic
+        self.sleep_time = sleep_time
+        self.exit_after = exit_after
+        # long-poll wait of a fetch, sleep_time is only used between polls when this is 0
+        self.wait_ms = wait_ms
+        self.batch_size = batch_size
+        # handlers running at once
+        self.concurrency = max(1, concurrency)
+        self.group = group
+        self.lease_ms = lease_ms
+        self.partitions = list(partitions) if partitions else None
+        self.ack_mode = ack_mode
+        self.frames = frames
+        self.subscriber_id = None
+        self.processed = set()
+        self._log = logging.getLogger(__file__)
+        self._reset_tracking()
+
+    def _reset_tracking(self):
+        self._cursor = {}           # partition -> highest offset delivered
+        self._delivered = {}        # partition -> deque of offsets delivered and not handled in order yet
+        self._handled = {}          # partition -> set of offsets handled out of order
+        self._ackable = {}          # partition -> offsets handled in order, not acked yet
+        self._ack_task = None
+        self._error = None
+
+    async def _request(self, path: str, params: dict, method: str='get', fetch: bool=False):
+        headers = {'Accept': ACCEPT_FRAMES} if fetch and self.frames else None
+        res = await self._session.request(method, path, json_data=params if method == 'post' else None,
+                                          params=params if method != 'post' else None, headers=headers)
+        res.raise_for_status()
+        if res.body:
+            content_type = res.headers.get('content-type')
+            if content_type == 'application/json':
+                return res.json()
+            elif frames_version(content_type):
+                return decode_rows(res.body, self.topic, frames_version(content_type))
+            raise ContentTypeError(f'Expected "application/json" but got {content_type}')
+
+    async def close(self):
+        await self._session.close()
+
+    async def subscribe(self):
+        params = {'topic': self.topic}
+        if self.group:
+            params['group'] = self.group
+        if self.partitions:
+            params['partitions'] = self.partitions
+        if self.ack_mode:
+            params['ack_mode'] = self.ack_mode
+        data = await self._request('/subscribe', params)
+        if data:
+            self.subscriber_id = data['subscriber_id']
+            self._reset_tracking()
+
+    async def unsubscribe(self):
+        await self._request('/unsubscribe', {'subscriber_id': self.subscriber_id}, 'post')
+        self.subscriber_id = None
+
+    async def ack_message(self, _offset: int, partition: int=0, ack_mode: str=None):
+        params = {'subscriber_id': self.subscriber_id, 'offset': _offset, 'partition': partition}
+        if ack_mode:
+            params['ack_mode'] = ack_mode
+        await self._request('/ack_message', params, 'post')
+
+    async def group_ack(self, offsets: list):
+        """
+        Ack offsets, a list of (partition, offset) pairs
+        """
+        params = {'subscriber_id': self.subscriber_id, 'partitions': [p for p, _ in offsets], 'offsets': [o for _, o in offsets]}
+        await self._request('/group_ack', params, 'post')
+
+    async def fetch(self) -> list:
+        """
+        The next batch_size messages after those already delivered, without acking anything.
+        Group members claim them.
+        """
+        if not self.subscriber_id:
+            raise UnsubscribedError(f"Not subscribed to topic {self.topic}")
+        params = {'subscriber_id': self.subscriber_id, 'num_messages': self.batch_size}
+        if self.wait_ms:
+            params['wait_ms'] = self.wait_ms
+        if self.group:
+            params.update(partitions=[], offsets=[])
+            if self.lease_ms:
+                params['lease_ms'] = self.lease_ms
+            batch = await self._request('/group_fetch', params, 'post', fetch=True)
+        else:
+            params.update(after_partitions=list(self._cursor), after_offsets=list(self._cursor.values()))
+            batch = await self._request('/get_message', params, fetch=True)
+        # a single message comes back on its own in JSON
+        if isinstance(batch, dict):
+            batch = [batch]
+        batch = batch or []
+        for data in batch:
+            partition = data.get('_partition', 0)
+            if data['_offset'] > self._cursor.get(partition, -1):
+                self._cursor[partition] = data['_offset']
+            self._delivered.setdefault(partition, collections.deque()).append(data['_offset'])
+        return batch
+
+    async def process_message(self, message_data: dict):
+        partition = message_data.get('_partition', 0)
+        if (partition, message_data['_offset']) not in self.processed:
+            self.processed.add((partition, message_data['_offset']))
+            label = 'Processed'
+        else:
+            label = 'Re-Processed'
+        self._log.info(f'{label} {partition: 3d}:{message_data["_offset"]: 5d} : "{message_data["message"]}"{os.linesep}')
+
+    async def _run_handler(self, handler, message_data: dict, slots: asyncio.Semaphore):
+        try:
+            await handler(message_data)
+        except Exception as e:
+            if self._error is None:
+                self._log.error(f'Handler failed on {message_data.get("_partition", 0)}:{message_data["_offset"]}: {e}')
+                self._error = e
+            return
+        finally:
+            slots.release()
+        self._message_handled(message_data.get('_partition', 0), message_data['_offset'])
+
+    def _message_handled(self, partition: int, offset: int):
+        delivered = self._delivered[partition]
+        handled = self._handled.setdefault(partition, set())
+        handled.add(offset)
+        # the watermark only moves over a contiguous run of handled offsets
+        while delivered and delivered[0] in handled:
+            handled.discard(delivered[0])
+            self._ackable.setdefault(partition, []).append(delivered.popleft())
+        if self._ackable and (self._ack_task is None or self._ack_task.done()):
+            self._ack_task = asyncio.ensure_future(self._send_acks())
+
+    async def _send_acks(self):
+        while self._ackable:
+            ackable, self._ackable = self._ackable, {}
+            try:
+                if self.group:
+                    await self.group_ack([(p, o) for p, offsets in sorted(ackable.items()) for o in offsets])
+                else:
+                    for partition, offsets in sorted(ackable.items()):
+                        await self.ack_message(offsets[-1], partition)
+            except Exception as e:
+                self._log.error(f'Ack failed: {e}')
+                if self._error is None:
+                    self._error = e
+                return
+
+    async def consume(self, handler=None):
+        """
+        Handle messages with `await handler(message)` (process_message by default) until exit_after
+        fetches in a row came back empty, then ack what was handled, unsubscribe and close.
+        """
+        handler = handler or self.process_message
+        if not self.subscriber_id:
+            await self.subscribe()
+        slots = asyncio.Semaphore(self.concurrency)
+        handlers = set()
+        tries = 0
+        next_batch = asyncio.ensure_future(self.fetch())
+        try:
+            while tries < self.exit_after and self._error is None:
+                batch = await next_batch
+                if batch:
+                    tries = 0
+                    # fetched while this batch is handled
+                    next_batch = asyncio.ensure_future(self.fetch())
+                    for data in batch:
+                        await slots.acquire()
+                        if self._error is not None:
+                            slots.release()
+                            break
+                        task = asyncio.ensure_future(self._run_handler(handler, data, slots))
+                        handlers.add(task)
+                        task.add_done_callback(handlers.discard)
+                else:
+                    tries += 1
+                    if not self.wait_ms:
+                        await asyncio.sleep(self.sleep_time)
+                    next_batch = asyncio.ensure_future(self.fetch())
+        finally:
+            next_batch.cancel()
+            try:
+                if handlers:
+                    await asyncio.wait(handlers)
+                if self._ack_task is not None:
+                    await self._ack_task
+                # acks that came in while the last ack request was sent
+                if self._ackable and self._error is None:
+                    await self._send_acks()
+                await self.unsubscribe()
+            finally:
+                await self.close()
+        if self._error is not None:
+            raise self._error
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        print(f"""
+Usage: {os.path.basename(sys.argv[0])} <topic-name> <sleep-time-in-seconds> <exit-after-tries> [<wait-ms> [<batch-size> [<concurrency> [<group>]]]]
+""", file=sys.stderr)
+        sys.exit(1)
+    else:
+        topic = sys.argv[1]
+        sleep_time = int((sys.argv[2:3] or [1])[0])
+        exit_after = int((sys.argv[3:4] or [10])[0])
+        wait_ms = int((sys.argv[4:5] or [1000])[0])
+        batch_size = int((sys.argv[5:6] or [20])[0])
+        concurrency = int((sys.argv[6:7] or [DEFAULT_CONCURRENCY])[0])
+        group = (sys.argv[7:8] or [None])[0] or None
+        logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+        subscriber = QAsyncSubscriber(topic, sleep_time, exit_after, wait_ms, batch_size, concurrency, group)
+        asyncio.get_event_loop().run_until_complete(subscriber.consume())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+In-memory cache of the newest messages of each topic partition, shared by the threaded and
+asyncio server engines.
+
+Caught up subscribers mostly ask /get_message for the one or two messages published since
+their last ack. The cache keeps the tail of recently read or written partitions as a contiguous
+run of messages, filled by the server's own publishes and by database reads on a miss, so such
+reads are answered from memory after a primary key lookup of the subscriber's offsets instead
+of the topic_message join. Lagging subscribers and consumer groups still read the database.
+
+The cache only answers when it returns exactly what get_message() would: for every partition it
+either holds num_messages messages after the subscriber's offset, or its run reaches the head
+of the partition. Heads are tracked from the publish notifications of every server process.
+topic_delete(), topic_reset() and retention drop the cached topic, and the cache is emptied
+whenever the notification listener reconnects and bypassed while it is disconnected, since
+notifications may have been missed in between.
+
+Memory is bounded by max_bytes (message payloads plus an estimate of the per row overhead)
+across all topics, evicting the least recently used partitions first, and by max_messages per
+partition.
+"""
+from collections import OrderedDict, deque
+import os
+import threading
+
+TAIL_CACHE_BYTES = int(os.environ.get('TAIL_CACHE_BYTES', 64 * 1024 * 1024))
+TAIL_CACHE_MESSAGES = int(os.environ.get('TAIL_CACHE_MESSAGES', 1000))
+
+# rough size of a cached row besides its payload (the dict, its keys, the timestamp and ints)
+ROW_OVERHEAD = 400
+TAIL_OVERHEAD = 200
+
+
+class _Tail:
+    __slots__ = ('low', 'rows', 'head', 'size')
+
+    def __init__(self, low: int, head: int=None):
+        self.low = low          # offset of rows[0]
+        self.rows = deque()     # contiguous messages from low
+        self.head = head        # newest offset of the partition, None when not known
+        self.size = TAIL_OVERHEAD
+
+    @property
+    def high(self) -> int:
+        return self.low + len(self.rows) - 1
+
+
+class QTailCache:
+    def __init__(self, max_bytes: int=TAIL_CACHE_BYTES, max_messages: int=TAIL_CACHE_MESSAGES):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._tails = OrderedDict()     # (topic, partition) -> _Tail, least recently used first
+        self._bytes = 0
+        self._epoch = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.max_messages > 0
+
+    def read(self, epoch, topic: str, partitions: list, offsets: list, num_messages: int) -> list:
+        """
+        The next num_messages messages of the subscribed partitions after the subscriber's offsets
+        (offsets[p] for partition p), merged on offset like get_message(), or None on a miss.
+        epoch identifies the current notification listener connection, None while disconnected.
+        """
+        with self._lock:
+            if not self._sync(epoch):
+                return None
+            found = []
+            for partition in partitions:
+                tail = self._tails.get((topic, partition))
+                offset = offsets[partition]
+                if tail is None or offset + 1 < tail.low:
+                    self.misses += 1
+                    return None
+                start = offset + 1 - tail.low
+                available = max(0, len(tail.rows) - start)
+                if available < num_messages and (tail.head is None or max(tail.high, offset) < tail.head):
+                    # fewer messages than asked for are only exact when the rest of the partition is known to be empty
+                    self.misses += 1
+                    return None
+                for i in range(start, start + min(available, num_messages)):
+                    found.append(tail.rows[i])
+                self._tails.move_to_end((topic, partition))
+            self.hits += 1
+            found.sort(key=lambda row: (row['_offset'], row['_partition']))
+            return found[:num_messages]
+
+    def fill(self, epoch, topic: str, partitions: list, offsets: list, num_messages: int, rows: list):
+        """
+        Store the rows get_message() returned for a subscriber with the given offsets. When fewer
+        than num_messages came back every subscribed partition was read up to its head.
+        """
+        with self._lock:
+            if not self._sync(epoch):
+                return
+            exhausted = len(rows) < num_messages
+            by_partition = {partition: [] for partition in partitions}
+            for row in rows:
+                by_partition.setdefault(row['_partition'], []).append(row)
+            for partition, partition_rows in by_partition.items():
+                offset = offsets[partition]
+                tail = self._tail(topic, partition, offset + 1)
+                if partition_rows and offset + 1 > tail.high + 1:
+                    # not contiguous with what is cached, start over from this read
+                    self._reset(tail, offset + 1)
+                elif not partition_rows and not tail.rows:
+                    tail.low = offset + 1
+                for row in partition_rows:
+                    self._append(tail, row)
+                if exhausted:
+                    last = partition_rows[-1]['_offset'] if partition_rows else offset
+                    tail.head = max(tail.head or 0, last)
+                self._tails.move_to_end((topic, partition))
+            self._evict()
+
+    def publish(self, epoch, row: dict):
+        """
+        Add a message this process just published (after its commit).
+        """
+        with self._lock:
+            if not self._sync(epoch):
+                return
+            key = (row['topic'], row['_partition'])
+            tail = self._tails.get(key)
+            if tail is None:
+                # the head stays unknown, a later publish from another process may have been notified before this tail existed
+                tail = self._tail(row['topic'], row['_partition'], row['_offset'])
+            elif tail.rows and row['_offset'] > tail.high + 1:
+                self._reset(tail, row['_offset'])
+            elif tail.rows and row['_offset'] <= tail.high:
+                return
+            self._append(tail, row)
+            if tail.head is not None:
+                tail.head = max(tail.head, row['_offset'])
+            self._evict()
+
+    def advance(self, topic: str, partition: int, offset: int):
+        """
+        A publish notification: offset is now the head of the partition.
+        """
+        with self._lock:
+            key = (topic, partition)
+            tail = self._tails.get(key)
+            if tail is None:
+                # remember the head, so a later fill or publish cannot take an older offset for it
+                self._tails[key] = tail = _Tail(offset + 1, offset)
+                self._tails.move_to_end(key, last=False)
+                self._bytes += tail.size
+                self._evict()
+            else:
+                tail.head = max(tail.head or 0, offset)
+
+    def invalidate(self, topic: str):
+        with self._lock:
+            for key in [key for key in self._tails if key[0] == topic]:
+                self._bytes -= self._tails.pop(key).size
+
+    def clear(self):
+        with self._lock:
+            self._tails.clear()
+            self._bytes = 0
+
+    def metrics(self) -> list:
+        """
+        Collector for QMetrics.register_collector().
+        """
+        with self._lock:
+            return [
+                ('queue_tail_cache_hits_total', 'counter', 'Message reads answered from the tail cache.', [({}, self.hits)]),
+                ('queue_tail_cache_misses_total', 'counter', 'Message reads the tail cache could not answer.',
+                 [({}, self.misses)]),
+                ('queue_tail_cache_evictions_total', 'counter', 'Topic partitions evicted from the tail cache.',
+                 [({}, self.evictions)]),
+                ('queue_tail_cache_bytes', 'gauge', 'Estimated size of the tail cache.', [({}, self._bytes)]),
+                ('queue_tail_cache_partitions', 'gauge', 'Topic partitions held in the tail cache.',
+                 [({}, len(self._tails))]),
+            ]
+
+    # called with self._lock held
+
+    def _sync(self, epoch) -> bool:
+        if epoch != self._epoch:
+            self._tails.clear()
+            self._bytes = 0
+            self._epoch = epoch
+        return epoch is not None and self.enabled
+
+    def _tail(self, topic: str, partition: int, low: int) -> _Tail:
+        tail = self._tails.get((topic, partition))
+        if tail is None:
+            tail = self._tails[(topic, partition)] = _Tail(low)
+            self._bytes += tail.size
+        return tail
+
+    def _reset(self, tail: _Tail, low: int):
+        self._bytes -= tail.size - TAIL_OVERHEAD
+        tail.size = TAIL_OVERHEAD
+        tail.rows.clear()
+        tail.low = low
+
+    def _append(self, tail: _Tail, row: dict):
+        if not tail.rows:
+            tail.low = row['_offset']
+        elif row['_offset'] != tail.high + 1:
+            return
+        size = len(row.get('message') or row.get('payload') or '') + ROW_OVERHEAD
+        tail.rows.append(row)
+        tail.size += size
+        self._bytes += size
+        while len(tail.rows) > self.max_messages:
+            old = tail.rows.popleft()
+            tail.low += 1
+            size = len(old.get('message') or old.get('payload') or '') + ROW_OVERHEAD
+            tail.size -= size
+            self._bytes -= size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._tails:
+            _, tail = self._tails.popitem(last=False)
+            self._bytes -= tail.size
+            self.evictions += 1
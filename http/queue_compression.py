@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+gzip/deflate compression of HTTP bodies and stored message payloads, shared by the server
+engines and the clients.
+
+HTTP: a request body may be sent with Content-Encoding gzip or deflate, which every response
+announces in an Accept-Encoding header. A JSON or framed response of at least
+COMPRESS_MIN_BYTES bytes (default 1024) is compressed with the first coding the request's
+Accept-Encoding allows. Smaller bodies are sent as they are, their compression would cost more
+than it saves.
+
+Storage: a topic created with compression=gzip|deflate stores every message of at least
+COMPRESS_MIN_BYTES UTF-8 bytes compressed, when that makes it smaller. The row then has the
+compressed bytes in payload, the codec in encoding and a null message. plain_rows() turns such
+rows back into text rows for JSON responses. Framed responses of version 2 (see queue_wire.py)
+carry the stored bytes as they are, for the client to decompress.
+
+"deflate" is the zlib format, as HTTP defines it.
+"""
+import os
+import zlib
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+# a compressed request body may not expand to more than this, so a small body cannot exhaust memory
+DECOMPRESS_MAX_BYTES = int(os.environ.get('DECOMPRESS_MAX_BYTES', 16 * 1024 * 1024))
+
+ENCODINGS = ('gzip', 'deflate')
+# announced to clients in the Accept-Encoding response header
+ACCEPT_ENCODING = ', '.join(ENCODINGS)
+
+_WBITS = {'gzip': 31, 'deflate': 15}
+
+# the fields of a message row in responses, a stored payload is turned back into message
+ROW_FIELDS = ('id', 'topic', '_partition', '_offset', 'message', 'publish_ts')
+
+
+def compressor(encoding: str):
+    """
+    A zlib compress object writing encoding.
+    """
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, _WBITS[encoding])
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    comp = compressor(encoding)
+    return comp.compress(data) + comp.flush()
+
+
+def decompress(data: bytes, encoding: str, max_bytes: int=DECOMPRESS_MAX_BYTES) -> bytes:
+    """
+    Raises ValueError for an unknown coding, corrupt data or more than max_bytes of output.
+    """
+    if encoding not in _WBITS:
+        raise ValueError(f'Unsupported content coding {encoding}')
+    try:
+        decomp = zlib.decompressobj(_WBITS[encoding])
+        data = decomp.decompress(data, max_bytes)
+        if decomp.unconsumed_tail:
+            raise ValueError(f'Decompressed body exceeds {max_bytes} bytes')
+        return data + decomp.flush()
+    except zlib.error as e:
+        raise ValueError(f'Corrupt {encoding} data: {e}')
+
+
+def accepted_encodings(accept_encoding: str) -> list:
+    """
+    The codings of ENCODINGS an Accept-Encoding header allows, most preferred first.
+    """
+    if not accept_encoding:
+        return []
+    weights = {}
+    wildcard = None
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        name, _, value = params.partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                q = float(value)
+            except ValueError:
+                q = 0.0
+        if coding == '*':
+            wildcard = q
+        elif coding in ENCODINGS:
+            weights[coding] = q
+    if wildcard is not None:
+        for coding in ENCODINGS:
+            weights.setdefault(coding, wildcard)
+    # sorted is stable, so equally weighted codings keep the order of ENCODINGS
+    return sorted((c for c in ENCODINGS if weights.get(c, 0) > 0), key=lambda c: -weights[c])
+
+
+def response_encoding(accept_encoding: str, size: int) -> str:
+    """
+    The coding to compress a response body of size bytes with, None to send it as it is.
+    """
+    if size < COMPRESS_MIN_BYTES:
+        return None
+    codings = accepted_encodings(accept_encoding)
+    return codings[0] if codings else None
+
+
+def encode_payload(message: str, encoding: str) -> bytes:
+    """
+    message compressed for storage, None when it is too small or does not get smaller.
+    """
+    data = message.encode('utf-8')
+    if not encoding or len(data) < COMPRESS_MIN_BYTES:
+        return None
+    payload = compress(data, encoding)
+    return payload if len(payload) < len(data) else None
+
+
+def row_message(row) -> str:
+    """
+    The text of a message row, decompressed when it was stored compressed.
+    """
+    encoding = row.get('encoding')
+    if encoding:
+        return zlib.decompress(row['payload'], _WBITS[encoding]).decode('utf-8')
+    return row['message']
+
+
+def plain_rows(rows: list) -> list:
+    """
+    Message rows with their text in message and without the storage columns, for JSON.
+    """
+    return [{name: row_message(row) if name == 'message' else row[name] for name in ROW_FIELDS if name in row}
+            for row in rows]
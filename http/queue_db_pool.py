@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Thread-safe PostgreSQL connection pool shared by all of the queue server request threads.
+
+Connections are created lazily up to max_size, kept warm down to min_size, checked for
+breakage when they are handed out or returned, and recycled once they get too old.
+
+Statements passed as prepared={name: sql} (sql with $1, $2, ... parameters) are prepared on a
+connection the first time execute_prepared() runs them there, and executed by name after that,
+so PostgreSQL parses and plans them once per connection instead of once per call.
+"""
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class PoolClosedError(Exception):
+    pass
+
+
+class QConnectionPool:
+    def __init__(self, dsn: str, min_size: int=1, max_size: int=10, acquire_timeout: float=5.0,
+                 check_idle_after: float=30.0, max_lifetime: float=3600.0, prepared: dict=None, **connect_kwargs):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f'Invalid pool sizes min_size={min_size}, max_size={max_size}')
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.check_idle_after = check_idle_after
+        self.max_lifetime = max_lifetime
+        self.prepared = dict(prepared or {})
+        self._connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []           # [(conn, created_ts, released_ts), ...] used as a LIFO stack
+        self._created = {}        # id(conn) -> created_ts for every live connection
+        self._prepared_on = {}    # id(conn) -> names of the statements prepared on it
+        self._size = 0            # live connections plus connections being opened
+        self._waiters = 0
+        self._closed = False
+
+        self._stat_acquires = 0
+        self._stat_timeouts = 0
+        self._stat_wait_total = 0.0
+        self._stat_wait_max = 0.0
+        self._stat_opened = 0
+        self._stat_discarded = 0
+        self._stat_prepared = 0
+
+        self._log = logging.getLogger(__name__)
+        for _ in range(self.min_size):
+            with self._cond:
+                self._size += 1
+            self._open_into_idle()
+
+    def _open(self):
+        # psycopg2 is imported where the pool uses it, so servers without a database run without it
+        import psycopg2
+        conn = psycopg2.connect(self.dsn, **self._connect_kwargs)
+        with self._cond:
+            self._created[id(conn)] = time.monotonic()
+            self._prepared_on[id(conn)] = set()
+            self._stat_opened += 1
+        return conn
+
+    def _open_into_idle(self):
+        # the caller has already reserved the slot in self._size
+        try:
+            conn = self._open()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._idle.append((conn, self._created[id(conn)], time.monotonic()))
+            self._cond.notify()
+
+    def _close_conn(self, conn):
+        # called with self._cond held or for a connection no other thread can see
+        self._created.pop(id(conn), None)
+        self._prepared_on.pop(id(conn), None)
+        self._size -= 1
+        self._stat_discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_broken(conn) -> bool:
+        import psycopg2.extensions
+        if conn.closed:
+            return True
+        return conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+
+    def _is_alive(self, conn) -> bool:
+        import psycopg2
+        try:
+            with conn.cursor() as cur:
+                cur.execute('select 1;')
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def acquire(self, timeout: float=None):
+        """
+        Get a connection from the pool, opening a new one if the pool is not yet at max_size.
+        Raises PoolTimeoutError if no connection becomes available within the timeout.
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        while True:
+            reserved = False
+            candidate = None
+            with self._cond:
+                if self._closed:
+                    raise PoolClosedError('Connection pool is closed')
+                if not self._idle and self._size >= self.max_size:
+                    self._waiters += 1
+                    try:
+                        while not self._idle and self._size >= self.max_size and not self._closed:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                self._stat_timeouts += 1
+                                raise PoolTimeoutError(f'Timed out after {timeout:.3f}s waiting for a database connection')
+                            self._cond.wait(remaining)
+                    finally:
+                        self._waiters -= 1
+                    if self._closed:
+                        raise PoolClosedError('Connection pool is closed')
+                if self._idle:
+                    candidate = self._idle.pop()
+                else:
+                    self._size += 1
+                    reserved = True
+
+            if reserved:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            else:
+                conn, created_ts, released_ts = candidate
+                now = time.monotonic()
+                stale = now - created_ts > self.max_lifetime
+                if stale or self._is_broken(conn) or (now - released_ts > self.check_idle_after and not self._is_alive(conn)):
+                    with self._cond:
+                        self._close_conn(conn)
+                    continue
+
+            waited = time.monotonic() - start
+            with self._cond:
+                self._stat_acquires += 1
+                self._stat_wait_total += waited
+                self._stat_wait_max = max(self._stat_wait_max, waited)
+            return conn
+
+    def release(self, conn, discard: bool=False):
+        """
+        Return a connection to the pool. Broken, too old or explicitly discarded connections are closed.
+        """
+        import psycopg2.extensions
+        if not discard and not self._is_broken(conn):
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    discard = True
+        else:
+            discard = True
+
+        refill = False
+        with self._cond:
+            created_ts = self._created.get(id(conn), 0.0)
+            if discard or self._closed or time.monotonic() - created_ts > self.max_lifetime:
+                self._close_conn(conn)
+                if not self._closed and self._size < self.min_size:
+                    self._size += 1
+                    refill = True
+            else:
+                self._idle.append((conn, created_ts, time.monotonic()))
+            self._cond.notify()
+
+        if refill:
+            try:
+                self._open_into_idle()
+            except Exception as e:
+                self._log.warning(f'Could not replace a discarded pool connection: {e}')
+
+    @contextmanager
+    def connection(self, timeout: float=None):
+        """
+        Context manager that commits on success, rolls back on error and hands the connection back.
+        Connections that failed at the network level are discarded instead of being reused.
+        """
+        import psycopg2
+        conn = self.acquire(timeout)
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        except BaseException:
+            if not self._is_broken(conn):
+                conn.rollback()
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def stats(self) -> dict:
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': idle,
+                'in_use': self._size - idle,
+                'waiters': self._waiters,
+                'acquires': self._stat_acquires,
+                'timeouts': self._stat_timeouts,
+                'wait_seconds_total': self._stat_wait_total,
+                'wait_seconds_max': self._stat_wait_max,
+                'wait_seconds_avg': self._stat_wait_total / self._stat_acquires if self._stat_acquires else 0.0,
+                'connections_opened': self._stat_opened,
+                'connections_discarded': self._stat_discarded,
+                'statements_prepared': self._stat_prepared,
+            }
+
+    def execute_prepared(self, cur, name: str, args: tuple=()):
+        """
+        Run the prepared statement name with args on the cursor's connection, preparing it there
+        first if needed. Prepared statements are not transactional, they outlive a rollback.
+        """
+        # only the thread holding the connection touches its set
+        done = self._prepared_on[id(cur.connection)]
+        if name not in done:
+            cur.execute(f'prepare {name} as {self.prepared[name]}')
+            done.add(name)
+            with self._cond:
+                self._stat_prepared += 1
+        placeholders = ', '.join(['%s'] * len(args))
+        cur.execute(f'execute {name}({placeholders})' if args else f'execute {name}', args)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _, _ = self._idle.pop()
+                self._close_conn(conn)
+            self._cond.notify_all()
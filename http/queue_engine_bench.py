@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Side-by-side benchmark of the threaded and asyncio server engines.
+
+For each server URL the benchmark opens a number of idle long-polling subscriber connections
+(parked on /get_message with wait_ms on a topic nobody publishes to), then drives /publish
+requests from a set of concurrent workers for a fixed duration and reports throughput,
+latency percentiles, errors and how many idle connections the server actually held.
+
+Start one server per engine, e.g.::
+    ./queue_server.py --engine threaded 8888
+    ./queue_server.py --engine asyncio 8889
+    ./queue_engine_bench.py --url threaded=http://localhost:8888 --url asyncio=http://localhost:8889 --idle 10000
+"""
+import argparse
+import asyncio
+import json
+import resource
+import statistics
+import time
+from urllib.parse import urlencode, urlparse
+
+
+class RawHTTPConnection:
+    """
+    Minimal HTTP/1.1 client connection on asyncio streams, so that holding tens of thousands of
+    connections does not depend on a client library's pool limits. Reconnects when the server
+    closes the connection after a response.
+    """
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method: str, path: str, params: dict=None) -> tuple:
+        await self.connect()
+        body = b''
+        headers = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}']
+        if params and method == 'GET':
+            headers[0] = f'{method} {path}?{urlencode(params)} HTTP/1.1'
+        elif params:
+            body = json.dumps(params).encode('utf-8')
+            headers.append('Content-type: application/json')
+        headers.append(f'Content-Length: {len(body)}')
+        self.writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('Server closed the connection')
+        version, status = status_line.decode('latin-1').split()[:2]
+        resp_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            resp_headers[name.strip().lower()] = value.strip()
+        if 'content-length' in resp_headers:
+            resp_body = await self.reader.readexactly(int(resp_headers['content-length']))
+        else:
+            resp_body = await self.reader.read()
+
+        connection = resp_headers.get('connection', '').lower()
+        if connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive') or 'content-length' not in resp_headers:
+            self.close()
+        return int(status), resp_body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+async def idle_subscriber(host: str, port: int, subscriber_id: int, wait_ms: int, stop: asyncio.Event, state: dict):
+    conn = RawHTTPConnection(host, port)
+    try:
+        while not stop.is_set():
+            try:
+                await conn.connect()
+                state['held'] += 1
+                try:
+                    await conn.request('GET', '/get_message', {'subscriber_id': subscriber_id, 'wait_ms': wait_ms})
+                finally:
+                    state['held'] -= 1
+            except (OSError, ConnectionError, asyncio.IncompleteReadError):
+                state['errors'] += 1
+                conn.close()
+                await asyncio.sleep(0.5)
+    finally:
+        conn.close()
+
+
+async def publisher(host: str, port: int, topic: str, message: str, stop: asyncio.Event, latencies: list, state: dict):
+    conn = RawHTTPConnection(host, port)
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                status, _ = await conn.request('POST', '/publish', {'topic': topic, 'message': message})
+            except (OSError, ConnectionError, asyncio.IncompleteReadError):
+                state['errors'] += 1
+                conn.close()
+                continue
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                state['errors'] += 1
+    finally:
+        conn.close()
+
+
+async def bench_engine(name: str, url: str, args) -> dict:
+    parsed = urlparse(url)
+    host, port = parsed.hostname, parsed.port or 80
+    setup = RawHTTPConnection(host, port)
+    stamp = int(time.time() * 1000)
+    pub_topic = f'engine-bench-{name}-{stamp}'
+    idle_topic = f'engine-bench-idle-{name}-{stamp}'
+    for topic in (pub_topic, idle_topic):
+        await setup.request('GET', '/topic', {'topic': topic, 'description': 'engine benchmark'})
+    subscriber_ids = []
+    for _ in range(max(1, args.idle_subscribers)):
+        status, body = await setup.request('GET', '/subscribe', {'topic': idle_topic})
+        subscriber_ids.append(json.loads(body)['subscriber_id'])
+
+    stop = asyncio.Event()
+    state = {'held': 0, 'errors': 0}
+    idle_state = {'held': 0, 'errors': 0}
+    latencies = []
+    idle_tasks = [asyncio.ensure_future(idle_subscriber(host, port, subscriber_ids[i % len(subscriber_ids)], args.wait_ms, stop, idle_state))
+                  for i in range(args.idle)]
+    # let the idle connections get established before measuring
+    ramp_deadline = time.monotonic() + args.ramp
+    while idle_state['held'] < args.idle and time.monotonic() < ramp_deadline:
+        await asyncio.sleep(0.1)
+
+    message = 'x' * args.message_size
+    started = time.monotonic()
+    pub_tasks = [asyncio.ensure_future(publisher(host, port, pub_topic, message, stop, latencies, state))
+                 for _ in range(args.workers)]
+    await asyncio.sleep(args.duration)
+    held = idle_state['held']
+    stop.set()
+    elapsed = time.monotonic() - started
+    for task in pub_tasks + idle_tasks:
+        task.cancel()
+    await asyncio.gather(*pub_tasks, *idle_tasks, return_exceptions=True)
+
+    status, body = await setup.request('GET', '/pool_stats')
+    pool_stats = json.loads(body) if status == 200 else {}
+    for topic in (pub_topic, idle_topic):
+        await setup.request('GET', '/topic_delete', {'topic': topic})
+    setup.close()
+
+    return {'engine': name,
+            'url': url,
+            'idle_requested': args.idle,
+            'idle_held': held,
+            'idle_errors': idle_state['errors'],
+            'workers': args.workers,
+            'seconds': round(elapsed, 3),
+            'requests': len(latencies),
+            'errors': state['errors'],
+            'requests_per_second': round(len(latencies) / elapsed, 1),
+            'latency_ms_p50': round(percentile(latencies, 50) * 1000, 3),
+            'latency_ms_p95': round(percentile(latencies, 95) * 1000, 3),
+            'latency_ms_p99': round(percentile(latencies, 99) * 1000, 3),
+            'latency_ms_mean': round(statistics.mean(latencies) * 1000, 3) if latencies else 0.0,
+            'pool_stats': pool_stats}
+
+
+def print_table(results: list):
+    columns = ['engine', 'idle_held', 'idle_errors', 'requests_per_second', 'errors',
+               'latency_ms_p50', 'latency_ms_p95', 'latency_ms_p99']
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in columns]
+    print('  '.join(c.rjust(w) for c, w in zip(columns, widths)))
+    for r in results:
+        print('  '.join(str(r[c]).rjust(w) for c, w in zip(columns, widths)))
+
+
+async def main(args):
+    results = []
+    for spec in args.url:
+        name, _, url = spec.partition('=')
+        if not url:
+            name, url = urlparse(spec).netloc, spec
+        results.append(await bench_engine(name, url, args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare queue server engines under idle long-poll load')
+    parser.add_argument('--url', action='append', required=True, help='[name=]url of a server to benchmark, repeatable')
+    parser.add_argument('--idle', type=int, default=1000, help='Idle long-polling connections to hold open')
+    parser.add_argument('--idle-subscribers', type=int, default=10, help='Subscribers shared by the idle connections')
+    parser.add_argument('--wait-ms', type=int, default=30000, help='wait_ms used by the idle connections')
+    parser.add_argument('--workers', type=int, default=16, help='Concurrent publishing connections')
+    parser.add_argument('--duration', type=float, default=15.0, help='Seconds of publishing per engine')
+    parser.add_argument('--ramp', type=float, default=30.0, help='Longest wait for idle connections to be established')
+    parser.add_argument('--message-size', type=int, default=100, help='Bytes per published message')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    asyncio.get_event_loop().run_until_complete(main(args))
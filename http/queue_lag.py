@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Subscriber lag for the /lag route, shared by the threaded and asyncio server engines.
+
+The rows come from topic_lag() (or the storage backend's lag()): one per subscriber and
+consumed partition, with the partition's head offset (topic_partition.head_offset, advanced by
+every publish), the committed offset of the subscriber or of its consumer group, and the publish
+time of the oldest message after the committed offset. That is one index lookup per lagging
+subscriber partition, never a scan of topic_message.
+
+Rows are reused for LAG_CACHE_MS milliseconds (0 disables the cache), so frequent scrapes cost
+one query per cache period. Ages are computed when each report is built, from the cached
+publish times, so they stay current while the offsets may be up to LAG_CACHE_MS old. Coalesced
+acks waiting for a flush are not counted as committed.
+"""
+from datetime import datetime, timezone
+import os
+import threading
+import time
+
+LAG_CACHE_MS = float(os.environ.get('LAG_CACHE_MS', 2000))
+
+
+class QLagCache:
+    """
+    Lag rows per topic filter (None for all topics), reused for ttl_ms milliseconds.
+    """
+    def __init__(self, ttl_ms: float=LAG_CACHE_MS):
+        self.ttl_ms = ttl_ms
+        self._lock = threading.Lock()
+        self._entries = {}      # topic or None -> (monotonic time computed, rows)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, topic: str) -> list:
+        """
+        Cached rows for topic, None when there are none or they are too old.
+        """
+        with self._lock:
+            entry = self._entries.get(topic)
+            if entry is not None and (time.monotonic() - entry[0]) * 1000.0 < self.ttl_ms:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, topic: str, rows: list):
+        if self.ttl_ms <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # drop expired filters so one-off topic filters do not pile up
+            self._entries = {k: v for k, v in self._entries.items() if (now - v[0]) * 1000.0 < self.ttl_ms}
+            self._entries[topic] = (now, rows)
+
+    def metrics(self) -> list:
+        """
+        Collector for QMetrics.register_collector().
+        """
+        return [('queue_lag_cache_hits_total', 'counter', '/lag requests answered from the lag cache.', [({}, self.hits)]),
+                ('queue_lag_cache_misses_total', 'counter', '/lag requests that queried the lag.', [({}, self.misses)])]
+
+
+def _age_ms(ts: datetime, now: datetime) -> int:
+    return max(0, int((now - ts).total_seconds() * 1000)) if ts is not None else None
+
+
+def lag_report(rows: list) -> dict:
+    """
+    The /lag response for rows of topic_lag(): per topic the head offset of every partition, and
+    per subscriber its total lag, the age of its oldest unacked message and the same per partition.
+    """
+    now = datetime.now(timezone.utc)
+    topics = {}
+    for row in rows:
+        topic = topics.setdefault(row['topic'], {'topic': row['topic'], 'heads': {}, 'subscribers': {}})
+        topic['heads'][row['_partition']] = row['head_offset']
+        subscriber = topic['subscribers'].get(row['subscriber_id'])
+        if subscriber is None:
+            subscriber = topic['subscribers'][row['subscriber_id']] = {
+                'subscriber_id': row['subscriber_id'], 'group': row['group_name'], 'lag': 0,
+                'oldest_unacked_age_ms': None, 'partitions': []}
+        age = _age_ms(row['oldest_unacked_ts'], now)
+        subscriber['partitions'].append({'partition': row['_partition'], 'head_offset': row['head_offset'],
+                                         'committed_offset': row['committed_offset'], 'lag': row['lag'],
+                                         'oldest_unacked_age_ms': age})
+        subscriber['lag'] += row['lag']
+        if age is not None and (subscriber['oldest_unacked_age_ms'] or 0) <= age:
+            subscriber['oldest_unacked_age_ms'] = age
+
+    report = []
+    for topic in topics.values():
+        subscribers = list(topic['subscribers'].values())
+        report.append({
+            'topic': topic['topic'],
+            'partitions': [{'partition': p, 'head_offset': head} for p, head in sorted(topic['heads'].items())],
+            # what autoscaling looks at: the subscriber furthest behind
+            'max_lag': max(s['lag'] for s in subscribers),
+            'max_oldest_unacked_age_ms': max((s['oldest_unacked_age_ms'] for s in subscribers
+                                              if s['oldest_unacked_age_ms'] is not None), default=None),
+            'subscribers': subscribers,
+        })
+    return {'topics': report}
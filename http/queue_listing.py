@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Keyset pagination for the list routes (/topics, /topic_messages, /topic_subscribers), shared
+by the threaded and asyncio server engines.
+
+Each table is paged on its natural key instead of with OFFSET, so fetching any page costs the
+same index range scan no matter how deep into the table it is:
+
+* topic:            after_topic
+* topic_message:    after_partition + after_offset (with a topic filter), after_offset (with topic
+                    and partition filters) or after_topic + after_partition + after_offset
+* topic_subscriber: after_id
+"""
+import os
+from urllib.parse import urlencode
+
+LIST_DEFAULT_LIMIT = int(os.environ.get('LIST_DEFAULT_LIMIT', 1000))
+LIST_MAX_LIMIT = int(os.environ.get('LIST_MAX_LIMIT', 10000))
+
+LIST_ROUTES = {'topic': 'topics', 'topic_message': 'topic_messages', 'topic_subscriber': 'topic_subscribers'}
+
+
+def _param(params: dict, name: str):
+    value = params.get(name)
+    value = value[0] if isinstance(value, (list, tuple)) else value
+    return value if value not in ('', None) else None
+
+
+def _int_param(params: dict, name: str):
+    value = _param(params, name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Expected integer value for the {name} parameter. Got [{value}].')
+
+
+def is_stream_request(params: dict, accept: str=None) -> bool:
+    stream = _param(params, 'stream')
+    if stream is not None:
+        return str(stream).lower() in ('1', 'true', 'yes')
+    return bool(accept) and 'application/x-ndjson' in accept
+
+
+def list_query(table_name: str, params: dict, stream: bool=False) -> tuple:
+    """
+    Build the keyset query for one page of table_name. Returns (sql, values, limit) with psycopg2
+    style placeholders. In streaming mode the limit is only applied when one was requested.
+    Raises ValueError for invalid parameters.
+    """
+    if table_name not in LIST_ROUTES:
+        raise ValueError(f'Unknown list table {table_name}')
+
+    limit = _int_param(params, 'limit')
+    if limit is not None and limit < 1:
+        raise ValueError(f'Expected a positive limit. Got [{limit}].')
+    if not stream:
+        limit = min(limit or LIST_DEFAULT_LIMIT, LIST_MAX_LIMIT)
+
+    target_topic = _param(params, 'topic')
+    after_topic = _param(params, 'after_topic')
+    where = []
+    values = []
+    if target_topic:
+        where.append('topic = %s')
+        values.append(target_topic)
+
+    if table_name == 'topic_message':
+        partition = _int_param(params, 'partition')
+        after_partition = _int_param(params, 'after_partition')
+        after_offset = _int_param(params, 'after_offset')
+        if target_topic and partition is not None:
+            where.append('_partition = %s')
+            values.append(partition)
+            if after_offset is not None:
+                where.append('_offset > %s')
+                values.append(after_offset)
+        elif target_topic:
+            if after_offset is not None or after_partition is not None:
+                where.append('(_partition, _offset) > (%s, %s)')
+                values.extend([after_partition or 0, after_offset if after_offset is not None else 0])
+        elif after_topic is not None:
+            where.append('(topic, _partition, _offset) > (%s, %s, %s)')
+            values.extend([after_topic, after_partition or 0, after_offset if after_offset is not None else 0])
+        order = 'topic, _partition, _offset'
+    elif table_name == 'topic':
+        if after_topic is not None:
+            where.append('topic > %s')
+            values.append(after_topic)
+        order = 'topic'
+    else:
+        after_id = _int_param(params, 'after_id')
+        if after_id is not None:
+            where.append('id > %s')
+            values.append(after_id)
+        order = 'id'
+
+    sql = f"""select * from {table_name}"""
+    if where:
+        sql += ' where ' + ' and '.join(where)
+    sql += f' order by {order}'
+    if limit is not None:
+        sql += ' limit %s'
+        values.append(limit)
+    return sql + ';', values, limit
+
+
+def next_page(table_name: str, params: dict, rows: list, limit: int) -> str:
+    """
+    Path of the page following rows, or None when rows is the last page.
+    """
+    if not rows or limit is None or len(rows) < limit:
+        return None
+    last = rows[-1]
+    query = {}
+    target_topic = _param(params, 'topic')
+    if target_topic:
+        query['topic'] = target_topic
+    if table_name == 'topic_message':
+        partition = _param(params, 'partition')
+        if not target_topic:
+            query['after_topic'] = last['topic']
+        if target_topic and partition is not None:
+            query['partition'] = partition
+        else:
+            query['after_partition'] = last['_partition']
+        query['after_offset'] = last['_offset']
+    elif table_name == 'topic':
+        query['after_topic'] = last['topic']
+    else:
+        query['after_id'] = last['id']
+    query['limit'] = limit
+    return f'/{LIST_ROUTES[table_name]}?{urlencode(query)}'
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Reproducible load generator and benchmark for a running queue server.
+
+run starts --publishers publisher processes and --subscribers subscriber processes spread
+round-robin over --topics topics (created with --partitions partitions and deleted at the end).
+Publishers send --message-size byte messages for --duration seconds, each at --rate messages
+per second (0 for as fast as it can), with /publish or /publish_batch (--batch-size > 1), and
+reset their topic to a random earlier offset with --reset-probability per request, like
+queue_pub_stress.py. Subscribers consume with /ack_fetch long polls and keep draining for up to
+--drain seconds after the publishers stop.
+
+Every message carries its send time, so subscribers measure publish-to-consume latency. Lag is
+the number of messages between a subscriber's acked offsets and the newest offsets published to
+its topic, sampled after every fetch. Request latencies of rate limited publishers are measured
+from the time a request was due, so a stalled server shows up in the percentiles instead of
+only lowering the request rate. With the same --seed, runs make the same reset decisions.
+
+The result is written as JSON (to --output, else stdout). compare prints the change of every
+metric between two result files and exits with status 1 when a metric got worse by more than
+--threshold (throughput down, latency or lag up).
+
+Usage::
+    ./queue_load_bench.py run --url http://localhost:8888 --publishers 4 --subscribers 4 --topics 2 --output base.json
+    ./queue_load_bench.py run --url http://localhost:8888 --publishers 4 --subscribers 4 --topics 2 --output new.json
+    ./queue_load_bench.py compare base.json new.json --threshold 0.1
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+import multiprocessing
+import random
+import sys
+import time
+
+from queue_session import make_session
+
+SUB_BATCH_SIZE = 100
+SUB_WAIT_MS = 500
+
+# metric path -> direction in which it is better
+COMPARED_METRICS = (
+    (('publish', 'per_second'), 'higher'),
+    (('publish', 'latency_ms', 'p50'), 'lower'),
+    (('publish', 'latency_ms', 'p95'), 'lower'),
+    (('publish', 'latency_ms', 'p99'), 'lower'),
+    (('fetch', 'latency_ms', 'p50'), 'lower'),
+    (('fetch', 'latency_ms', 'p99'), 'lower'),
+    (('end_to_end_ms', 'p50'), 'lower'),
+    (('end_to_end_ms', 'p95'), 'lower'),
+    (('end_to_end_ms', 'p99'), 'lower'),
+    (('consumed', 'per_second'), 'higher'),
+    (('max_lag',), 'lower'),
+    (('publish', 'errors'), 'lower'),
+)
+
+
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    samples = sorted(samples)
+    at = lambda q: round(samples[min(len(samples) - 1, int(len(samples) * q))] * 1000.0, 3)
+    return {'p50': at(0.50), 'p95': at(0.95), 'p99': at(0.99), 'max': round(samples[-1] * 1000.0, 3)}
+
+
+def publisher(index: int, args, topic: str, heads, head_base: int, start: multiprocessing.Event,
+              stop: multiprocessing.Event, results: multiprocessing.Queue):
+    rand = random.Random(args.seed * 1000 + index)
+    padding = 'x' * max(0, args.message_size - 32)
+    session = make_session(pool_size=1, retries=0)
+    latencies = []
+    published = errors = resets = requests_sent = 0
+    last_offset = 1
+    interval = args.batch_size / args.rate if args.rate else 0.0
+    start.wait()
+    started = time.monotonic()
+    due = started
+    try:
+        while not stop.is_set():
+            if interval:
+                due += interval
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                due = time.monotonic()
+            messages = [f'{time.time():.6f} {padding}' for _ in range(args.batch_size)]
+            try:
+                if args.batch_size > 1:
+                    res = session.post(f'{args.url}/publish_batch', json={'topic': topic, 'messages': messages})
+                    partition, offset = (res.json()['partition'], res.json()['last_offset']) if res.ok else (None, None)
+                else:
+                    res = session.post(f'{args.url}/publish', json={'topic': topic, 'message': messages[0]})
+                    partition, offset = res.headers.get('X-Partition'), res.headers.get('X-Offset')
+            except Exception:
+                errors += len(messages)
+                continue
+            latencies.append(time.monotonic() - due)
+            requests_sent += 1
+            if not res.ok or offset is None:
+                errors += len(messages)
+                continue
+            published += len(messages)
+            partition, offset = int(partition), int(offset)
+            last_offset = offset
+            with heads.get_lock():
+                heads[head_base + partition] = max(heads[head_base + partition], offset)
+            if args.reset_probability and rand.random() < args.reset_probability:
+                session.post(f'{args.url}/topic_reset', json={'topic': topic, 'offset': rand.randrange(1, last_offset + 1)})
+                resets += 1
+    finally:
+        session.close()
+    results.put({'role': 'publisher', 'published': published, 'errors': errors, 'resets': resets,
+                 'requests': requests_sent, 'seconds': time.monotonic() - started, 'latencies': latencies})
+
+
+def subscriber(index: int, args, topic: str, heads, head_base: int, start: multiprocessing.Event,
+               stop: multiprocessing.Event, results: multiprocessing.Queue):
+    session = make_session(pool_size=1)
+    latencies = []
+    end_to_end = []
+    consumed = errors = 0
+    max_lag = 0
+    acked = {}
+    started = time.monotonic()
+    try:
+        res = session.get(f'{args.url}/subscribe', params={'topic': topic})
+        res.raise_for_status()
+        subscriber_id = res.json()['subscriber_id']
+        start.wait()
+        started = time.monotonic()
+        drain_until = None
+        while True:
+            if stop.is_set() and drain_until is None:
+                drain_until = time.monotonic() + args.drain
+            params = {'subscriber_id': subscriber_id, 'num_messages': SUB_BATCH_SIZE, 'wait_ms': SUB_WAIT_MS,
+                      'partitions': list(acked), 'offsets': list(acked.values())}
+            sent = time.monotonic()
+            try:
+                res = session.post(f'{args.url}/ack_fetch', json=params)
+                rows = res.json() if res.ok else []
+            except Exception:
+                errors += 1
+                rows = []
+            latencies.append(time.monotonic() - sent)
+            now = time.time()
+            for row in rows:
+                try:
+                    end_to_end.append(now - float(row['message'].split(' ', 1)[0]))
+                except ValueError:
+                    pass
+                acked[row['_partition']] = row['_offset']
+            consumed += len(rows)
+            with heads.get_lock():
+                lag = sum(max(0, heads[head_base + p] - acked.get(p, 0)) for p in range(args.partitions))
+            max_lag = max(max_lag, lag)
+            if drain_until is not None and ((not rows and lag == 0) or time.monotonic() >= drain_until):
+                break
+        session.post(f'{args.url}/unsubscribe', json={'subscriber_id': subscriber_id})
+    finally:
+        session.close()
+    results.put({'role': 'subscriber', 'consumed': consumed, 'errors': errors, 'max_lag': max_lag,
+                 'seconds': time.monotonic() - started, 'latencies': latencies, 'end_to_end': end_to_end})
+
+
+def run(args) -> dict:
+    run_id = f'{int(time.time())}-{args.seed}'
+    topics = [f'load-bench-{run_id}-{i}' for i in range(args.topics)]
+    session = make_session()
+    try:
+        for topic in topics:
+            session.post(f'{args.url}/topic', json={'topic': topic, 'description': 'load benchmark',
+                                                    'partitions': args.partitions}).raise_for_status()
+    except Exception:
+        session.close()
+        raise
+
+    ctx = multiprocessing.get_context('spawn')
+    # newest published offset of every topic partition, shared by all processes
+    heads = ctx.Array('q', args.topics * args.partitions)
+    start = ctx.Event()
+    stop = ctx.Event()
+    results = ctx.Queue()
+    procs = []
+    for i in range(args.subscribers):
+        procs.append(ctx.Process(target=subscriber, args=(i, args, topics[i % args.topics], heads,
+                                                          (i % args.topics) * args.partitions, start, stop, results)))
+    for i in range(args.publishers):
+        procs.append(ctx.Process(target=publisher, args=(i, args, topics[i % args.topics], heads,
+                                                         (i % args.topics) * args.partitions, start, stop, results)))
+    for proc in procs:
+        proc.start()
+    # subscribers subscribe before the start, so they begin at the head of the empty topics
+    time.sleep(args.warmup)
+    started_at = datetime.now(timezone.utc)
+    start.set()
+    time.sleep(args.duration)
+    stop.set()
+    collected = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    try:
+        for topic in topics:
+            session.delete(f'{args.url}/topic_delete', params={'topic': topic})
+    finally:
+        session.close()
+
+    pubs = [r for r in collected if r['role'] == 'publisher']
+    subs = [r for r in collected if r['role'] == 'subscriber']
+    published = sum(r['published'] for r in pubs)
+    consumed = sum(r['consumed'] for r in subs)
+    pub_seconds = max((r['seconds'] for r in pubs), default=0.0)
+    sub_seconds = max((r['seconds'] for r in subs), default=0.0)
+    config = {name: value for name, value in vars(args).items() if name not in ('command', 'func', 'output')}
+    return {
+        'config': config,
+        'started': started_at.isoformat(),
+        'publish': {'messages': published,
+                    'requests': sum(r['requests'] for r in pubs),
+                    'errors': sum(r['errors'] for r in pubs),
+                    'resets': sum(r['resets'] for r in pubs),
+                    'per_second': round(published / pub_seconds, 1) if pub_seconds else 0.0,
+                    'latency_ms': percentiles([s for r in pubs for s in r['latencies']])},
+        'fetch': {'requests': sum(len(r['latencies']) for r in subs),
+                  'errors': sum(r['errors'] for r in subs),
+                  'latency_ms': percentiles([s for r in subs for s in r['latencies']])},
+        'consumed': {'messages': consumed, 'per_second': round(consumed / sub_seconds, 1) if sub_seconds else 0.0},
+        'end_to_end_ms': percentiles([s for r in subs for s in r['end_to_end']]),
+        'max_lag': max((r['max_lag'] for r in subs), default=0),
+    }
+
+
+def metric(result: dict, path: tuple):
+    for name in path:
+        if not isinstance(result, dict):
+            return None
+        result = result.get(name)
+    return result
+
+
+def compare(base: dict, new: dict, threshold: float) -> list:
+    """
+    Rows of (metric, base value, new value, relative change, regressed) for every compared metric.
+    """
+    rows = []
+    for path, better in COMPARED_METRICS:
+        old_value, new_value = metric(base, path), metric(new, path)
+        if old_value is None or new_value is None:
+            continue
+        change = (new_value - old_value) / old_value if old_value else (0.0 if new_value == old_value else float('inf'))
+        worse = -change if better == 'higher' else change
+        rows.append(('.'.join(path), old_value, new_value, change, worse > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator and benchmark for the queue server')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='Run a benchmark and write the result as JSON')
+    run_parser.add_argument('--url', default='http://localhost:8888', help='Queue server URL')
+    run_parser.add_argument('--publishers', type=int, default=2, help='Publisher processes')
+    run_parser.add_argument('--subscribers', type=int, default=2, help='Subscriber processes')
+    run_parser.add_argument('--topics', type=int, default=1, help='Topics to spread the processes over')
+    run_parser.add_argument('--partitions', type=int, default=1, help='Partitions per topic')
+    run_parser.add_argument('--rate', type=float, default=0.0, help='Messages per second per publisher, 0 for unlimited')
+    run_parser.add_argument('--batch-size', type=int, default=1, help='Messages per publish request (/publish_batch above 1)')
+    run_parser.add_argument('--message-size', type=int, default=100, help='Bytes per message')
+    run_parser.add_argument('--reset-probability', type=float, default=0.0, help='Chance of a topic reset after each publish request')
+    run_parser.add_argument('--duration', type=float, default=30.0, help='Seconds of publishing')
+    run_parser.add_argument('--warmup', type=float, default=1.0, help='Seconds for the processes to start and subscribe')
+    run_parser.add_argument('--drain', type=float, default=10.0, help='Seconds subscribers may take to catch up after publishing stops')
+    run_parser.add_argument('--seed', type=int, default=1, help='Seed of the random reset decisions')
+    run_parser.add_argument('--output', help='Write the JSON result to this file instead of stdout')
+
+    compare_parser = commands.add_parser('compare', help='Compare two result files')
+    compare_parser.add_argument('base', help='Result file of the baseline run')
+    compare_parser.add_argument('new', help='Result file of the run to check')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='Relative change beyond which a metric counts as a regression')
+    compare_parser.add_argument('--json', action='store_true', help='Print the comparison as JSON')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        if args.topics < 1 or args.partitions < 1 or args.batch_size < 1:
+            parser.error('--topics, --partitions and --batch-size must be at least 1')
+        result = json.dumps(run(args), indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(result + '\n')
+        else:
+            print(result)
+        return
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows = compare(base, new, args.threshold)
+    if args.json:
+        print(json.dumps([{'metric': m, 'base': b, 'new': n, 'change': c, 'regressed': r} for m, b, n, c, r in rows], indent=2))
+    else:
+        for name, old_value, new_value, change, regressed in rows:
+            print(f"{name:<28} {old_value:>12} {new_value:>12} {change * 100:>+8.1f}%{'  REGRESSION' if regressed else ''}")
+    sys.exit(1 if any(r[4] for r in rows) else 0)
+
+
+if __name__ == '__main__':
+    main()
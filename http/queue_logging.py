@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Logging setup for the queue server.
+
+In async mode (LOG_ASYNC=1) request threads only put records on a bounded queue and a single
+listener thread does the formatting and I/O, so a slow disk or terminal never stalls a request.
+When the queue is full records are dropped and counted rather than blocking.
+
+Per-request log lines are logged with extra=PER_REQUEST and are sampled at LOG_SAMPLE_RATE
+(1.0 keeps all of them, 0.01 keeps about one in a hundred). Everything else is always kept.
+"""
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_ASYNC = os.environ.get('LOG_ASYNC', '0').lower() in ('1', 'true', 'yes')
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1.0))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+LOG_FORMAT = '%(asctime)s - %(threadName)s - %(levelname)s - %(message)s'
+
+# pass as extra= on per-request log calls to make them subject to sampling
+PER_REQUEST = {'per_request': True}
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1.0 or not getattr(record, 'per_request', False):
+            return True
+        return random.random() < self.rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records instead of blocking or erroring when the queue is full.
+    """
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the queue never leaves the process, so formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_queue_handler = None
+
+
+def setup_logging(level: str=LOG_LEVEL, async_mode: bool=LOG_ASYNC, sample_rate: float=LOG_SAMPLE_RATE,
+                  queue_size: int=LOG_QUEUE_SIZE):
+    global _listener, _queue_handler
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    if async_mode:
+        _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+        handler = _queue_handler
+        _listener = logging.handlers.QueueListener(_queue_handler.queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+    else:
+        handler = stream_handler
+    handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped_records() -> int:
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+def logging_metrics() -> list:
+    """
+    Collector for QMetrics.register_collector().
+    """
+    return [('queue_log_records_dropped_total', 'counter', 'Log records dropped because the async log queue was full.',
+             [({}, dropped_records())])]
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+In-process request metrics rendered in the Prometheus text exposition format on /metrics.
+
+Per route the server records request counts by status, error counts, and latency histograms
+for three phases of each request: time spent in the database (including waiting for a pooled
+connection), time spent serializing the response, and the total time. Other components add
+their own gauges and counters with register_collector().
+"""
+import threading
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PHASES = ('db', 'serialize', 'total')
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _number(value) -> str:
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+class QMetrics:
+    def __init__(self, buckets: tuple=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._requests = {}     # (route, method, status) -> count
+        self._errors = {}       # route -> count
+        self._histograms = {}   # (route, phase) -> [bucket counts..., +Inf count, sum]
+        self._collectors = []   # callables returning [(name, type, help, [(labels, value), ...]), ...]
+
+    def observe(self, route: str, method: str, status: int, total: float, db: float=0.0, serialize: float=0.0):
+        with self._lock:
+            key = (route, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            if status >= 400:
+                self._errors[route] = self._errors.get(route, 0) + 1
+            for phase, seconds in (('db', db), ('serialize', serialize), ('total', total)):
+                hist = self._histograms.get((route, phase))
+                if hist is None:
+                    hist = self._histograms[(route, phase)] = [0] * (len(self.buckets) + 1) + [0.0]
+                for i, bound in enumerate(self.buckets):
+                    if seconds <= bound:
+                        hist[i] += 1
+                        break
+                else:
+                    hist[len(self.buckets)] += 1
+                hist[-1] += seconds
+
+    def register_collector(self, collector):
+        """
+        collector() -> [(name, type, help, [(labels dict, value), ...]), ...] is called on every scrape.
+        """
+        self._collectors.append(collector)
+
+    def snapshot(self) -> dict:
+        """
+        Raw counters in a JSON friendly form, used to aggregate metrics across processes.
+        """
+        with self._lock:
+            return {
+                'buckets': list(self.buckets),
+                'requests': [[route, method, status, count] for (route, method, status), count in self._requests.items()],
+                'errors': [[route, count] for route, count in self._errors.items()],
+                'histograms': [[route, phase, list(hist)] for (route, phase), hist in self._histograms.items()],
+                'collected': [[name, mtype, help_text, [[labels, value] for labels, value in samples]]
+                              for name, mtype, help_text, samples in self._collect()],
+            }
+
+    def _collect(self) -> list:
+        families = []
+        for collector in self._collectors:
+            families.extend(collector())
+        return families
+
+    def render(self) -> str:
+        return render_snapshots([self.snapshot()])
+
+
+def render_snapshots(snapshots: list) -> str:
+    """
+    Render one or more snapshots (e.g. one per worker process) as a single Prometheus text page,
+    summing counters, histograms and collected samples with equal labels.
+    """
+    requests = {}
+    errors = {}
+    histograms = {}
+    collected = {}
+    buckets = tuple(snapshots[0]['buckets']) if snapshots else DEFAULT_BUCKETS
+    for snap in snapshots:
+        for route, method, status, count in snap['requests']:
+            key = (route, method, status)
+            requests[key] = requests.get(key, 0) + count
+        for route, count in snap['errors']:
+            errors[route] = errors.get(route, 0) + count
+        for route, phase, hist in snap['histograms']:
+            total = histograms.get((route, phase))
+            if total is None:
+                histograms[(route, phase)] = list(hist)
+            else:
+                histograms[(route, phase)] = [a + b for a, b in zip(total, hist)]
+        for name, mtype, help_text, samples in snap.get('collected', []):
+            family = collected.setdefault(name, [mtype, help_text, {}])
+            for labels, value in samples:
+                key = tuple(sorted(labels.items()))
+                family[2][key] = family[2].get(key, 0) + value
+
+    lines = ['# HELP queue_requests_total HTTP requests handled, by route, method and status.',
+             '# TYPE queue_requests_total counter']
+    for (route, method, status), count in sorted(requests.items()):
+        lines.append(f'queue_requests_total{_labels({"route": route, "method": method, "status": status})} {count}')
+
+    lines += ['# HELP queue_request_errors_total HTTP requests answered with a 4xx or 5xx status, by route.',
+              '# TYPE queue_request_errors_total counter']
+    for route, count in sorted(errors.items()):
+        lines.append(f'queue_request_errors_total{_labels({"route": route})} {count}')
+
+    lines += ['# HELP queue_request_duration_seconds Request latency by route and phase (db, serialize, total).',
+              '# TYPE queue_request_duration_seconds histogram']
+    for (route, phase), hist in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(buckets + (float('inf'),), hist[:-1]):
+            cumulative += count
+            labels = _labels({'route': route, 'phase': phase, 'le': _number(float(bound))})
+            lines.append(f'queue_request_duration_seconds_bucket{labels} {cumulative}')
+        lines.append(f'queue_request_duration_seconds_sum{_labels({"route": route, "phase": phase})} {_number(float(hist[-1]))}')
+        lines.append(f'queue_request_duration_seconds_count{_labels({"route": route, "phase": phase})} {cumulative}')
+
+    for name, (mtype, help_text, samples) in sorted(collected.items()):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {mtype}']
+        for key, value in sorted(samples.items()):
+            lines.append(f'{name}{_labels(dict(key))} {_number(value)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Single-connection LISTEN/NOTIFY dispatcher for the queue server.
+
+save_message() and save_messages() send a notification on the "topic_publish" channel with
+a JSON payload holding the topic, partition and newest offset. The dispatcher owns one dedicated
+database connection that LISTENs on that channel and wakes only the request threads that are
+parked waiting on the published topic.
+
+A waiter takes a snapshot of the topic generation *before* it checks the database and then
+waits for the generation to move past the snapshot, so a publish that lands between the
+check and the wait is never missed.
+"""
+import json
+import logging
+import select
+import threading
+import time
+
+PUBLISH_CHANNEL = 'topic_publish'
+# topic_delete(), topic_reset() and retention announce changes to a topic's messages on this channel
+TOPIC_CHANGE_CHANNEL = 'topic_change'
+
+
+class QNotificationDispatcher:
+    def __init__(self, dsn: str, channels: tuple=(PUBLISH_CHANNEL,), poll_interval: float=1.0,
+                 reconnect_delay: float=1.0, fallback_wait: float=1.0):
+        self.dsn = dsn
+        self.channels = tuple(channels)
+        self.poll_interval = poll_interval
+        self.reconnect_delay = reconnect_delay
+        # longest a waiter sleeps when notifications are not flowing (listener disconnected)
+        self.fallback_wait = fallback_wait
+
+        self._lock = threading.Lock()
+        self._conditions = {}     # topic -> threading.Condition sharing self._lock
+        self._generations = {}    # topic -> count of publish notifications seen
+        self._waiting = {}        # topic -> number of parked waiters
+        self._listeners = []      # callables(channel, payload) run on the dispatcher thread
+        self._connected = threading.Event()
+        self._epoch = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._log = logging.getLogger(__name__)
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    @property
+    def epoch(self):
+        """
+        Changes every time the listener (re)connects, None while it is disconnected. State kept up
+        to date from notifications is only valid for the epoch it was built in.
+        """
+        return self._epoch if self._connected.is_set() else None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='notify-dispatcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._wake_all()
+
+    def add_listener(self, callback):
+        """
+        Register callback(channel, payload) for every notification received. Callbacks run on
+        the dispatcher thread and must not block.
+        """
+        self._listeners.append(callback)
+
+    def generation(self, topic: str) -> int:
+        with self._lock:
+            return self._generations.get(topic, 0)
+
+    def wait(self, topic: str, generation: int, timeout: float) -> bool:
+        """
+        Park the calling thread until a publish on topic moves its generation past the given
+        snapshot or the timeout expires. Returns True if woken by a publish.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            cond = self._conditions.get(topic)
+            if cond is None:
+                cond = self._conditions[topic] = threading.Condition(self._lock)
+            self._waiting[topic] = self._waiting.get(topic, 0) + 1
+            try:
+                while self._generations.get(topic, 0) == generation and not self._stop.is_set():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    if not self._connected.is_set():
+                        # without a listener publishes go unseen, so hand back to the caller to re-check
+                        cond.wait(min(remaining, self.fallback_wait))
+                        break
+                    cond.wait(remaining)
+                return self._generations.get(topic, 0) != generation
+            finally:
+                self._waiting[topic] -= 1
+                if not self._waiting[topic]:
+                    del self._waiting[topic]
+                    del self._conditions[topic]
+
+    def waiter_count(self) -> int:
+        with self._lock:
+            return sum(self._waiting.values())
+
+    def _notify_topic(self, topic: str):
+        with self._lock:
+            self._generations[topic] = self._generations.get(topic, 0) + 1
+            cond = self._conditions.get(topic)
+            if cond is not None:
+                cond.notify_all()
+
+    def _wake_all(self):
+        # after a reconnect notifications may have been lost, so every waiter re-checks
+        with self._lock:
+            for topic in set(self._generations) | set(self._conditions):
+                self._generations[topic] = self._generations.get(topic, 0) + 1
+            for cond in self._conditions.values():
+                cond.notify_all()
+
+    def _dispatch(self, channel: str, payload: str):
+        if channel == PUBLISH_CHANNEL:
+            try:
+                topic = json.loads(payload)['topic']
+            except (ValueError, KeyError, TypeError):
+                topic = payload
+            self._notify_topic(topic)
+        for callback in self._listeners:
+            try:
+                callback(channel, payload)
+            except Exception as e:
+                self._log.error(f'Notification listener failed: {e}')
+
+    def _run(self):
+        # imported here, so QLocalDispatcher and the channel names need no psycopg2
+        import psycopg2.extensions
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    for channel in self.channels:
+                        cur.execute(f'LISTEN {channel};')
+                self._epoch += 1
+                self._connected.set()
+                self._wake_all()
+                self._log.info(f'Listening for notifications on {", ".join(self.channels)}')
+                while not self._stop.is_set():
+                    readable, _, _ = select.select([conn], [], [], self.poll_interval)
+                    if not readable:
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._dispatch(notify.channel, notify.payload)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, OSError) as e:
+                self._log.error(f'Notification listener connection lost: {e}')
+            finally:
+                self._connected.clear()
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            self._stop.wait(self.reconnect_delay)
+
+
+class QLocalDispatcher(QNotificationDispatcher):
+    """
+    Dispatcher for storage that lives in the server process (QSegmentLogStorage): publishes and
+    topic changes are handed to notify() directly instead of arriving through LISTEN/NOTIFY, so
+    it is always connected.
+    """
+    def __init__(self, channels: tuple=(PUBLISH_CHANNEL,)):
+        super().__init__(None, channels)
+
+    def start(self):
+        if not self._connected.is_set():
+            self._epoch += 1
+            self._connected.set()
+
+    def stop(self):
+        self._stop.set()
+        self._connected.clear()
+        self._wake_all()
+
+    def notify(self, channel: str, payload: dict):
+        if channel in self.channels:
+            self._dispatch(channel, json.dumps(payload))
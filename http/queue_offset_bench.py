@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Publish throughput benchmark for offset allocation with concurrent publishers on one topic.
+With --partitions N the topic is created with N partitions and publishes are spread over them
+round-robin, so publishers only contend on the head offset of the same partition.
+
+Each publisher is a thread with its own database connection calling save_message() (or
+save_messages() with --batch-size > 1) in its own transaction as fast as it can for the
+given duration. With --legacy the old max(_offset) ... for update allocation is run instead
+so the two strategies can be compared on the same database.
+
+Usage::
+    DB_URI=postgresql://queues@localhost:5432/queues ./queue_offset_bench.py [--publishers 1 4 16] [--duration 10]
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+from psycopg2 import connect as db_connect
+import psycopg2.errors
+
+DB_URI = os.environ.get('DB_URI', 'postgresql://queues@localhost:5432/queues')
+
+LEGACY_SELECT = """select _offset
+                     from "topic_message" tm
+                    where tm.topic = %s
+                      and tm._offset = (select coalesce(max(tm1._offset), 0)
+                                          from "topic_message" tm1
+                                         where tm1.topic = %s)
+                      for update;"""
+LEGACY_INSERT = """insert into "topic_message" (topic, _offset, message) values (%s, %s, %s);"""
+
+
+def publish_loop(topic: str, batch_size: int, legacy: bool, stop: threading.Event, start: threading.Barrier, result: dict):
+    messages = [f'bench message {i}' for i in range(batch_size)]
+    published = 0
+    errors = 0
+    conn = db_connect(DB_URI)
+    try:
+        with conn.cursor() as cur:
+            start.wait()
+            while not stop.is_set():
+                try:
+                    if legacy:
+                        cur.execute(LEGACY_SELECT, (topic, topic))
+                        row = cur.fetchone()
+                        cur.execute(LEGACY_INSERT, (topic, (row[0] if row else 0) + 1, messages[0]))
+                        count = 1
+                    elif batch_size > 1:
+                        cur.execute("""select * from save_messages(%s, %s::text[]);""", (topic, messages))
+                        count = batch_size
+                    else:
+                        cur.execute("""select * from save_message(%s, %s);""", (topic, messages[0]))
+                        count = 1
+                    conn.commit()
+                    published += count
+                except psycopg2.errors.UniqueViolation:
+                    conn.rollback()
+                    errors += 1
+    finally:
+        conn.close()
+    result['published'] = published
+    result['errors'] = errors
+
+
+def run_round(topic: str, publishers: int, duration: float, batch_size: int, legacy: bool, partitions: int=1) -> dict:
+    stop = threading.Event()
+    start = threading.Barrier(publishers + 1)
+    results = [{} for _ in range(publishers)]
+    threads = [threading.Thread(target=publish_loop, args=(topic, batch_size, legacy, stop, start, results[i]))
+               for i in range(publishers)]
+    for t in threads:
+        t.start()
+    start.wait()
+    started = time.monotonic()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+
+    published = sum(r.get('published', 0) for r in results)
+    return {'publishers': publishers,
+            'batch_size': 1 if legacy else batch_size,
+            'strategy': 'legacy' if legacy else 'head_offset',
+            'partitions': partitions,
+            'seconds': round(elapsed, 3),
+            'published': published,
+            'conflicts': sum(r.get('errors', 0) for r in results),
+            'messages_per_second': round(published / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark concurrent publishing to a single topic')
+    parser.add_argument('--publishers', type=int, nargs='+', default=[1, 4, 16], help='Publisher counts to run')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds per round')
+    parser.add_argument('--batch-size', type=int, default=1, help='Messages per save_messages() call')
+    parser.add_argument('--legacy', action='store_true', help='Use the old max(_offset) for update allocation')
+    parser.add_argument('--partitions', type=int, default=1, help='Partitions of the benchmark topic (ignored with --legacy)')
+    parser.add_argument('--topic', default=f'offset-bench-{int(time.time())}', help='Topic to publish to (created and deleted)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    with db_connect(DB_URI) as conn:
+        with conn.cursor() as cur:
+            # one segment big enough for any run, so the legacy inserts always have a partition to land in
+            cur.execute("""select topic_create(%s, %s, %s, p_partitions => %s);""",
+                        (args.topic, 'offset allocation benchmark', 10 ** 12, 1 if args.legacy else args.partitions))
+
+    rows = []
+    try:
+        for publishers in args.publishers:
+            rows.append(run_round(args.topic, publishers, args.duration, args.batch_size, args.legacy,
+                                  1 if args.legacy else args.partitions))
+            if not args.json:
+                r = rows[-1]
+                print(f"{r['strategy']:>12} publishers={r['publishers']:<3d} partitions={r['partitions']:<4d} batch={r['batch_size']:<4d} "
+                      f"msgs/s={r['messages_per_second']:>10.1f} conflicts={r['conflicts']}")
+    finally:
+        with db_connect(DB_URI) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""select topic_delete(%s);""", (args.topic,))
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+if __name__ == '__main__':
+    main()
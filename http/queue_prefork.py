@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Pre-fork mode of the threaded server (queue_server.py --workers N).
+
+A supervisor process forks N worker processes. Each one binds the server port with SO_REUSEPORT,
+so the kernel spreads new connections over them, and each has its own interpreter lock,
+connection pool and notification listener. The supervisor itself serves no requests and holds
+no database connections.
+
+A worker that exits while the supervisor is not stopping is started again after
+WORKER_RESTART_DELAY seconds, a delay that doubles (up to 30 seconds) while workers keep dying
+within WORKER_MIN_UPTIME seconds of their start. On SIGTERM or SIGINT the supervisor sends
+SIGTERM to every worker, which drains: it stops accepting connections and finishes the requests
+in progress for up to WORKER_DRAIN_TIMEOUT seconds before it exits. Workers still running after
+that are killed.
+
+Metrics are shared through files in a directory: every worker writes its QMetrics.snapshot()
+there every WORKER_METRICS_INTERVAL seconds and renders /metrics from its own live snapshot and
+the files of the others. When a worker exits its counters are kept (without its gauges), so
+totals never go backwards across restarts.
+"""
+import glob
+import json
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from queue_metrics import DEFAULT_BUCKETS, render_snapshots
+
+WORKER_DRAIN_TIMEOUT = float(os.environ.get('WORKER_DRAIN_TIMEOUT', 30.0))
+WORKER_RESTART_DELAY = float(os.environ.get('WORKER_RESTART_DELAY', 1.0))
+WORKER_MIN_UPTIME = float(os.environ.get('WORKER_MIN_UPTIME', 5.0))
+WORKER_METRICS_INTERVAL = float(os.environ.get('WORKER_METRICS_INTERVAL', 1.0))
+
+RESTART_DELAY_MAX = 30.0
+
+
+def _write_json(path: str, data):
+    # readers never see a partly written file
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # removed or replaced by the supervisor while listing the directory
+        return None
+
+
+class QWorkerMetrics:
+    """
+    Publishes a worker's metrics snapshots for its siblings and renders all of them.
+    """
+    def __init__(self, directory: str, metrics, interval: float=WORKER_METRICS_INTERVAL):
+        self.directory = directory
+        self.metrics = metrics
+        self.interval = interval
+        self.path = os.path.join(directory, f'worker-{os.getpid()}.json')
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.publish()
+        self._thread = threading.Thread(target=self._run, name='worker-metrics', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.publish()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.publish()
+            except Exception:
+                logging.exception('Could not write the metrics snapshot %s', self.path)
+
+    def publish(self):
+        _write_json(self.path, self.metrics.snapshot())
+
+    def render(self) -> str:
+        snapshots = [self.metrics.snapshot()]
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.json'))):
+            if path != self.path:
+                snapshot = _read_json(path)
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+        return render_snapshots(snapshots)
+
+
+class QPreforkSupervisor:
+    """
+    Forks `workers` processes running target(index, metrics_dir) and keeps them running until
+    stopped.
+
+    target is called in the forked child and returns its exit status. It must return once the
+    process gets SIGTERM, after draining.
+    """
+    def __init__(self, target, workers: int, metrics_dir: str=None, drain_timeout: float=WORKER_DRAIN_TIMEOUT,
+                 restart_delay: float=WORKER_RESTART_DELAY, min_uptime: float=WORKER_MIN_UPTIME):
+        self.target = target
+        self.workers = workers
+        self.metrics_dir = metrics_dir
+        self.drain_timeout = drain_timeout
+        self.restart_delay = restart_delay
+        self.min_uptime = min_uptime
+        self.restarts = 0
+        self._own_metrics_dir = False
+        self._children = {}         # pid -> (index, start time)
+        self._restart_at = {}       # index -> monotonic time of the next start
+        self._delay = restart_delay
+        self._stopping = False
+
+    def _on_signal(self, signum, frame):
+        self._stopping = True
+
+    def run(self) -> int:
+        if self.metrics_dir is None:
+            self.metrics_dir = tempfile.mkdtemp(prefix='queue-metrics-')
+            self._own_metrics_dir = True
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        logging.info('Starting %d workers...', self.workers)
+        try:
+            for index in range(self.workers):
+                self._spawn(index)
+            while not self._stopping:
+                self._reap()
+                now = time.monotonic()
+                for index, at in list(self._restart_at.items()):
+                    if at <= now and not self._stopping:
+                        del self._restart_at[index]
+                        self._spawn(index)
+                # a signal cuts the sleep short
+                time.sleep(0.2)
+            self._shutdown()
+        finally:
+            if self._own_metrics_dir:
+                shutil.rmtree(self.metrics_dir, ignore_errors=True)
+        logging.info('All workers stopped')
+        return 0
+
+    def _spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                # Ctrl-C reaches the whole process group, the supervisor decides what it means
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                status = self.target(index, self.metrics_dir)
+            except BaseException:
+                logging.exception('Worker %d failed', index)
+            finally:
+                # never run the supervisor's cleanup (or atexit handlers) in a worker
+                os._exit(status or 0)
+        self._children[pid] = (index, time.monotonic())
+        self._publish_supervisor_metrics()
+        logging.info('Started worker %d (pid %d)', index, pid)
+
+    def _reap(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self._exited(pid, status)
+
+    def _exited(self, pid: int, status: int):
+        index, started = self._children.pop(pid, (None, None))
+        self._retire_metrics(pid)
+        if index is None or self._stopping:
+            return
+        if os.WIFSIGNALED(status):
+            reason = f'was killed by signal {os.WTERMSIG(status)}'
+        else:
+            reason = f'exited with status {os.WEXITSTATUS(status)}'
+        # back off while workers die right after starting (a bad configuration, an unreachable database)
+        if time.monotonic() - started < self.min_uptime:
+            self._delay = min(self._delay * 2, RESTART_DELAY_MAX)
+        else:
+            self._delay = self.restart_delay
+        logging.error('Worker %d (pid %d) %s, restarting it in %.1fs', index, pid, reason, self._delay)
+        self.restarts += 1
+        self._restart_at[index] = time.monotonic() + self._delay
+        self._publish_supervisor_metrics()
+
+    def _shutdown(self):
+        logging.info('Draining %d workers...', len(self._children))
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        # a little longer than the workers' own drain timeout, for closing pools and listeners
+        deadline = time.monotonic() + self.drain_timeout + 5.0
+        while self._children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid, (index, _) in list(self._children.items()):
+            logging.warning('Worker %d (pid %d) did not stop in time, killing it', index, pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            self._children.pop(pid)
+
+    def _retire_metrics(self, pid: int):
+        # keep the counters of an exited worker, its gauges described a process that is gone
+        path = os.path.join(self.metrics_dir, f'worker-{pid}.json')
+        snapshot = _read_json(path)
+        if snapshot is None:
+            return
+        snapshot['collected'] = [family for family in snapshot.get('collected', []) if family[1] != 'gauge']
+        _write_json(os.path.join(self.metrics_dir, f'retired-{pid}.json'), snapshot)
+        os.remove(path)
+
+    def _publish_supervisor_metrics(self):
+        _write_json(os.path.join(self.metrics_dir, 'supervisor.json'), {
+            'buckets': list(DEFAULT_BUCKETS),
+            'requests': [],
+            'errors': [],
+            'histograms': [],
+            'collected': [
+                ['queue_workers', 'gauge', 'Worker processes running under the pre-fork supervisor.',
+                 [[{}, len(self._children)]]],
+                ['queue_worker_restarts_total', 'counter', 'Worker processes restarted after exiting unexpectedly.',
+                 [[{}, self.restarts]]],
+            ],
+        })
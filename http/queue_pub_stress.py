@@ -1,5 +1,6 @@
 #! /usr/bin/env python3
 
+import os
 import queue_publisher as qpub
 import random
 import sys
@@ -13,7 +14,11 @@ max_messages = random.randrange(100, 10000)
 create = len(sys.argv) == 3
 
 
-qp = qpub.QPublisher()
+# PUB_BATCH_SIZE > 1 publishes through the buffered /publish_batch path
+batch_size = int(os.environ.get('PUB_BATCH_SIZE', 1))
+linger_ms = int(os.environ.get('PUB_LINGER_MS', 0))
+
+qp = qpub.QPublisher(batch_size=batch_size, linger_ms=linger_ms)
 if create:
     qp.create_topic(topic, f'testing messages with topic {topic}')
 
@@ -24,3 +29,4 @@ for mnum in range(1, max_messages):
     if random.randrange(1, 100) > 95:
         reset_count += 1
         qp.reset_topic(topic, random.randrange(1, mnum))
+qp.close()
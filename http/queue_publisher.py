@@ -4,10 +4,14 @@ from http import HTTPStatus
 import json
 import logging
 import os
-import requests
 import sys
+import threading
 import time
 
+from queue_compression import compress, response_encoding
+from queue_session import make_session, DEFAULT_POOL_SIZE, DEFAULT_RETRIES
+from queue_wire import FRAMES_CONTENT_TYPE, encode_messages
+
 PUBLISHER_URL = os.environ.get('PUBLISHER_URL', 'http://queues-server:8888')
 
 
@@ -20,8 +24,39 @@ class UnsubscribedError(Exception):
 
 
 class QPublisher:
-    def __init__(self, log_to_file=True):
+    """
+    Publisher client. With batch_size > 1 or linger_ms > 0 the publisher runs in buffered mode:
+    publish_message() queues messages per topic and they are sent with /publish_batch once
+    batch_size messages are waiting or the oldest waiting message is linger_ms old. Messages
+    published with a key are buffered per topic and key, so each batch lands in the key's partition.
+    A batch that fails to send stays buffered and is sent again by the next flush, so an error
+    raised by publish_message() or flush() does not lose messages, which must not be published again.
+    
+    With frames (the default) messages are sent in the binary framed format of queue_wire.py once
+    a response of the server has shown that it accepts it, and as JSON until then.
+
+    With compression (the default) request bodies of at least COMPRESS_MIN_BYTES are sent gzip or
+    deflate encoded once a response has listed the codings the server accepts (see
+    queue_compression.py).
+    """
+    def __init__(self, log_to_file=True, batch_size: int=1, linger_ms: int=0,
+                 pool_size: int=DEFAULT_POOL_SIZE, retries: int=DEFAULT_RETRIES, frames: bool=True,
+                 compression: bool=True):
         self.id = time.time()
+        self._session = make_session(pool_size, retries)
+        self.frames = frames
+        self._server_frames = False
+        self.compression = compression
+        # the server's Accept-Encoding, request bodies are not compressed before it is known
+        self._server_encodings = None
+        self.batch_size = max(1, batch_size)
+        self.linger_ms = max(0, linger_ms)
+        self._buffers = {}          # (topic, key) -> [messages]
+        self._buffer_ts = {}        # (topic, key) -> monotonic time of the oldest buffered message
+        self._buffer_lock = threading.RLock()
+        self._flush_error = None
+        self._closed = False
+        self._linger_thread = None
         
         logging_params = {'format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                           'level': logging.INFO}
@@ -33,15 +68,47 @@ class QPublisher:
         
         logging.basicConfig(**logging_params)
         self._log = logging.getLogger(__file__)
+
+        if self.buffered and self.linger_ms:
+            self._linger_thread = threading.Thread(target=self._linger_loop, name=f'publisher-linger-{self.id}', daemon=True)
+            self._linger_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def buffered(self) -> bool:
+        return self.batch_size > 1 or self.linger_ms > 0
     
     def _handle_request(self, url: str, data: dict, request_type: str='post'):
-        rmethod = getattr(requests, request_type)
         if request_type == 'post':
-            rargs = {'json': data}
+            res = self._post(url, json.dumps(data).encode('utf-8'), 'application/json')
         else:
-            rargs = {'params': data}
-        res = rmethod(url, **rargs)
+            res = self._session.get(url, params=data)
+        return self._handle_response(res)
+    
+    def _post_frames(self, url: str, params: dict, messages: list):
+        # framed messages in the body, the other parameters in the query string
+        res = self._post(url, encode_messages(messages), FRAMES_CONTENT_TYPE, params)
+        return self._handle_response(res)
+    
+    def _post(self, url: str, body: bytes, content_type: str, params: dict=None):
+        headers = {'Content-type': content_type}
+        encoding = response_encoding(self._server_encodings, len(body)) if self.compression else None
+        if encoding:
+            body = compress(body, encoding)
+            headers['Content-Encoding'] = encoding
+        return self._session.post(url, params=params, data=body, headers=headers)
+    
+    def _handle_response(self, res):
         res.raise_for_status()
+        if not self._server_frames and FRAMES_CONTENT_TYPE in res.headers.get('Accept-Post', ''):
+            self._server_frames = True
+        if self._server_encodings is None and 'Accept-Encoding' in res.headers:
+            self._server_encodings = res.headers['Accept-Encoding']
         
         if res.status_code == HTTPStatus.OK:
             if 'Content-type' in res.headers:
@@ -50,14 +117,24 @@ class QPublisher:
                 else:
                     raise ContentTypeError(f'Expected "application/json" but got {res.headers["Content-type"]}')
 
-    def create_topic(self, topic: str, description: str):
-        data = self._handle_request(f'{PUBLISHER_URL}/topic', {'topic': topic, 'description': description})
+    def create_topic(self, topic: str, description: str, **policy):
+        """
+        policy takes the optional partitions, segment_size, retention_ms, retention_messages and retention_acked settings,
+        and compression ('gzip' or 'deflate') to store the topic's large messages compressed
+        """
+        data = self._handle_request(f'{PUBLISHER_URL}/topic', dict(policy, topic=topic, description=description))
         self._log.info(f"Topic {data['topic']} created")
     
+    def set_retention(self, topic: str, retention_ms: int=None, retention_messages: int=None, retention_acked: bool=False):
+        params = {'topic': topic, 'retention_ms': retention_ms, 'retention_messages': retention_messages,
+                  'retention_acked': retention_acked}
+        return self._handle_request(f'{PUBLISHER_URL}/topic_retention', params)
+    
     def delete_topic(self, topic: str):
         data = self._handle_request(f'{PUBLISHER_URL}/topic_delete', {'topic': topic})
     
     def reset_topic(self, topic: str, offset: int):
+        self.flush(topic)
         data = self._handle_request(f'{PUBLISHER_URL}/topic_reset', {'topic': topic, 'offset': offset})
     
     def list_topics(self, topic: str=''):
@@ -68,16 +145,139 @@ class QPublisher:
         data = self._handle_request(f'{PUBLISHER_URL}/topics', topic_param, 'get')
         self._log.info(data)
         
-    def publish_message(self, topic: str, message: str):
-        data = self._handle_request(f'{PUBLISHER_URL}/publish', {'topic': topic, 'message': message})
+    def publish_message(self, topic: str, message: str, key: str=None):
+        """
+        Messages with the same key go to the same partition of the topic and keep their order,
+        messages without a key are spread over the partitions.
+        """
+        if not self.buffered:
+            params = {'topic': topic}
+            if key is not None:
+                params['key'] = key
+            if self.frames and self._server_frames:
+                data = self._post_frames(f'{PUBLISHER_URL}/publish', params, [message])
+            else:
+                params['message'] = message
+                data = self._handle_request(f'{PUBLISHER_URL}/publish', params)
+            return
+        
+        self._raise_flush_error()
+        with self._buffer_lock:
+            buffer_key = (topic, key)
+            buffer = self._buffers.setdefault(buffer_key, [])
+            if not buffer:
+                self._buffer_ts[buffer_key] = time.monotonic()
+            buffer.append(message)
+            if len(buffer) >= self.batch_size:
+                self._flush_buffer(buffer_key)
+    
+    def publish_many(self, topic: str, messages: list, key: str=None):
+        """
+        Publish a list of messages to a topic as one batch, all to the same partition. Returns the
+        server response with the partition and the first and last offsets assigned to the batch.
+        """
+        if not messages:
+            return None
+        params = {'topic': topic}
+        if key is not None:
+            params['key'] = key
+        if self.frames and self._server_frames:
+            return self._post_frames(f'{PUBLISHER_URL}/publish_batch', params, list(messages))
+        params['messages'] = list(messages)
+        return self._handle_request(f'{PUBLISHER_URL}/publish_batch', params)
+    
+    def _flush_buffer(self, buffer_key: tuple):
+        # called with self._buffer_lock held. The batch stays buffered until it is sent, so a failed
+        # send raises and the next flush sends the same messages again
+        messages = self._buffers.get(buffer_key)
+        if not messages:
+            self._buffers.pop(buffer_key, None)
+            self._buffer_ts.pop(buffer_key, None)
+            return
+        topic, key = buffer_key
+        data = self.publish_many(topic, messages, key)
+        del self._buffers[buffer_key]
+        self._buffer_ts.pop(buffer_key, None)
+        if data:
+            self._log.info(f"Published {data['count']} messages to topic {topic} partition {data.get('partition', 0)} "
+                           f"at offsets {data['first_offset']}-{data['last_offset']}")
+    
+    def flush(self, topic: str=None):
+        """
+        Send any buffered messages now, for one topic or for all topics.
+        """
+        with self._buffer_lock:
+            buffer_keys = [k for k in self._buffers if not topic or k[0] == topic]
+            for buffer_key in buffer_keys:
+                self._flush_buffer(buffer_key)
+            if not self._buffers:
+                # a failed background flush has been made up for
+                self._flush_error = None
+        self._raise_flush_error()
+    
+    def close(self):
+        self._closed = True
+        if self._linger_thread is not None:
+            self._linger_thread.join()
+            self._linger_thread = None
+        try:
+            self.flush()
+        finally:
+            self._session.close()
+    
+    def _raise_flush_error(self):
+        if self._flush_error is not None:
+            err, self._flush_error = self._flush_error, None
+            raise err
+    
+    def _linger_loop(self):
+        linger = self.linger_ms / 1000.0
+        while not self._closed:
+            time.sleep(min(linger, 0.05) or 0.05)
+            now = time.monotonic()
+            with self._buffer_lock:
+                expired = [k for k, ts in self._buffer_ts.items() if now - ts >= linger]
+                for buffer_key in expired:
+                    try:
+                        self._flush_buffer(buffer_key)
+                    except Exception as e:
+                        self._log.error(f'Background flush of topic {buffer_key[0]} failed: {e}')
+                        self._flush_error = e
+                        # the batch is still buffered, it is sent again after another linger_ms
+                        self._buffer_ts[buffer_key] = now
 
-    def list_messages(self, topic: str=''):
+    def list_messages(self, topic: str='', after_offset: int=None, limit: int=None, partition: int=None):
         if topic:
             topic_param = {'topic': topic}
         else:
             topic_param = {}
+        if partition is not None:
+            topic_param['partition'] = partition
+        if after_offset is not None:
+            topic_param['after_offset'] = after_offset
+        if limit is not None:
+            topic_param['limit'] = limit
         data = self._handle_request(f'{PUBLISHER_URL}/topic_messages', topic_param, 'get')
         self._log.info(data)
+        return data
+    
+    def iter_messages(self, topic: str='', after_offset: int=None, partition: int=None):
+        """
+        Yield every message (optionally of one topic or topic partition, after an offset) from the
+        streaming /topic_messages route without holding the whole list in memory on either side.
+        """
+        params = {'stream': 1}
+        if topic:
+            params['topic'] = topic
+        if partition is not None:
+            params['partition'] = partition
+        if after_offset is not None:
+            params['after_offset'] = after_offset
+        with self._session.get(f'{PUBLISHER_URL}/topic_messages', params=params, stream=True) as res:
+            res.raise_for_status()
+            for line in res.iter_lines():
+                if line:
+                    yield json.loads(line)
         
     def list_subscribers(self, topic: str=''):
         if topic:
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Background retention for topic_message.
+
+topic_message is partitioned per topic and every topic partition is split into segments of
+segment_size offsets. On every run the worker calls topic_retention() once per topic, each in
+its own short transaction. That drops the oldest segments that are past the topic's retention
+policy (retention_ms, retention_messages, retention_acked) and creates the next segment ahead
+of the publishers. Segments are dropped whole, never deleted row by row, and the database side
+gives up on any lock it cannot get within lock_timeout, so a run never stalls publishers or
+readers; whatever it skipped is retried on the next run.
+"""
+import logging
+import os
+import threading
+import time
+
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 30.0))
+RETENTION_MAX_SEGMENTS = int(os.environ.get('RETENTION_MAX_SEGMENTS', 10))
+
+TOPICS_SQL = """select topic from topic order by topic;"""
+RETENTION_SQL = """select * from topic_retention(%s, %s);"""
+
+
+class RetentionStats:
+    """
+    Counters shared by the threaded worker and the asyncio engine's retention task.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.errors = 0
+        self.segments_dropped = 0
+        self.rows_reclaimed = 0
+        self.bytes_reclaimed = 0
+        self.last_run_seconds = 0.0
+
+    def record(self, row: dict):
+        with self._lock:
+            self.segments_dropped += row['segments_dropped'] or 0
+            self.rows_reclaimed += row['rows_reclaimed'] or 0
+            self.bytes_reclaimed += row['bytes_reclaimed'] or 0
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def record_run(self, seconds: float):
+        with self._lock:
+            self.runs += 1
+            self.last_run_seconds = seconds
+
+    def metrics(self) -> list:
+        """
+        Collector for QMetrics.register_collector().
+        """
+        with self._lock:
+            return [
+                ('queue_retention_runs_total', 'counter', 'Completed retention runs.', [({}, self.runs)]),
+                ('queue_retention_errors_total', 'counter', 'Topics whose retention failed during a run.', [({}, self.errors)]),
+                ('queue_retention_segments_dropped_total', 'counter', 'Message segments dropped by retention.',
+                 [({}, self.segments_dropped)]),
+                ('queue_retention_rows_reclaimed_total', 'counter', 'Messages removed by retention.',
+                 [({}, self.rows_reclaimed)]),
+                ('queue_retention_bytes_reclaimed_total', 'counter', 'Bytes of table and index storage freed by retention.',
+                 [({}, self.bytes_reclaimed)]),
+                ('queue_retention_last_run_seconds', 'gauge', 'Duration of the last retention run.',
+                 [({}, self.last_run_seconds)]),
+            ]
+
+
+class QRetentionWorker:
+    """
+    Runs retention every interval seconds on a daemon thread, using connections from a QConnectionPool.
+    """
+    def __init__(self, db_pool, interval: float=RETENTION_INTERVAL, max_segments: int=RETENTION_MAX_SEGMENTS,
+                 stats: RetentionStats=None):
+        self.db_pool = db_pool
+        self.interval = interval
+        self.max_segments = max_segments
+        self.stats = stats or RetentionStats()
+        self._stop = threading.Event()
+        self._thread = None
+        self._log = logging.getLogger(__name__)
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='retention-worker', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self):
+        start = time.monotonic()
+        with self.db_pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(TOPICS_SQL)
+                topics = [row['topic'] for row in cur.fetchall()]
+        for topic in topics:
+            if self._stop.is_set():
+                break
+            try:
+                with self.db_pool.connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(RETENTION_SQL, (topic, self.max_segments))
+                        row = cur.fetchone()
+            except Exception as e:
+                self.stats.record_error()
+                self._log.error(f'Retention failed for topic {topic}: {e}')
+                continue
+            if row:
+                self.stats.record(row)
+                if row['segments_dropped']:
+                    self._log.info(f'Retention dropped {row["segments_dropped"]} segments ({row["rows_reclaimed"]} messages, '
+                                   f'{row["bytes_reclaimed"]} bytes) of topic {topic}')
+        self.stats.record_run(time.monotonic() - start)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self.stats.record_error()
+                self._log.error(f'Retention run failed: {e}')
@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+"""
+Embedded storage backend: an append-only segment log per topic partition in local files.
+
+Layout under the data directory::
+
+    topics/<topic>/topic.json                    description, partitions, segment_size
+    topics/<topic>/<partition>/<base>.log        messages from offset <base> on
+    topics/<topic>/<partition>/<base>.idx        sparse index of a closed segment
+    subscribers.json                             subscriber offsets checkpoint
+
+A message is stored as a header (id int64, offset int64, publish_ts in microseconds int64,
+length uint32, all big endian) followed by the UTF-8 payload. Segments are appended with
+unbuffered writes and read through mmap, remapped when the active segment has grown past the
+mapped length. A segment rolls over once it holds the topic's segment_size messages or
+SEGMENT_LOG_BYTES bytes.
+
+The sparse index holds the file position of every SEGMENT_LOG_INDEX_INTERVAL-th message of a
+segment, so a read from any offset jumps straight to the index entry at
+(offset - base) // interval and skips fewer than interval headers from there. The index of the
+active segment is kept in memory and rebuilt on startup by scanning the segment, which also
+cuts off a message torn by a crash; a closed segment's index is written when it rolls over.
+
+Subscriber offsets are held in memory and written to subscribers.json (a new file renamed over
+the old one). Durable acks write it before they return, coalesced acks are written every
+SEGMENT_LOG_CHECKPOINT_MS milliseconds, so a crash redelivers what was acked since. With
+SEGMENT_LOG_FSYNC=1 segment appends and checkpoints are fsynced, otherwise they survive a
+crash of the server process but not of the machine.
+
+Consumer groups, retention policies and the listing routes need the postgres storage. Keys
+pick a partition by crc32, not by the hash the database uses, and a message id is unique per
+data directory rather than per database.
+"""
+from array import array
+import bisect
+from datetime import datetime, timezone
+import itertools
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import threading
+from urllib.parse import quote, unquote
+import zlib
+
+from queue_notify import PUBLISH_CHANNEL, TOPIC_CHANGE_CHANNEL
+from queue_storage import (InvalidTopicError, QStorage, StorageError, StorageNotSupportedError, TopicExistsError,
+                           TopicNotFoundError)
+from queue_wire import EPOCH, MICROSECOND
+
+SEGMENT_LOG_DIR = os.environ.get('SEGMENT_LOG_DIR', 'queue-data')
+SEGMENT_LOG_BYTES = int(os.environ.get('SEGMENT_LOG_BYTES', 64 * 1024 * 1024))
+SEGMENT_LOG_INDEX_INTERVAL = int(os.environ.get('SEGMENT_LOG_INDEX_INTERVAL', 64))
+SEGMENT_LOG_CHECKPOINT_MS = float(os.environ.get('SEGMENT_LOG_CHECKPOINT_MS', 1000))
+SEGMENT_LOG_FSYNC = os.environ.get('SEGMENT_LOG_FSYNC', '0').lower() in ('1', 'true', 'yes')
+
+# the same defaults and limits as get_message() and ack_fetch()
+GET_MESSAGE_MAX = 20
+ACK_FETCH_MAX = 1000
+# NAME_MAX of common filesystems, for the escaped name of a topic directory
+TOPIC_NAME_MAX_BYTES = 255
+
+_HEADER = struct.Struct('>qqqI')
+_INDEX_ENTRY = array('Q').itemsize
+
+
+class _Segment:
+    __slots__ = ('base', 'path', 'count', 'size', 'positions', '_fd', '_map')
+
+    def __init__(self, base: int, path: str):
+        self.base = base            # offset of the first message
+        self.path = path
+        self.count = 0
+        self.size = 0
+        self.positions = array('Q')  # file position of message base + i * interval
+        self._fd = None
+        self._map = None
+
+    @property
+    def next_offset(self) -> int:
+        return self.base + self.count
+
+    def view(self, end: int) -> mmap.mmap:
+        # the active segment grows, so it is mapped again once a read goes past the mapped length
+        if self._map is None or len(self._map) < end:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDONLY)
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class _Partition:
+    def __init__(self, path: str, partition: int):
+        self.path = path
+        self.partition = partition
+        self.lock = threading.Lock()
+        self.segments = []          # by base offset
+        self.bases = []
+        self._append_fd = None
+
+    @property
+    def head(self) -> int:
+        # offset of the newest message, 0 before the first publish like topic_partition.head_offset
+        return self.segments[-1].next_offset - 1 if self.segments else 0
+
+    def close(self):
+        if self._append_fd is not None:
+            os.close(self._append_fd)
+            self._append_fd = None
+        for segment in self.segments:
+            segment.close()
+
+
+class _Topic:
+    def __init__(self, topic: str, path: str, meta: dict):
+        self.topic = topic
+        self.path = path
+        self.meta = meta
+        self.partitions = [_Partition(os.path.join(path, str(p)), p) for p in range(meta['partitions'])]
+        self.round_robin = itertools.count()
+
+
+class QSegmentLogStorage(QStorage):
+    name = 'segment_log'
+
+    def __init__(self, data_dir: str=SEGMENT_LOG_DIR, segment_bytes: int=SEGMENT_LOG_BYTES,
+                 index_interval: int=SEGMENT_LOG_INDEX_INTERVAL, checkpoint_ms: float=SEGMENT_LOG_CHECKPOINT_MS,
+                 fsync: bool=SEGMENT_LOG_FSYNC):
+        self.data_dir = data_dir
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.checkpoint_ms = checkpoint_ms
+        self.fsync = fsync
+        # notify(channel, payload) announces publishes and topic changes like the database's NOTIFY
+        self.notify = None
+
+        self._lock = threading.RLock()
+        self._topics = {}
+        self._subscribers = {}
+        self._next_subscriber_id = 1
+        self._next_message_id = 1
+        self._dirty = False
+        self._checkpoint_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._log = logging.getLogger(__name__)
+
+        self.appended = 0
+        self.segments_rolled = 0
+        self.checkpoints = 0
+
+        os.makedirs(os.path.join(self.data_dir, 'topics'), exist_ok=True)
+        self._load()
+        if self.checkpoint_ms > 0:
+            self._thread = threading.Thread(target=self._run, name='segment-log-checkpoint', daemon=True)
+            self._thread.start()
+
+    # topics
+
+    def topic_create(self, topic: str, description: str, partitions: int=None, segment_size: int=None,
+                     retention_ms: int=None, retention_messages: int=None, retention_acked: bool=False,
+                     compression: str=None) -> str:
+        if retention_ms or retention_messages or retention_acked:
+            raise StorageNotSupportedError(f'Retention policies need the postgres storage, not {self.name}')
+        if compression:
+            raise StorageNotSupportedError(f'Compressed topics need the postgres storage, not {self.name}')
+        with self._lock:
+            if topic in self._topics:
+                raise TopicExistsError(f'The topic "{topic}" already exists')
+            path = self._topic_path(topic)
+            if len(os.path.basename(path).encode('utf-8')) > TOPIC_NAME_MAX_BYTES:
+                raise InvalidTopicError(f'The topic name "{topic}" is too long for the {self.name} storage')
+            meta = {'topic': topic, 'description': description, 'partitions': partitions or 1,
+                    'segment_size': segment_size or 100000, 'create_ts': datetime.now(timezone.utc).isoformat()}
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                raise StorageError(f'Cannot create the directory of topic "{topic}": {e.strerror}')
+            try:
+                for p in range(meta['partitions']):
+                    os.makedirs(os.path.join(path, str(p)))
+                self._write_file(os.path.join(path, 'topic.json'), json.dumps(meta).encode('utf-8'))
+            except OSError as e:
+                shutil.rmtree(path, ignore_errors=True)
+                raise StorageError(f'Cannot create the files of topic "{topic}": {e.strerror}')
+            self._topics[topic] = _Topic(topic, path, meta)
+        return topic
+
+    def topic_delete(self, topic: str) -> str:
+        with self._lock:
+            target = self._topics.pop(topic, None)
+            if target is None:
+                return None
+            for subscriber_id in [i for i, row in self._subscribers.items() if row['topic'] == topic]:
+                del self._subscribers[subscriber_id]
+            for partition in target.partitions:
+                with partition.lock:
+                    partition.close()
+            shutil.rmtree(target.path, ignore_errors=True)
+            self._checkpoint()
+        self._notify(TOPIC_CHANGE_CHANNEL, {'topic': topic, 'event': 'delete'})
+        return topic
+
+    def topic_reset(self, topic: str, offset: int) -> int:
+        with self._lock:
+            count = 0
+            for row in self._subscribers.values():
+                if row['topic'] == topic:
+                    row['_offsets'] = [offset] * len(row['_offsets'])
+                    row['action_ts'] = datetime.now(timezone.utc)
+                    count += 1
+            self._checkpoint()
+        self._notify(TOPIC_CHANGE_CHANNEL, {'topic': topic, 'event': 'reset'})
+        return count
+
+    # publishing
+
+    def append(self, topic: str, message: str, key: str=None) -> dict:
+        target, partition = self._pick_partition(topic, key)
+        rows = self._append(target, partition, [message])
+        return rows[0]
+
+    def append_batch(self, topic: str, messages: list, key: str=None) -> dict:
+        if not messages:
+            return None
+        target, partition = self._pick_partition(topic, key)
+        rows = self._append(target, partition, messages)
+        return {'_partition': partition.partition, 'first_offset': rows[0]['_offset'], 'last_offset': rows[-1]['_offset']}
+
+    # subscribers
+
+    def subscribe(self, topic: str, group: str=None, partitions: list=None, ack_mode: str=None) -> int:
+        if group is not None:
+            raise StorageNotSupportedError(f'Consumer groups need the postgres storage, not {self.name}')
+        with self._lock:
+            target = self._topic(topic)
+            count = len(target.partitions)
+            if not partitions:
+                partitions = list(range(count))
+            elif any(p is None or p < 0 or p >= count for p in partitions):
+                raise ValueError(f'Topic "{topic}" has partitions 0 to {count - 1}')
+            subscriber_id = self._next_subscriber_id
+            self._next_subscriber_id += 1
+            self._subscribers[subscriber_id] = {
+                'id': subscriber_id, 'topic': topic, '_offsets': [p.head for p in target.partitions],
+                'partitions': sorted(set(partitions)), 'group_id': None, 'ack_mode': ack_mode or 'durable',
+                'action_ts': datetime.now(timezone.utc)}
+            self._checkpoint()
+        return subscriber_id
+
+    def unsubscribe(self, subscriber_id: int) -> int:
+        with self._lock:
+            if self._subscribers.pop(subscriber_id, None) is None:
+                return None
+            self._checkpoint()
+        return subscriber_id
+
+    def subscriber(self, subscriber_id: int) -> dict:
+        with self._lock:
+            row = self._subscribers.get(subscriber_id)
+            return dict(row, _offsets=list(row['_offsets'])) if row is not None else None
+
+    def fetch(self, subscriber_id: int, num_messages: int, pending_partitions: list=(), pending_offsets: list=()) -> list:
+        row = self.subscriber(subscriber_id)
+        if row is None:
+            return []
+        offsets = row['_offsets']
+        for partition, offset in zip(pending_partitions, pending_offsets):
+            if 0 <= partition < len(offsets):
+                offsets[partition] = max(offsets[partition], offset)
+        return self._read(row['topic'], row['partitions'], offsets, max(1, min(num_messages, GET_MESSAGE_MAX)))
+
+    def ack(self, subscriber_id: int, offset: int, partition: int=0, ack_mode: str=None) -> dict:
+        with self._lock:
+            row = self._subscribers.get(subscriber_id)
+            if row is None or partition not in row['partitions']:
+                return None
+            row['_offsets'][partition] = offset
+            row['action_ts'] = datetime.now(timezone.utc)
+            if (ack_mode or row['ack_mode']) == 'durable':
+                self._checkpoint()
+            else:
+                self._dirty = True
+            return dict(row, _offsets=list(row['_offsets']))
+
+    def ack_fetch(self, subscriber_id: int, partitions: list, offsets: list, num_messages: int) -> list:
+        with self._lock:
+            row = self._subscribers.get(subscriber_id)
+            if row is None:
+                return []
+            if offsets:
+                for partition, offset in zip(partitions, offsets):
+                    if 0 <= partition < len(row['_offsets']):
+                        row['_offsets'][partition] = offset
+                row['action_ts'] = datetime.now(timezone.utc)
+                if row['ack_mode'] == 'durable':
+                    self._checkpoint()
+                else:
+                    self._dirty = True
+            topic, subscribed, current = row['topic'], row['partitions'], list(row['_offsets'])
+        return self._read(topic, subscribed, current, max(1, min(num_messages, ACK_FETCH_MAX)))
+
+    def lag(self, topic: str=None) -> list:
+        with self._lock:
+            subscribers = sorted((row['topic'], row['id'], list(row['partitions']), list(row['_offsets']))
+                                 for row in self._subscribers.values() if topic is None or row['topic'] == topic)
+            targets = {name: self._topics[name] for name, _, _, _ in subscribers}
+        rows = []
+        for name, subscriber_id, partitions, offsets in subscribers:
+            target = targets[name]
+            for p in partitions:
+                partition = target.partitions[p]
+                head, committed = partition.head, offsets[p]
+                oldest = None
+                if head > committed:
+                    found = self._read_partition(target, partition, committed, 1)
+                    oldest = found[0]['publish_ts'] if found else None
+                rows.append({'topic': name, 'subscriber_id': subscriber_id, 'group_name': None, '_partition': p,
+                             'head_offset': head, 'committed_offset': committed, 'lag': max(0, head - committed),
+                             'oldest_unacked_ts': oldest})
+        return rows
+
+    def metrics(self) -> list:
+        """
+        Collector for QMetrics.register_collector().
+        """
+        with self._lock:
+            partitions = [p for t in self._topics.values() for p in t.partitions]
+        segments = sum(len(p.segments) for p in partitions)
+        size = sum(s.size for p in partitions for s in p.segments)
+        return [
+            ('queue_segment_log_messages_appended_total', 'counter', 'Messages appended to the segment log.',
+             [({}, self.appended)]),
+            ('queue_segment_log_segments_rolled_total', 'counter', 'Segments closed because they were full.',
+             [({}, self.segments_rolled)]),
+            ('queue_segment_log_checkpoints_total', 'counter', 'Writes of the subscriber offsets checkpoint.',
+             [({}, self.checkpoints)]),
+            ('queue_segment_log_segments', 'gauge', 'Segment files of all topic partitions.', [({}, segments)]),
+            ('queue_segment_log_bytes', 'gauge', 'Size of all segment files.', [({}, size)]),
+        ]
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._checkpoint()
+            for target in self._topics.values():
+                for partition in target.partitions:
+                    with partition.lock:
+                        partition.close()
+
+    # internals
+
+    def _notify(self, channel: str, payload: dict):
+        if self.notify is not None:
+            self.notify(channel, payload)
+
+    def _topic_path(self, topic: str) -> str:
+        # dots are escaped too, so no topic is named like "." or ".." on disk
+        return os.path.join(self.data_dir, 'topics', quote(topic, safe='').replace('.', '%2E'))
+
+    def _topic(self, topic: str) -> _Topic:
+        target = self._topics.get(topic)
+        if target is None:
+            raise TopicNotFoundError(f'Topic "{topic}" does not exist')
+        return target
+
+    def _pick_partition(self, topic: str, key: str=None) -> tuple:
+        with self._lock:
+            target = self._topic(topic)
+        count = len(target.partitions)
+        if count == 1:
+            index = 0
+        elif key is not None:
+            index = zlib.crc32(key.encode('utf-8')) % count
+        else:
+            index = next(target.round_robin) % count
+        return target, target.partitions[index]
+
+    def _append(self, target: _Topic, partition: _Partition, messages: list) -> list:
+        micros = (datetime.now(timezone.utc) - EPOCH) // MICROSECOND
+        publish_ts = EPOCH + micros * MICROSECOND
+        rows = []
+        with partition.lock:
+            if target.topic not in self._topics:
+                raise TopicNotFoundError(f'Topic "{target.topic}" does not exist')
+            with self._lock:
+                first_id = self._next_message_id
+                self._next_message_id += len(messages)
+            for i, message in enumerate(messages):
+                segment = self._writable_segment(target, partition)
+                offset = segment.next_offset
+                data = message.encode('utf-8')
+                record = _HEADER.pack(first_id + i, offset, micros, len(data)) + data
+                if segment.count % self.index_interval == 0:
+                    segment.positions.append(segment.size)
+                os.write(partition._append_fd, record)
+                segment.size += len(record)
+                segment.count += 1
+                rows.append({'id': first_id + i, 'topic': target.topic, '_partition': partition.partition,
+                             '_offset': offset, 'message': message, 'publish_ts': publish_ts})
+            if self.fsync:
+                os.fsync(partition._append_fd)
+            head = partition.head
+        self.appended += len(messages)
+        self._notify(PUBLISH_CHANNEL, {'topic': target.topic, 'partition': partition.partition, 'offset': head})
+        return rows
+
+    def _writable_segment(self, target: _Topic, partition: _Partition) -> _Segment:
+        # called with partition.lock held
+        segment = partition.segments[-1] if partition.segments else None
+        if segment is not None and (segment.count >= target.meta['segment_size'] or segment.size >= self.segment_bytes):
+            self._close_segment(partition, segment)
+            self.segments_rolled += 1
+            segment = None
+        if segment is None:
+            base = partition.segments[-1].next_offset if partition.segments else 1
+            segment = _Segment(base, os.path.join(partition.path, f'{base:020d}.log'))
+            partition.segments.append(segment)
+            partition.bases.append(base)
+        if partition._append_fd is None:
+            partition._append_fd = os.open(segment.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return segment
+
+    def _close_segment(self, partition: _Partition, segment: _Segment):
+        if partition._append_fd is not None:
+            if self.fsync:
+                os.fsync(partition._append_fd)
+            os.close(partition._append_fd)
+            partition._append_fd = None
+        self._write_file(segment.path[:-len('.log')] + '.idx', segment.positions.tobytes())
+
+    def _read(self, topic: str, partitions: list, offsets: list, num_messages: int) -> list:
+        with self._lock:
+            target = self._topics.get(topic)
+        if target is None:
+            return []
+        found = []
+        for p in partitions:
+            found.extend(self._read_partition(target, target.partitions[p], offsets[p], num_messages))
+        found.sort(key=lambda row: (row['_offset'], row['_partition']))
+        return found[:num_messages]
+
+    def _read_partition(self, target: _Topic, partition: _Partition, after: int, limit: int) -> list:
+        rows = []
+        with partition.lock:
+            if not partition.segments or after >= partition.head:
+                return rows
+            offset = max(after + 1, partition.bases[0])
+            i = bisect.bisect_right(partition.bases, offset) - 1
+            while len(rows) < limit and i < len(partition.segments):
+                segment = partition.segments[i]
+                if offset >= segment.next_offset:
+                    i += 1
+                    continue
+                view = segment.view(segment.size)
+                # O(1) jump to the nearest indexed message, then skip headers up to offset
+                relative = offset - segment.base
+                pos = segment.positions[relative // self.index_interval]
+                for _ in range(relative % self.index_interval):
+                    pos += _HEADER.size + _HEADER.unpack_from(view, pos)[3]
+                while len(rows) < limit and pos < segment.size:
+                    message_id, message_offset, micros, length = _HEADER.unpack_from(view, pos)
+                    pos += _HEADER.size
+                    rows.append({'id': message_id, 'topic': target.topic, '_partition': partition.partition,
+                                 '_offset': message_offset, 'message': str(view[pos:pos + length], 'utf-8'),
+                                 'publish_ts': EPOCH + micros * MICROSECOND})
+                    pos += length
+                    offset = message_offset + 1
+                i += 1
+        return rows
+
+    def _load(self):
+        path = os.path.join(self.data_dir, 'subscribers.json')
+        checkpoint = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                checkpoint = json.loads(f.read().decode('utf-8'))
+        self._next_subscriber_id = checkpoint.get('next_subscriber_id', 1)
+        self._next_message_id = checkpoint.get('next_message_id', 1)
+        topics_dir = os.path.join(self.data_dir, 'topics')
+        for name in sorted(os.listdir(topics_dir)):
+            topic_path = os.path.join(topics_dir, name)
+            meta_path = os.path.join(topic_path, 'topic.json')
+            if not os.path.exists(meta_path):
+                continue
+            with open(meta_path, 'rb') as f:
+                meta = json.loads(f.read().decode('utf-8'))
+            target = _Topic(unquote(name), topic_path, meta)
+            for partition in target.partitions:
+                self._load_partition(partition)
+            self._topics[target.topic] = target
+        for row in checkpoint.get('subscribers', []):
+            if row['topic'] in self._topics:
+                row['action_ts'] = datetime.fromisoformat(row['action_ts'])
+                self._subscribers[row['id']] = row
+        self._log.info(f'Opened segment log {self.data_dir} with {len(self._topics)} topics and '
+                       f'{len(self._subscribers)} subscribers')
+
+    def _load_partition(self, partition: _Partition):
+        os.makedirs(partition.path, exist_ok=True)
+        names = sorted(name for name in os.listdir(partition.path) if name.endswith('.log'))
+        for n, name in enumerate(names):
+            segment = _Segment(int(name[:-len('.log')]), os.path.join(partition.path, name))
+            segment.size = os.path.getsize(segment.path)
+            index_path = segment.path[:-len('.log')] + '.idx'
+            if n < len(names) - 1 and os.path.exists(index_path):
+                with open(index_path, 'rb') as f:
+                    segment.positions.frombytes(f.read())
+                segment.count = int(names[n + 1][:-len('.log')]) - segment.base
+            else:
+                self._scan(segment)
+            partition.segments.append(segment)
+            partition.bases.append(segment.base)
+
+    def _scan(self, segment: _Segment):
+        # rebuilds the index and count of a segment, dropping a message torn by a crash at its end
+        pos = 0
+        if segment.size:
+            view = segment.view(segment.size)
+            while pos + _HEADER.size <= segment.size:
+                message_id, _, _, length = _HEADER.unpack_from(view, pos)
+                if pos + _HEADER.size + length > segment.size:
+                    break
+                if segment.count % self.index_interval == 0:
+                    segment.positions.append(pos)
+                segment.count += 1
+                self._next_message_id = max(self._next_message_id, message_id + 1)
+                pos += _HEADER.size + length
+            segment.close()
+        if pos != segment.size:
+            self._log.warning(f'Truncating {segment.size - pos} bytes of a torn message from {segment.path}')
+            os.truncate(segment.path, pos)
+            segment.size = pos
+
+    def _checkpoint(self):
+        # called with self._lock held
+        subscribers = [dict(row, action_ts=row['action_ts'].isoformat()) for row in self._subscribers.values()]
+        data = json.dumps({'next_subscriber_id': self._next_subscriber_id, 'next_message_id': self._next_message_id,
+                           'subscribers': subscribers}).encode('utf-8')
+        self._dirty = False
+        with self._checkpoint_lock:
+            self._write_file(os.path.join(self.data_dir, 'subscribers.json'), data)
+            self.checkpoints += 1
+
+    def _write_file(self, path: str, data: bytes):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _run(self):
+        while not self._stop.wait(self.checkpoint_ms / 1000.0):
+            try:
+                with self._lock:
+                    if self._dirty:
+                        self._checkpoint()
+            except OSError as e:
+                self._log.error(f'Subscriber checkpoint failed: {e}')
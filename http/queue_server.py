@@ -8,52 +8,453 @@ This is code taken from https://gist.github.com/mdonkers/63e115cc0c79b4f6b8b3a6b
 and modified. This was chosen for simplicity in order to complete the project requirements
 in a timely manner.
 """
+from contextlib import contextmanager
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
 import logging
 import os
-from psycopg2 import connect as db_connect
-from psycopg2.extras import RealDictCursor
-import psycopg2.errors
+import signal
+import socket
+import threading
+import time
+import zlib
 from urllib.parse import urlparse, parse_qs, unquote_plus
 
 from IPython import embed
 
+from queue_admission import (ADMISSION_ACCEPT_BACKLOG, ADMISSION_EXEMPT_ROUTES, ADMISSION_RETRY_AFTER, QAdmission,
+                             QTopicLimiter, retry_after)
+from queue_acks import ACK_FLUSH_MS, ACK_MODES, QAckCoalescer, QAckFlushWorker, highest_offsets
+from queue_cache import TAIL_CACHE_BYTES, QTailCache
+from queue_compression import ACCEPT_ENCODING, ENCODINGS, compress, compressor, decompress, plain_rows, response_encoding
+from queue_db_pool import QConnectionPool, PoolTimeoutError
+from queue_lag import QLagCache, lag_report
+from queue_listing import is_stream_request, list_query, next_page
+from queue_logging import PER_REQUEST, logging_metrics, setup_logging, stop_logging
+from queue_metrics import QMetrics
+from queue_retention import QRetentionWorker
+from queue_segment_log import SEGMENT_LOG_DIR, QSegmentLogStorage
+from queue_statements import HOT_STATEMENTS
+from queue_stream import (STREAM_CREDIT_POLL_MS, STREAM_CREDITS, STREAM_FORMATS, STREAM_HEARTBEAT_MS, STREAM_MAX_CREDITS,
+                          QStreamRegistry, QStreamWindow, encode_events, heartbeat, stream_format)
+from queue_storage import (InvalidTopicError, QPostgresStorage, QStorage, StorageError, StorageNotSupportedError,
+                           TopicExistsError, TopicNotFoundError)
+from queue_wire import (ACCEPT_POST, ENCODED_FRAMES_CONTENT_TYPE, FRAMES_CONTENT_TYPE, accepts_encoded_frames, accepts_frames,
+                        decode_messages, encode_rows)
+from queue_notify import PUBLISH_CHANNEL, TOPIC_CHANGE_CHANNEL, QLocalDispatcher, QNotificationDispatcher
+from queue_prefork import WORKER_DRAIN_TIMEOUT, QPreforkSupervisor, QWorkerMetrics
+
 DEFAULT_PORT=8888
 
 # default is to use the docker networking from docker-compose
 DB_URI = os.environ.get('DB_URI', 'postgresql://queues@db:5432/queues')
 
+# postgres, or segment_log for the embedded storage in SEGMENT_LOG_DIR (see queue_segment_log.py)
+QUEUE_STORAGE = os.environ.get('QUEUE_STORAGE', 'postgres')
+STORAGE_BACKENDS = ('postgres', 'segment_log')
+
+# connection pool sizing shared by all request threads
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 2))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 20))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5.0))
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', 3600.0))
+
+# largest number of messages accepted by a single /publish_batch request
+PUBLISH_BATCH_MAX = int(os.environ.get('PUBLISH_BATCH_MAX', 1000))
+
+# largest number of partitions a topic may be created with
+TOPIC_MAX_PARTITIONS = 1024
+
+# longest a /get_message request may be parked waiting for a publish
+GET_MESSAGE_MAX_WAIT_MS = int(os.environ.get('GET_MESSAGE_MAX_WAIT_MS', 30000))
+
+# most messages get_message() returns per call
+GET_MESSAGE_MAX = 20
+
+# rows fetched per round trip when streaming a list route
+STREAM_FETCH_SIZE = int(os.environ.get('STREAM_FETCH_SIZE', 500))
+
+# seconds an idle keep-alive connection (and its thread) is kept open
+KEEPALIVE_TIMEOUT = float(os.environ.get('KEEPALIVE_TIMEOUT', 75.0))
+
+# worker processes sharing the port (see queue_prefork.py), 1 serves from this process
+QUEUE_WORKERS = int(os.environ.get('QUEUE_WORKERS', 1))
+
+
+class QHTTPServer(ThreadingHTTPServer):
+    """
+    Threading HTTP server that owns the resources shared by all request handler threads.
+    """
+    daemon_threads = True
+    # connections the kernel queues until they are accepted, past that new connections are refused
+    request_queue_size = ADMISSION_ACCEPT_BACKLOG
+
+    def __init__(self, server_address, handler_class, db_pool: QConnectionPool=None,
+                 dispatcher: QNotificationDispatcher=None, retention: QRetentionWorker=None,
+                 tail_cache: QTailCache=None, acks: QAckFlushWorker=None, storage: QStorage=None,
+                 reuse_port: bool=False, storage_backend: str=None):
+        # pre-fork workers all bind the same port, the kernel balances connections between them
+        self.reuse_port = reuse_port
+        # requests being handled, and whether the server is finishing them before it closes
+        self.draining = False
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+        # bounds the connection threads and the requests handled at once, see queue_admission.py
+        self.admission = QAdmission()
+        self.topic_limiter = QTopicLimiter()
+        super().__init__(server_address, handler_class)
+        # an explicit storage_backend (the --storage flag) wins over the QUEUE_STORAGE env var
+        if storage is None and (storage_backend or QUEUE_STORAGE) == 'segment_log':
+            storage = QSegmentLogStorage(SEGMENT_LOG_DIR)
+        if storage is None:
+            if db_pool is None:
+                from psycopg2.extras import RealDictCursor
+                db_pool = QConnectionPool(DB_URI,
+                                          min_size=DB_POOL_MIN_SIZE,
+                                          max_size=DB_POOL_MAX_SIZE,
+                                          acquire_timeout=DB_POOL_TIMEOUT,
+                                          max_lifetime=DB_POOL_MAX_LIFETIME,
+                                          prepared=HOT_STATEMENTS,
+                                          cursor_factory=RealDictCursor)
+            storage = QPostgresStorage(db_pool)
+        self.storage = storage
+        # None with storage that has no database, the routes that need one answer 501 then
+        self.db_pool = storage.db_pool
+        # segment logs are read from memory maps already, a second copy of their tails would not help
+        self.tail_cache = tail_cache or QTailCache(max_bytes=0 if self.db_pool is None else TAIL_CACHE_BYTES)
+        if dispatcher is None:
+            channels = (PUBLISH_CHANNEL, TOPIC_CHANGE_CHANNEL)
+            dispatcher = QNotificationDispatcher(DB_URI, channels=channels) if self.db_pool is not None else QLocalDispatcher(channels)
+        self.dispatcher = dispatcher
+        if isinstance(dispatcher, QLocalDispatcher):
+            storage.notify = dispatcher.notify
+        self.dispatcher.add_listener(self._on_notify)
+        self.dispatcher.start()
+        if retention is None and self.db_pool is not None:
+            retention = QRetentionWorker(self.db_pool)
+        self.retention = retention
+        if self.retention is not None:
+            self.retention.start()
+        if acks is None:
+            # the segment log keeps offsets in memory and checkpoints them itself
+            acks = QAckFlushWorker(self.db_pool, QAckCoalescer(flush_ms=0 if self.db_pool is None else ACK_FLUSH_MS))
+        self.acks = acks
+        self.acks.start()
+        self.metrics = QMetrics()
+        self.metrics.register_collector(self._resource_metrics)
+        self.metrics.register_collector(logging_metrics)
+        if self.retention is not None:
+            self.metrics.register_collector(self.retention.stats.metrics)
+        self.metrics.register_collector(self.tail_cache.metrics)
+        self.metrics.register_collector(self.acks.coalescer.metrics)
+        self.metrics.register_collector(self.storage.metrics)
+        self.lag_cache = QLagCache()
+        self.metrics.register_collector(self.lag_cache.metrics)
+        self.metrics.register_collector(self.admission.metrics)
+        # open /stream responses, woken by acks, see queue_stream.py
+        self.streams = QStreamRegistry()
+        self.metrics.register_collector(self.streams.metrics)
+        # set in a pre-fork worker, renders the metrics of all workers
+        self.worker_metrics = None
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        if not self.admission.connect():
+            self._reject_connection(request)
+            return
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.admission.disconnect()
+
+    def _reject_connection(self, request):
+        # answered from the accepting thread without reading the request, so it must not block
+        body = json.dumps({'http_status': HTTPStatus.SERVICE_UNAVAILABLE,
+                           'error_message': 'Too many connections, try again later'}).encode('utf-8')
+        head = (f'HTTP/1.1 503 Service Unavailable\r\nContent-type: application/json\r\nContent-Length: {len(body)}\r\n'
+                f'Retry-After: {retry_after(ADMISSION_RETRY_AFTER)}\r\nConnection: close\r\n\r\n')
+        try:
+            request.setblocking(False)
+            request.sendall(head.encode('latin-1') + body)
+            # closing with unread data resets the connection, which may discard the response
+            request.recv(65536)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def request_started(self):
+        with self._busy_lock:
+            self._busy += 1
+
+    def request_finished(self):
+        with self._busy_lock:
+            self._busy -= 1
+
+    def drain(self, timeout: float=WORKER_DRAIN_TIMEOUT) -> bool:
+        """
+        Stop accepting connections and wait up to timeout seconds for the requests in progress.
+        Keep-alive connections are closed after their current response. Must not be called from
+        the thread running serve_forever(). Returns False if requests were still running.
+        """
+        self.draining = True
+        self.shutdown()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._busy_lock:
+                if self._busy == 0:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def _on_notify(self, channel: str, payload: str):
+        # keeps the tail cache and the coalesced acks in step with the publishes and topic changes of every server process
+        try:
+            data = json.loads(payload)
+            if channel == PUBLISH_CHANNEL:
+                self.tail_cache.advance(data['topic'], data.get('partition', 0), data['offset'])
+            elif channel == TOPIC_CHANGE_CHANNEL:
+                self.tail_cache.invalidate(data['topic'])
+                if data.get('event') in ('reset', 'delete'):
+                    self.acks.coalescer.discard_topic(data['topic'])
+                    self.streams.close_topic(data['topic'])
+                if data.get('event') == 'delete':
+                    self.storage.forget_topic(data['topic'])
+        except (ValueError, KeyError, TypeError):
+            logging.warning('Ignoring malformed %s notification: %s', channel, payload)
+
+    def _resource_metrics(self) -> list:
+        waiters = ('queue_long_poll_waiters', 'gauge', 'Requests parked waiting for a publish notification.',
+                   [({}, self.dispatcher.waiter_count())])
+        connections = ('queue_open_connections', 'gauge', 'Open client connections.', [({}, self.admission.connections)])
+        if self.db_pool is None:
+            return [waiters, connections]
+        pool = self.db_pool.stats()
+        return [
+            ('queue_db_pool_connections', 'gauge', 'Open database connections in the pool, by state.',
+             [({'state': 'in_use'}, pool['in_use']), ({'state': 'idle'}, pool['idle'])]),
+            ('queue_db_pool_waiters', 'gauge', 'Request threads waiting for a database connection.',
+             [({}, pool['waiters'])]),
+            ('queue_db_pool_wait_seconds_total', 'counter', 'Total time spent waiting for a database connection.',
+             [({}, pool['wait_seconds_total'])]),
+            ('queue_db_pool_timeouts_total', 'counter', 'Database connection acquires that timed out.',
+             [({}, pool['timeouts'])]),
+            ('queue_db_statements_prepared_total', 'counter', 'Hot route statements prepared on pool connections.',
+             [({}, pool['statements_prepared'])]),
+            waiters,
+            connections,
+        ]
+
+    def server_close(self):
+        super().server_close()
+        self.acks.stop()
+        if self.retention is not None:
+            self.retention.stop()
+        self.dispatcher.stop()
+        self.storage.close()
+
 
 # The server request handler
 class QRequestHandler(BaseHTTPRequestHandler):
-    def _set_response(self, status: int=HTTPStatus.OK, headers: dict={'Content-type': 'application/json'}):
+    # HTTP/1.1 keeps connections open between requests, so every response must carry a Content-Length
+    protocol_version = 'HTTP/1.1'
+    # idle keep-alive connections are closed after this many seconds
+    timeout = KEEPALIVE_TIMEOUT
+    # headers and body are written separately, without TCP_NODELAY the body waits for the client's delayed ack
+    disable_nagle_algorithm = True
+    
+    def send_response(self, code: int, message: str=None):
+        self._status = code
+        super().send_response(code, message)
+    
+    def log_message(self, format: str, *args):
+        # the access log line goes through (possibly async and sampled) logging instead of straight to stderr
+        logging.info('%s - ' + format, self.address_string(), *args, extra=PER_REQUEST)
+    
+    def log_error(self, format: str, *args):
+        logging.error('%s - ' + format, self.address_string(), *args)
+    
+    def _set_response(self, status: int=HTTPStatus.OK, headers: dict={'Content-type': 'application/json'}, body: bytes=b''):
         self.send_response(status)
         for pair in headers.items():
             self.send_header(*pair)
+        # tells clients they may publish with the framed format, see queue_wire.py
+        self.send_header('Accept-Post', ACCEPT_POST)
+        # and compress their request bodies, see queue_compression.py
+        self.send_header('Accept-Encoding', ACCEPT_ENCODING)
+        if headers.get('Content-type') in ('application/json', FRAMES_CONTENT_TYPE, ENCODED_FRAMES_CONTENT_TYPE):
+            # protocol errors are sent before there are any request headers
+            request_headers = getattr(self, 'headers', None)
+            encoding = response_encoding(request_headers.get('Accept-Encoding') if request_headers else None, len(body))
+            if encoding:
+                start = time.perf_counter()
+                body = compress(body, encoding)
+                self._serialize_time += time.perf_counter() - start
+                self.send_header('Content-Encoding', encoding)
+                self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
+        if body:
+            self.wfile.write(body)
     
-    def send_error(self, status:int, data: dict={}):
-        kwargs = {'status': status}
-        if not data:
-            kwargs['headers'] = {}
-        self._set_response(**kwargs)
+    def _serialize(self, data) -> bytes:
+        start = time.perf_counter()
+        body = json.dumps(data, default=str).encode('utf-8')
+        self._serialize_time += time.perf_counter() - start
+        return body
+    
+    def _send_json(self, data, status: int=HTTPStatus.OK):
+        self._set_response(status, body=self._serialize(data))
+    
+    def _send_messages(self, rows: list, unwrap: bool=False):
+        """
+        Send fetched messages framed when the client accepts it, else as JSON (a single message
+        unwrapped from the list with unwrap, as /get_message always did).
+        """
+        if not accepts_frames(self.headers['Accept']):
+            rows = plain_rows(rows)
+            self._send_json(rows[0] if unwrap and len(rows) == 1 else rows)
+            return
+        # version 2 frames carry messages stored compressed as they are
+        version = 2 if accepts_encoded_frames(self.headers['Accept']) else 1
+        start = time.perf_counter()
+        body = encode_rows(rows, version)
+        self._serialize_time += time.perf_counter() - start
+        self._set_response(headers={'Content-type': ENCODED_FRAMES_CONTENT_TYPE if version == 2 else FRAMES_CONTENT_TYPE},
+                           body=body)
+    
+    def _retry_later(self, status: int, seconds: float, err_msg: str):
+        # Retry-After promises the client that nothing was done, so any request may be sent again
+        self._set_response(status, headers={'Content-type': 'application/json', 'Retry-After': retry_after(seconds)},
+                           body=self._serialize({'http_status': status, 'error_message': err_msg}))
+    
+    def _rate_limited(self, topic: str, count: int) -> bool:
+        """
+        Take count messages from the publish rate limit of topic. Answers 429 and returns True when
+        the topic is over its limit.
+        """
+        wait = self.server.topic_limiter.take(topic, count)
+        if wait:
+            self.server.admission.topic_rejected()
+            logging.warning('Publish rate limit of topic %s exceeded, retry after %.3fs', topic, wait)
+            self._retry_later(HTTPStatus.TOO_MANY_REQUESTS, wait, f'Publish rate limit of topic {topic} exceeded, try again later')
+        return bool(wait)
+    
+    @contextmanager
+    def _parked(self):
+        # a long-poll waiting for a publish holds no database connection, so it does not count as in flight
+        if self._admitted:
+            self.server.admission.leave()
+        try:
+            yield
+        finally:
+            if self._admitted:
+                self.server.admission.resume()
+    
+    def send_error(self, status:int, data: dict={}, explain: str=None):
+        # BaseHTTPRequestHandler calls send_error(code, message[, explain]) for protocol level errors,
+        # after which the state of the connection is unknown
+        if isinstance(data, str):
+            data = {'http_status': status, 'error_message': data}
+            self.close_connection = True
         if data:
-            self.wfile.write(json.dumps(data, default=str).encode('utf-8'))
+            self._send_json(data, status)
+        else:
+            self._set_response(status, headers={})
+    
+    def _read_body(self) -> bytes:
+        # the body has to be consumed even when it is not used, or it would be parsed as the next request
+        if self._body is None:
+            varlen = int(self.headers['Content-Length'] or 0)
+            self._body = self.rfile.read(varlen) if varlen > 0 else b''
+        return self._body
+    
+    def parse_request(self) -> bool:
+        self._body = None
+        self._query_params = {}
+        self._status = None
+        self._admitted = False
+        self._db_time = 0.0
+        self._serialize_time = 0.0
+        return super().parse_request()
+    
+    @contextmanager
+    def _db_cursor(self, name: str=None):
+        # a named cursor is a server-side cursor that fetches rows from the database on demand
+        if self.server.db_pool is None:
+            raise StorageNotSupportedError(f'/{self._route} needs the postgres storage, not {self.server.storage.name}')
+        start = time.perf_counter()
+        try:
+            with self.server.db_pool.connection() as conn:
+                with conn.cursor(name=name) as cur:
+                    yield cur
+        finally:
+            self._db_time += time.perf_counter() - start
     
+    def _store(self, operation: str, *args):
+        # a call to the storage backend, counted as database time in the route metrics
+        start = time.perf_counter()
+        try:
+            return getattr(self.server.storage, operation)(*args)
+        finally:
+            self._db_time += time.perf_counter() - start
+
     def handle_route(self, allowed_routes=[]):
+        start = time.perf_counter()
+        self._route = 'unknown'
+        self.server.request_started()
+        try:
+            self._handle_route(allowed_routes)
+        finally:
+            self.server.request_finished()
+            if self.server.draining:
+                self.close_connection = True
+            self.server.metrics.observe(self._route, self.command, self._status or 0, time.perf_counter() - start,
+                                        db=self._db_time, serialize=self._serialize_time)
+    
+    def _handle_route(self, allowed_routes=[]):
         parsed_path = urlparse(self.path)
         
+        body = self._read_body()
+        content_encoding = (self.headers['Content-Encoding'] or 'identity').strip().lower()
+        if body and content_encoding != 'identity':
+            if content_encoding not in ENCODINGS:
+                self.send_error(
+                    HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+                    {'http_status': HTTPStatus.UNSUPPORTED_MEDIA_TYPE, 'error_message': f'Unsupported Content-Encoding "{content_encoding}", use one of {ACCEPT_ENCODING}'})
+                return
+            try:
+                body = decompress(body, content_encoding)
+            except ValueError as e:
+                self.send_error(HTTPStatus.BAD_REQUEST, {'http_status': HTTPStatus.BAD_REQUEST, 'error_message': str(e)})
+                return
         if self.command.upper() == 'POST':
-            varlen = int(self.headers['Content-Length'])
             if self.headers['Content-type'] == 'application/json':
-                self._query_params = json.loads(self.rfile.read(varlen).decode('utf-8'))
+                self._query_params = json.loads(body.decode('utf-8'))
+            elif self.headers['Content-type'] == FRAMES_CONTENT_TYPE:
+                # framed messages to publish, everything else is in the query string
+                self._query_params = parse_qs(parsed_path.query)
+                try:
+                    messages = decode_messages(body)
+                except ValueError as e:
+                    self.send_error(HTTPStatus.BAD_REQUEST, {'http_status': HTTPStatus.BAD_REQUEST, 'error_message': str(e)})
+                    return
+                self._query_params['messages'] = messages
+                if len(messages) == 1:
+                    self._query_params['message'] = messages[0]
             else:
                 content_type = self.headers['Content-type']
                 self.send_error(
                     HTTPStatus.BAD_REQUEST,
-                    {'http_status': HTTPStatus.BAD_REQUEST, 'error_message': f'POST command only accepts "application/json" content type. (Got "{content_type}")'} )
+                    {'http_status': HTTPStatus.BAD_REQUEST, 'error_message': f'POST command only accepts "application/json" or "{FRAMES_CONTENT_TYPE}" content type. (Got "{content_type}")'} )
+                return
         else:
             self._query_params = parse_qs(parsed_path.query)
         
@@ -69,8 +470,31 @@ class QRequestHandler(BaseHTTPRequestHandler):
                 {'http_status': HTTPStatus.NOT_IMPLEMENTED, 'error_message': f"Unsupported route ({route})"} )
             return
         
+        # only known routes become metric labels, so made up paths cannot grow the label set
+        self._route = route
         if not allowed_routes or route in allowed_routes:
-            getattr(self, route_method)()
+            if route not in ADMISSION_EXEMPT_ROUTES:
+                if not self.server.admission.enter():
+                    logging.warning('Rejected /%s, %d requests in flight', route, self.server.admission.in_flight)
+                    self._retry_later(HTTPStatus.SERVICE_UNAVAILABLE, ADMISSION_RETRY_AFTER, 'Server busy, try again later')
+                    return
+                self._admitted = True
+            try:
+                getattr(self, route_method)()
+            except PoolTimeoutError as e:
+                logging.error(str(e))
+                self.send_error(
+                    HTTPStatus.SERVICE_UNAVAILABLE,
+                    {'http_status': HTTPStatus.SERVICE_UNAVAILABLE, 'error_message': 'No database connection available, try again later'})
+            except StorageNotSupportedError as e:
+                logging.error(str(e))
+                self.send_error(
+                    HTTPStatus.NOT_IMPLEMENTED,
+                    {'http_status': HTTPStatus.NOT_IMPLEMENTED, 'error_message': str(e)})
+            finally:
+                if self._admitted:
+                    self.server.admission.leave()
+                    self._admitted = False
         else:
             err_msg = f"Unsupported route ({route}) for {self.command}"
             logging.error(err_msg)
@@ -79,81 +503,193 @@ class QRequestHandler(BaseHTTPRequestHandler):
                 {'http_status': HTTPStatus.UNAUTHORIZED, 'error_message': err_msg})
     
     def do_GET(self):
-        logging.info("GET request,\nPath: %s\nHeaders:\n%s\n", str(self.path), str(self.headers))
+        logging.debug("GET request,\nPath: %s\nHeaders:\n%s\n", self.path, self.headers)
         self.handle_route()
     
     def do_POST(self):
-        logging.info("POST request,\nPath: %s\nHeaders:\n%s\n", str(self.path), str(self.headers))
-        self.handle_route(allowed_routes=['publish', 'ack_message', 'topic_reset', 'unsubscribe', 'topic'])
+        logging.debug("POST request,\nPath: %s\nHeaders:\n%s\n", self.path, self.headers)
+        self.handle_route(allowed_routes=['publish', 'publish_batch', 'ack_message', 'ack_fetch', 'group_fetch', 'group_ack', 'topic_reset', 'topic_retention', 'unsubscribe', 'topic'])
     
     def do_PUT(self):
-        logging.info("PUT request,\nPath: %s\nHeaders:\n%s\n", str(self.path), str(self.headers))
-        self.handle_route(allowed_routes=['publish', 'ack_message', 'topic_reset', 'unsubscribe', 'topic'])
+        logging.debug("PUT request,\nPath: %s\nHeaders:\n%s\n", self.path, self.headers)
+        self.handle_route(allowed_routes=['publish', 'publish_batch', 'ack_message', 'ack_fetch', 'group_fetch', 'group_ack', 'topic_reset', 'topic_retention', 'unsubscribe', 'topic'])
     
     def do_PATCH(self):
+        self._read_body()
         self.send_error(
             HTTPStatus.NOT_IMPLEMENTED,
             {'http_status': HTTPStatus.NOT_IMPLEMENTED, 'error_message': f"Unsupported command"})
     
     def do_DELETE(self):
-        logging.info("DELETE request,\nPath: %s\nHeaders:\n%s\n", str(self.path), str(self.headers))
+        logging.debug("DELETE request,\nPath: %s\nHeaders:\n%s\n", self.path, self.headers)
         self.handle_route(allowed_routes=['topic_delete', 'unsubscribe'])
     
-    def _do_list(self, table_name: str):
-        sql = f"""select * from {table_name} """
-        target_topic = self._query_params.get('topic')
-        if target_topic:
-            target_topic = target_topic[0] if isinstance(target_topic, (list, tuple)) else target_topic
-        if target_topic:
-            values = (target_topic,)
-            sql += """where topic = %s"""
+    def _start_chunked(self, content_type: str):
+        # HTTP/1.0 clients do not understand chunked encoding, they read the body until the connection closes
+        self._chunked = self.request_version == 'HTTP/1.1'
+        encoding = response_encoding(self.headers['Accept-Encoding'], float('inf'))
+        # every chunk is flushed through the compressor, so rows still go out as they are read
+        self._chunk_compressor = compressor(encoding) if encoding else None
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-type', content_type)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+        if self._chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_headers()
+    
+    def _write_chunk(self, data: bytes, final: bool=False):
+        if self._chunk_compressor is not None:
+            data = self._chunk_compressor.compress(data) + self._chunk_compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+        if not data:
+            return
+        if self._chunked:
+            self.wfile.write(f'{len(data):X}\r\n'.encode('latin-1') + data + b'\r\n')
         else:
-            values = None
-        sql = sql + ';'
+            self.wfile.write(data)
+        self.wfile.flush()
+    
+    def _end_chunked(self):
+        if self._chunk_compressor is not None:
+            self._write_chunk(b'', final=True)
+        if self._chunked:
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+    
+    def _do_list(self, table_name: str):
+        stream = is_stream_request(self._query_params, self.headers['Accept'])
+        try:
+            sql, values, limit = list_query(table_name, self._query_params, stream)
+        except ValueError as e:
+            logging.error(str(e))
+            self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY,
+                            {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': str(e)})
+            return
         
-        with db_connect(DB_URI, cursor_factory=RealDictCursor) as conn:
-            with conn.cursor() as cur:
+        if stream:
+            self._stream_list(table_name, sql, values)
+            return
+        
+        with self._db_cursor() as cur:
+            cur.execute(sql, values)
+            res = cur.fetchall()
+        logging.info('Got %d records from table %s', len(res), table_name, extra=PER_REQUEST)
+        if table_name == 'topic_message':
+            res = plain_rows(res)
+        headers = {'Content-type': 'application/json'}
+        next_path = next_page(table_name, self._query_params, res, limit)
+        if next_path:
+            headers['X-Next-Page'] = next_path
+        self._set_response(headers=headers, body=self._serialize(res))
+    
+    def _stream_list(self, table_name: str, sql: str, values: list):
+        """
+        Stream rows as newline delimited JSON from a server-side cursor, so only STREAM_FETCH_SIZE
+        rows are held in memory at a time and the first rows go out before the query finishes.
+        """
+        count = 0
+        try:
+            with self._db_cursor(name=f'list_{table_name}') as cur:
+                cur.itersize = STREAM_FETCH_SIZE
                 cur.execute(sql, values)
-                res = cur.fetchall()
-        self._set_response()
-        logging.info(f'Got {len(res)} records from table {table_name}')
-        self.wfile.write(json.dumps(res, default=str).encode('utf-8'))
+                self._start_chunked('application/x-ndjson')
+                while True:
+                    rows = cur.fetchmany(STREAM_FETCH_SIZE)
+                    if not rows:
+                        break
+                    count += len(rows)
+                    if table_name == 'topic_message':
+                        rows = plain_rows(rows)
+                    self._write_chunk(''.join(json.dumps(row, default=str) + '\n' for row in rows).encode('utf-8'))
+            self._end_chunked()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            logging.warning(f'Client went away after {count} streamed records from table {table_name}')
+            return
+        logging.info(f'Streamed {count} records from table {table_name}')
     
-    # list topics route: /topics
+    # list topics route: /topics?after_topic=<topic>&limit=<limit>&stream=<0|1>
     def do_topics(self):
         self._do_list("topic")
     
-    # list messages route: /topic_messages?topic=<topic>
+    # list messages route: /topic_messages?topic=<topic>&partition=<partition>&after_partition=<partition>&after_offset=<offset>&limit=<limit>&stream=<0|1>
     def do_topic_messages(self):
         self._do_list("topic_message")
 
-    # list subscribers route: /topic_subscribers?topic=<topic>
+    # list subscribers route: /topic_subscribers?topic=<topic>&after_id=<id>&limit=<limit>&stream=<0|1>
     def do_topic_subscribers(self):
         self._do_list("topic_subscriber")
 
-    # create topic route: /topic?topic=<name>&description=<description>
+    # subscriber lag route: /lag?topic=<topic>
+    # per topic and subscriber: head and committed offsets, message lag and age of the oldest unacked message
+    def do_lag(self):
+        topic = self._query_params.get('topic')
+        topic = (topic[0] if isinstance(topic, (list, tuple)) else topic) or None
+        rows = self.server.lag_cache.get(topic)
+        if rows is None:
+            rows = self._store('lag', topic)
+            self.server.lag_cache.put(topic, rows)
+        self._send_json(lag_report(rows))
+    
+    # Prometheus metrics route: /metrics
+    def do_metrics(self):
+        body = (self.server.worker_metrics or self.server.metrics).render().encode('utf-8')
+        self._set_response(headers={'Content-type': 'text/plain; version=0.0.4; charset=utf-8'}, body=body)
+    
+    # connection pool statistics route: /pool_stats
+    def do_pool_stats(self):
+        if self.server.db_pool is None:
+            raise StorageNotSupportedError(f'There is no connection pool with the {self.server.storage.name} storage')
+        self._send_json(self.server.db_pool.stats())
+
+    # create topic route: /topic?topic=<name>&description=<description>&partitions=<n>&segment_size=<n>&retention_ms=<ms>&retention_messages=<count>&retention_acked=<0|1>&compression=<gzip|deflate>
     def do_topic(self):
         new_topic = self._query_params.get('topic')
         new_topic_desc = self._query_params.get('description')
         if new_topic and new_topic_desc:
             new_topic = new_topic[0] if isinstance(new_topic, (list, tuple)) else new_topic
             new_topic_desc = new_topic_desc[0] if isinstance(new_topic_desc, (list, tuple)) else new_topic_desc
+            policy, err_msg = self._retention_params('segment_size', 'partitions')
+            if (policy.get('partitions') or 1) > TOPIC_MAX_PARTITIONS:
+                err_msg.append(f'A topic can have at most {TOPIC_MAX_PARTITIONS} partitions. Got [{policy["partitions"]}].')
+            compression = self._query_params.get('compression')
+            compression = (compression[0] if isinstance(compression, (list, tuple)) else compression) or None
+            if compression is not None and compression not in ENCODINGS:
+                err_msg.append(f'Expected one of {", ".join(ENCODINGS)} for the compression parameter. Got [{compression}].')
+            if err_msg:
+                logging.error('\n'.join(err_msg))
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': '<br>'.join(err_msg)})
+                return
             try:
-                with db_connect(DB_URI, cursor_factory=RealDictCursor) as conn:
-                    with conn.cursor() as cur:
-                        cur.execute("""select topic_create(%s, %s);""", (new_topic, new_topic_desc))
-                        res = cur.fetchone()
-            except psycopg2.errors.IntegrityError as e:
-                conn.rollback()
+                res = self._store('topic_create', new_topic, new_topic_desc, policy['partitions'], policy['segment_size'],
+                                  policy['retention_ms'], policy['retention_messages'], policy['retention_acked'], compression)
+            except TopicExistsError as e:
                 logging.error(f'Topic "{new_topic}" already exists')
                 self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
-                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': f'The topic "{new_topic}" already exists'})
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': str(e)})
+                return
+            except InvalidTopicError as e:
+                logging.error(str(e))
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY,
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': str(e)})
+                return
+            except StorageNotSupportedError:
+                # answered with 501 by handle_route()
+                raise
+            except StorageError as e:
+                logging.error(str(e))
+                self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
+                                {'http_status': HTTPStatus.INTERNAL_SERVER_ERROR, 'error_message': str(e)})
                 return
 
-            if res.get('topic_create') == new_topic:
+            if res == new_topic:
                 logging.info(f"Created topic '{new_topic}'")
-                self._set_response()
-                self.wfile.write(json.dumps({'topic': new_topic, 'message': f'Topic "{new_topic}" created'}).encode('utf-8'))
+                self._send_json({'topic': new_topic, 'partitions': policy['partitions'] or 1,
+                                 'message': f'Topic "{new_topic}" created'})
             else:
                 logging.error(f"ERROR: Topic '{new_topic}' creation failed")
                 self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY,
@@ -163,51 +699,108 @@ class QRequestHandler(BaseHTTPRequestHandler):
             self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
                             {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': "Missing parameters topic, description"})
 
+    def _retention_params(self, *extra) -> tuple:
+        """
+        Optional retention policy parameters (plus the extra integer parameters named), missing
+        ones as None. Returns (values, error messages).
+        """
+        values = {}
+        err_msg = []
+        for name in ('retention_ms', 'retention_messages') + extra:
+            value = self._query_params.get(name)
+            value = value[0] if isinstance(value, (list, tuple)) else value
+            if value in (None, '', 0, '0'):
+                values[name] = None
+                continue
+            try:
+                values[name] = int(value)
+            except (TypeError, ValueError):
+                err_msg.append(f'Expected integer value for the {name} parameter. Got [{value}].')
+                continue
+            if values[name] < 0:
+                err_msg.append(f'Expected a positive value for the {name} parameter. Got [{value}].')
+        acked = self._query_params.get('retention_acked', False)
+        acked = acked[0] if isinstance(acked, (list, tuple)) else acked
+        values['retention_acked'] = acked is True or str(acked).lower() in ('1', 'true', 'yes')
+        return values, err_msg
+    
+    # retention policy route: /topic_retention?topic=<topic>&retention_ms=<ms>&retention_messages=<count>&retention_acked=<0|1>
+    # replaces the policy of the topic, a missing or 0 limit turns it off
+    def do_topic_retention(self):
+        target_topic = self._query_params.get('topic')
+        if target_topic:
+            target_topic = target_topic[0] if isinstance(target_topic, (list, tuple)) else target_topic
+            policy, err_msg = self._retention_params()
+            if err_msg:
+                logging.error('\n'.join(err_msg))
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': '<br>'.join(err_msg)})
+                return
+            with self._db_cursor() as cur:
+                cur.execute("""select * from topic_set_retention(%s, %s, %s, %s);""",
+                            (target_topic, policy['retention_ms'], policy['retention_messages'], policy['retention_acked']))
+                res = cur.fetchone()
+            if res is None:
+                err_msg = f'The topic "{target_topic}" does not exist'
+                logging.error(err_msg)
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
+                return
+            logging.info(f'Set retention of topic {target_topic} to {policy}')
+            self._send_json({name: res[name] for name in ('topic', 'segment_size', 'retention_ms', 'retention_messages', 'retention_acked')})
+        else:
+            self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                            {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': "Missing parameter: topic"})
+    
     # delete topic route: /topic_delete?topic=<topic>
     def do_topic_delete(self):
         target_topic = self._query_params.get('topic')
         if target_topic:
             target_topic = target_topic[0] if isinstance(target_topic, (list, tuple)) else target_topic
             logging.info(f"Deleting topic {target_topic}")
-            with db_connect(DB_URI, cursor_factory=RealDictCursor) as conn:
-                with conn.cursor() as cur:
-                    cur.execute("""select topic_delete(%s);""", (target_topic,))
+            self._store('topic_delete', target_topic)
+            self.server.tail_cache.invalidate(target_topic)
+            self.server.acks.coalescer.discard_topic(target_topic)
             if self.command == 'GET':
-                self._set_response()
-                self.wfile.write(json.dumps({'message': f'Topic "{target_topic}" deleted'}).encode('utf-8'))
+                self._send_json({'message': f'Topic "{target_topic}" deleted'})
             else:
                 self._set_response(headers={})
         else:
             self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
                             {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': "Missing parameter: topic"})
     
-    # save message route: /publish?topic=<topic>&message=<message> 
+    # save message route: /publish?topic=<topic>&message=<message>&key=<key>
+    # messages with the same key go to the same partition of the topic, messages without one are spread round-robin
     def do_publish(self):
         target_topic = self._query_params.get('topic')
         message = self._query_params.get('message')
+        key = self._query_params.get('key')
         if target_topic and message is not None:
             target_topic = target_topic[0] if isinstance(target_topic, (list, tuple)) else target_topic
             message = message[0] if isinstance(message, (list, tuple)) else message
-            logging.info(f'MESSAGE = [{message}]')
+            key = key[0] if isinstance(key, (list, tuple)) else key
+            logging.debug('MESSAGE = [%s]', message)
+            if self._rate_limited(target_topic, 1):
+                return
             try:
-                with db_connect(DB_URI, cursor_factory=RealDictCursor) as conn:
-                    with conn.cursor() as cur:
-                        cur.execute("""select save_message(%s, %s);""", (target_topic, message))
-                        res = cur.fetchone()
-            except psycopg2.errors.IntegrityError as e:
-                conn.rollback()
-                logging.error(f'Topic "{target_topic}" does not exist')
+                res = self._store('append', target_topic, message, key)
+            except TopicNotFoundError as e:
+                logging.error(str(e))
                 self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
-                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': f'Topic "{target_topic}" does not exist'})
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': str(e)})
                 return
                         
-            if res is not None and res['save_message'] is not None:
-                logging.info(f'Saved message for topic {target_topic} at offset {res["save_message"]}')
+            if res is not None and res['_offset'] is not None:
+                # committed, so subscribers reading the tail can be served this message from memory
+                self.server.tail_cache.publish(self.server.dispatcher.epoch, dict(res))
+                logging.info('Saved message for topic %s at partition %s offset %s', target_topic, res['_partition'],
+                             res['_offset'], extra=PER_REQUEST)
                 if self.command == 'GET':
-                    self._set_response()
-                    self.wfile.write(json.dumps({'message': f'Saved message to topic "{target_topic}" at offset {res["save_message"]}'}).encode('utf-8'))
+                    self._send_json({'message': f'Saved message to topic "{target_topic}" at partition {res["_partition"]} offset {res["_offset"]}',
+                                     'partition': res['_partition'],
+                                     'offset': res['_offset']})
                 else:
-                    self._set_response(headers={})
+                    self._set_response(headers={'X-Partition': str(res['_partition']), 'X-Offset': str(res['_offset'])})
             else:
                 err_msg = f"Failed to save message to topic {target_topic}"
                 logging.error(err_msg)
@@ -219,26 +812,90 @@ class QRequestHandler(BaseHTTPRequestHandler):
             self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
                             {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
     
-    # subscribe route: /subscribe?topic=<topic>
+    # save message batch route: /publish_batch?topic=<topic>&messages=<message>&messages=<message>...&key=<key>
+    # or POST {"topic": <topic>, "messages": [<message>, ...], "key": <key>}
+    # the whole batch goes to one partition
+    def do_publish_batch(self):
+        target_topic = self._query_params.get('topic')
+        messages = self._query_params.get('messages')
+        key = self._query_params.get('key')
+        if target_topic and messages:
+            target_topic = target_topic[0] if isinstance(target_topic, (list, tuple)) else target_topic
+            key = key[0] if isinstance(key, (list, tuple)) else key
+            if not isinstance(messages, (list, tuple)) or not all(isinstance(m, str) for m in messages):
+                err_msg = "Parameter messages must be a list of strings"
+                logging.error(err_msg)
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY,
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
+                return
+            if len(messages) > PUBLISH_BATCH_MAX:
+                err_msg = f"Batch of {len(messages)} messages exceeds the limit of {PUBLISH_BATCH_MAX}"
+                logging.error(err_msg)
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY,
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
+                return
+            if self._rate_limited(target_topic, len(messages)):
+                return
+            try:
+                res = self._store('append_batch', target_topic, list(messages), key)
+            except TopicNotFoundError as e:
+                logging.error(str(e))
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY,
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': str(e)})
+                return
+
+            if res is not None and res['first_offset'] is not None:
+                logging.info('Saved %d messages for topic %s at partition %s offsets %s-%s', len(messages), target_topic,
+                             res['_partition'], res['first_offset'], res['last_offset'], extra=PER_REQUEST)
+                self._send_json({'topic': target_topic,
+                                'partition': res['_partition'],
+                                'first_offset': res['first_offset'],
+                                'last_offset': res['last_offset'],
+                                'count': len(messages)})
+            else:
+                err_msg = f"Failed to save messages to topic {target_topic}"
+                logging.error(err_msg)
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY,
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
+        else:
+            err_msg = "Missing parameters topic, messages"
+            logging.error(err_msg)
+            self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY,
+                            {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
+
+    # subscribe route: /subscribe?topic=<topic>&group=<group>&partitions=<partition>&partitions=<partition>...&ack_mode=<durable|coalesced>
+    # members of the same group share the group offsets and each message is handed to one of them.
+    # Without partitions the subscriber consumes every partition of the topic
     def do_subscribe(self):
         target_topic = self._query_params.get('topic')
+        group = self._query_params.get('group')
         if target_topic:
             target_topic = target_topic[0] if isinstance(target_topic, (list, tuple)) else target_topic
+            group = (group[0] if isinstance(group, (list, tuple)) else group) or None
             try:
-                with db_connect(DB_URI, cursor_factory=RealDictCursor) as conn:
-                    with conn.cursor() as cur:
-                        cur.execute("""select topic_subscribe(%s);""", (target_topic,))
-                        res = cur.fetchone()
-            except psycopg2.errors.IntegrityError as e:
-                conn.rollback()
-                err_msg = f'The topic "{target_topic}" does not exist'
-                logging.error(err_msg)
+                partitions = self._int_list('partitions')
+                ack_mode = self._ack_mode()
+            except ValueError as e:
+                logging.error(str(e))
                 self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
-                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': str(e)})
+                return
+            try:
+                res = self._store('subscribe', target_topic, group, partitions, ack_mode)
+            except (TopicNotFoundError, ValueError) as e:
+                logging.error(str(e))
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': str(e)})
                 return
             
-            self._set_response()
-            self.wfile.write(json.dumps({'topic': target_topic, 'subscriber_id': res['topic_subscribe']}).encode('utf-8'))
+            data = {'topic': target_topic, 'subscriber_id': res}
+            if group:
+                data['group'] = group
+            if partitions:
+                data['partitions'] = sorted(set(partitions))
+            if ack_mode:
+                data['ack_mode'] = ack_mode
+            self._send_json(data)
         else:
             logging.error("ERROR: /topic route missing parameters for topic")
             self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
@@ -253,27 +910,29 @@ class QRequestHandler(BaseHTTPRequestHandler):
             except ValueError:
                 err_msg = f'Expected integer value for the subscriber_id parameter. Got [{target_subscriber_id}].'
                 logging.error(err_msg)
-                send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
-                           {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
                 return
                 
             logging.info(f"Deleting subscriber {target_subscriber_id}")
-            with db_connect(DB_URI, cursor_factory=RealDictCursor) as conn:
-                with conn.cursor() as cur:
-                    cur.execute("""select unsubscribe(%s);""", (target_subscriber_id,))
+            self._store('unsubscribe', target_subscriber_id)
+            self.server.acks.coalescer.forget(target_subscriber_id)
+            self.server.streams.close_subscriber(target_subscriber_id)
             if self.command == 'GET':
-                self._set_response()
-                self.wfile.write(json.dumps({'message': f'Subscriber "{target_subscriber_id}" deleted'}).encode('utf-8'))
+                self._send_json({'message': f'Subscriber "{target_subscriber_id}" deleted'})
             else:
                 self._set_response(headers={})
         else:
             self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
                             {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': "Missing parameter: subscriber_id"})
     
-    # get message route: /get_message?subscriber_id=<subscriber_id>&num_messages=1
+    # get message route: /get_message?subscriber_id=<subscriber_id>&num_messages=1&wait_ms=0
+    # with wait_ms > 0 the request is parked until a message is published to the subscribed topic or the wait expires
+    # &after_partitions=<partition>&after_offsets=<offset>... reads past offsets already delivered without acking them
     def do_get_message(self):
         subscriber_id = self._query_params.get('subscriber_id')
         num_messages = self._query_params.get('num_messages', [1])
+        wait_ms = self._query_params.get('wait_ms', [0])
         err_msg = []
         if subscriber_id and num_messages:
             try:
@@ -284,38 +943,365 @@ class QRequestHandler(BaseHTTPRequestHandler):
                 num_messages = int(num_messages[0] if isinstance(num_messages, (list, tuple)) else num_messages)
             except ValueError:
                 err_msg.append(f'Expected integer value for the num_messages parameter. Got [{num_messages}].')
+            try:
+                wait_ms = int(wait_ms[0] if isinstance(wait_ms, (list, tuple)) else wait_ms)
+            except ValueError:
+                err_msg.append(f'Expected integer value for the wait_ms parameter. Got [{wait_ms}].')
+            try:
+                after = self._after_offsets()
+            except ValueError as e:
+                err_msg.append(str(e))
             if err_msg:
                 logging.error('\n'.join(err_msg))
-                send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
-                           {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': '<br>'.join(err_msg)})
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': '<br>'.join(err_msg)})
                 return
             try:
-                with db_connect(DB_URI, cursor_factory=RealDictCursor) as conn:
-                    with conn.cursor() as cur:
-                        cur.execute("""select * from get_message(%s, %s);""", (subscriber_id,num_messages))
-                        res = cur.fetchall()
-            except psycopg2.errors.IntegrityError as e:
-                conn.rollback()
-                err_msg = f'The topic "{new_topic}" does not exist'
-                logging.error(err_msg)
+                # acks still held by the ack coalescer count as made, and so does the client's read cursor
+                pending_partitions, pending_offsets = highest_offsets(self.server.acks.coalescer.offsets(subscriber_id), after)
+                res = self._get_messages(subscriber_id, wait_ms, 'fetch',
+                                         (subscriber_id, num_messages, pending_partitions, pending_offsets),
+                                         cached_messages=max(1, min(num_messages, GET_MESSAGE_MAX)), after=after)
+            except StorageError as e:
+                logging.error(str(e))
                 self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
-                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': str(e)})
                 return
             
-            logging.info(f'Fetched {len(res)} messages for subscriber {subscriber_id}')
-            if len(res) == 1:
-                res = res[0]
-            self._set_response()
-            self.wfile.write(json.dumps(res, default=str).encode('utf-8'))
+            logging.info('Fetched %d messages for subscriber %s', len(res), subscriber_id, extra=PER_REQUEST)
+            self._send_messages(res, unwrap=True)
         else:
             logging.error("ERROR: /topic route missing parameters for topic")
             self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
                             {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': "Missing 'topic' parameter"})
     
-    # ack_message route: /ack_message?subscriber_id=<subscriber_id>&offset=<offset>
+    # ack and fetch route: /ack_fetch?subscriber_id=<subscriber_id>&offset=<offset>&partition=<partition>&num_messages=20&wait_ms=0
+    # or with the last processed offset of several partitions: &partitions=<partition>&offsets=<offset>&partitions=<partition>&offsets=<offset>...
+    def do_ack_fetch(self):
+        subscriber_id = self._query_params.get('subscriber_id')
+        values = {}
+        err_msg = []
+        if subscriber_id:
+            for name, default in (('subscriber_id', None), ('num_messages', 1), ('wait_ms', 0)):
+                value = self._query_params.get(name, default)
+                value = value[0] if isinstance(value, (list, tuple)) else value
+                try:
+                    values[name] = int(value)
+                except (TypeError, ValueError):
+                    err_msg.append(f'Expected integer value for the {name} parameter. Got [{value}].')
+            try:
+                # without an offset nothing is acked, e.g. on the first fetch
+                partitions, offsets = self._partition_offsets()
+            except ValueError as e:
+                err_msg.append(str(e))
+            if err_msg:
+                logging.error('\n'.join(err_msg))
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': '<br>'.join(err_msg)})
+                return
+            # the ack is committed with the first fetch, later polls only fetch. Coalesced acks of the
+            # subscriber still waiting for a flush are committed along with it
+            coalescer = self.server.acks.coalescer
+            pending_partitions, pending_offsets = coalescer.offsets(values['subscriber_id'])
+            res = self._get_messages(values['subscriber_id'], values['wait_ms'],
+                                     'ack_fetch',
+                                     (values['subscriber_id'], partitions + pending_partitions, offsets + pending_offsets,
+                                      values['num_messages']),
+                                     (values['subscriber_id'], [], [], values['num_messages']))
+            coalescer.settle(values['subscriber_id'], pending_partitions, pending_offsets)
+            self.server.streams.acked(values['subscriber_id'], partitions, offsets)
+            logging.info('Acked offsets %s of partitions %s and fetched %d messages for subscriber %s', offsets, partitions,
+                         len(res), values['subscriber_id'], extra=PER_REQUEST)
+            # always a list, unlike /get_message which unwraps a single message
+            self._send_messages(res)
+        else:
+            self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                            {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': "Missing parameter: subscriber_id"})
+    
+    def _get_messages(self, subscriber_id: int, wait_ms: int, operation: str, args: tuple, poll_args: tuple=None,
+                      cached_messages: int=None, after: tuple=((), ())) -> list:
+        """
+        Fetch messages for a subscriber by calling the storage operation with args. When nothing is available
+        and wait_ms > 0 the calling thread waits on the notification dispatcher (without holding a database
+        connection) for a publish to the subscribed topic, then checks again with poll_args (default args)
+        until the wait expires. With cached_messages, the operation is a plain read of that many messages and
+        is answered from the tail cache when possible, after the (partitions, offsets) of after.
+        """
+        wait_ms = max(0, min(wait_ms, GET_MESSAGE_MAX_WAIT_MS))
+        deadline = time.monotonic() + wait_ms / 1000.0
+        dispatcher = self.server.dispatcher
+        cache = self.server.tail_cache
+        topic = None
+        generation = None
+        while True:
+            subscriber = None
+            if cached_messages and cache.enabled:
+                # the offsets are read on every check, acks may come through any server process
+                subscriber = self._store('subscriber', subscriber_id)
+                if subscriber is None:
+                    return []
+                topic = subscriber['topic']
+            elif wait_ms and topic is None:
+                topic = self._store('subscriber_topic', subscriber_id)
+                if topic is None:
+                    return []
+            if wait_ms and generation is None:
+                generation = dispatcher.generation(topic)
+            
+            res = None
+            if subscriber is not None and subscriber['group_id'] is None:
+                epoch = dispatcher.epoch
+                # offsets[p] is the offset of partition p
+                offsets = self.server.acks.coalescer.merge_offsets(subscriber_id, subscriber['_offsets'])
+                for partition, offset in zip(*after):
+                    if partition < len(offsets):
+                        offsets[partition] = max(offset, offsets[partition])
+                res = cache.read(epoch, topic, subscriber['partitions'], offsets, cached_messages)
+            if res is None:
+                res = self._store(operation, *args)
+                if subscriber is not None and subscriber['group_id'] is None:
+                    cache.fill(epoch, topic, subscriber['partitions'], offsets, cached_messages, [dict(r) for r in res])
+            
+            remaining = deadline - time.monotonic()
+            if res or remaining <= 0:
+                return res
+            with self._parked():
+                dispatcher.wait(topic, generation, remaining)
+            generation = dispatcher.generation(topic)
+            args = poll_args or args
+    
+    # stream route: /stream?subscriber_id=<subscriber_id>&credits=<n>&format=<ndjson|sse>&heartbeat_ms=<ms>
+    # pushes messages as they are published, at most credits of them delivered and not acked, see queue_stream.py
+    def do_stream(self):
+        subscriber_id = self._query_params.get('subscriber_id')
+        if not subscriber_id:
+            self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                            {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': "Missing parameter: subscriber_id"})
+            return
+        values = {}
+        err_msg = []
+        for name, default in (('subscriber_id', None), ('credits', STREAM_CREDITS), ('heartbeat_ms', STREAM_HEARTBEAT_MS)):
+            value = self._query_params.get(name, default)
+            value = value[0] if isinstance(value, (list, tuple)) else value
+            try:
+                values[name] = int(value)
+            except (TypeError, ValueError):
+                err_msg.append(f'Expected integer value for the {name} parameter. Got [{value}].')
+        if not err_msg and not 0 < values['credits'] <= STREAM_MAX_CREDITS:
+            err_msg.append(f'Expected between 1 and {STREAM_MAX_CREDITS} credits. Got [{values["credits"]}].')
+        if not err_msg and values['heartbeat_ms'] <= 0:
+            err_msg.append(f'Expected a positive heartbeat_ms. Got [{values["heartbeat_ms"]}].')
+        fmt = self._query_params.get('format')
+        try:
+            fmt = stream_format(fmt[0] if isinstance(fmt, (list, tuple)) else fmt, self.headers['Accept'])
+        except ValueError as e:
+            err_msg.append(str(e))
+        subscriber = None
+        if not err_msg:
+            subscriber = self._store('subscriber', values['subscriber_id'])
+            if subscriber is None:
+                err_msg.append(f'Subscriber {values["subscriber_id"]} does not exist')
+            elif subscriber['group_id'] is not None:
+                err_msg.append(f'Subscriber {values["subscriber_id"]} is a consumer group member, those claim messages with /group_fetch')
+        if err_msg:
+            logging.error('\n'.join(err_msg))
+            self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                            {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': '<br>'.join(err_msg)})
+            return
+        
+        window = QStreamWindow(values['subscriber_id'], subscriber['topic'], values['credits'])
+        wake = threading.Event()
+        self.server.streams.register(window, wake.set)
+        try:
+            self._start_chunked(STREAM_FORMATS[fmt])
+            self._stream_messages(window, wake, fmt, values['heartbeat_ms'] / 1000.0)
+            self._end_chunked()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            logging.warning('Client of subscriber %s went away after %d streamed messages', window.subscriber_id, window.sent)
+            return
+        except (StorageError, PoolTimeoutError) as e:
+            # the response has started, closing the connection is all that is left to tell the client
+            self.close_connection = True
+            logging.error('Stream of subscriber %s failed: %s', window.subscriber_id, e)
+            return
+        finally:
+            self.server.streams.unregister(window)
+        logging.info('Streamed %d messages to subscriber %s', window.sent, window.subscriber_id, extra=PER_REQUEST)
+    
+    def _stream_messages(self, window: QStreamWindow, wake: threading.Event, fmt: str, heartbeat_interval: float):
+        """
+        Write messages to the stream until it is closed or the server drains. Parks on the dispatcher
+        while caught up and on wake while out of credits, never longer than STREAM_CREDIT_POLL_MS, so
+        a closed stream is noticed.
+        """
+        subscriber_id = window.subscriber_id
+        dispatcher = self.server.dispatcher
+        coalescer = self.server.acks.coalescer
+        last_write = time.monotonic()
+        while not window.closed and not self.server.draining:
+            wake.clear()
+            available = window.available
+            if available > 0:
+                # taken before the read, so a publish during it is not missed
+                generation = dispatcher.generation(window.topic)
+                pending_partitions, pending_offsets = highest_offsets(coalescer.offsets(subscriber_id), window.after())
+                rows = self._store('fetch', subscriber_id, min(available, GET_MESSAGE_MAX), pending_partitions, pending_offsets)
+                if rows:
+                    window.delivered(rows)
+                    self._write_chunk(encode_events(plain_rows(rows), fmt))
+                    self.server.streams.count_delivered(len(rows))
+                    last_write = time.monotonic()
+                    continue
+            timeout = min(max(0.0, last_write + heartbeat_interval - time.monotonic()), STREAM_CREDIT_POLL_MS / 1000.0)
+            with self._parked():
+                if available > 0:
+                    dispatcher.wait(window.topic, generation, timeout)
+                elif not wake.wait(timeout):
+                    # acks made through other server processes only show in the committed offsets
+                    subscriber = self._store('subscriber', subscriber_id)
+                    if subscriber is None:
+                        break
+                    window.committed(coalescer.merge_offsets(subscriber_id, subscriber['_offsets']))
+            if time.monotonic() - last_write >= heartbeat_interval:
+                # the subscriber may have been deleted through another server process
+                if self._store('subscriber_topic', subscriber_id) is None:
+                    break
+                self._write_chunk(heartbeat(fmt))
+                last_write = time.monotonic()
+    
+    def _int_list(self, name: str) -> list:
+        """
+        Integer list parameter, from repeated query parameters or a JSON list. Raises ValueError.
+        """
+        value = self._query_params.get(name) or []
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        try:
+            return [int(v) for v in value]
+        except (TypeError, ValueError):
+            raise ValueError(f'Expected a list of integers for the {name} parameter. Got [{value}].')
+    
+    def _ack_mode(self) -> str:
+        """
+        The ack_mode parameter, None when not given. Raises ValueError.
+        """
+        value = self._query_params.get('ack_mode')
+        value = (value[0] if isinstance(value, (list, tuple)) else value) or None
+        if value is not None and value not in ACK_MODES:
+            raise ValueError(f'Expected one of {", ".join(ACK_MODES)} for the ack_mode parameter. Got [{value}].')
+        return value
+    
+    def _partition_offsets(self) -> tuple:
+        """
+        Offsets to ack as parallel (partitions, offsets) lists, from the offsets and partitions list
+        parameters or a single offset and partition. Partitions default to 0, the only partition of an
+        unpartitioned topic. Raises ValueError.
+        """
+        offsets = self._int_list('offsets')
+        partitions = self._int_list('partitions')
+        if not offsets:
+            offset = self._query_params.get('offset')
+            offset = offset[0] if isinstance(offset, (list, tuple)) else offset
+            if offset is not None:
+                partition = self._query_params.get('partition', 0)
+                partition = partition[0] if isinstance(partition, (list, tuple)) else partition
+                try:
+                    offsets, partitions = [int(offset)], [int(partition)]
+                except (TypeError, ValueError):
+                    raise ValueError(f'Expected integer values for the offset and partition parameters. Got [{offset}], [{partition}].')
+        if not partitions:
+            partitions = [0] * len(offsets)
+        if len(partitions) != len(offsets):
+            raise ValueError(f'Expected one partition per offset. Got {len(partitions)} partitions and {len(offsets)} offsets.')
+        return partitions, offsets
+    
+    def _after_offsets(self) -> tuple:
+        """
+        Read cursor of /get_message as parallel (partitions, offsets) lists, from the after_partitions
+        and after_offsets parameters. Raises ValueError.
+        """
+        offsets = self._int_list('after_offsets')
+        partitions = self._int_list('after_partitions') or [0] * len(offsets)
+        if len(partitions) != len(offsets):
+            raise ValueError(f'Expected one partition per offset. Got {len(partitions)} after_partitions and {len(offsets)} after_offsets.')
+        return partitions, offsets
+    
+    # consumer group claim route: /group_fetch?subscriber_id=<subscriber_id>&partitions=<partition>&offsets=<offset>...&num_messages=20&lease_ms=<ms>&wait_ms=0
+    # acks the given messages and leases the next messages no other member of the group holds
+    def do_group_fetch(self):
+        subscriber_id = self._query_params.get('subscriber_id')
+        values = {}
+        err_msg = []
+        if subscriber_id:
+            for name, default in (('subscriber_id', None), ('num_messages', 1), ('lease_ms', None), ('wait_ms', 0)):
+                value = self._query_params.get(name, default)
+                value = value[0] if isinstance(value, (list, tuple)) else value
+                if value is None and name == 'lease_ms':
+                    # the group default
+                    values[name] = None
+                    continue
+                try:
+                    values[name] = int(value)
+                except (TypeError, ValueError):
+                    err_msg.append(f'Expected integer value for the {name} parameter. Got [{value}].')
+            try:
+                partitions, offsets = self._partition_offsets()
+            except ValueError as e:
+                err_msg.append(str(e))
+            if err_msg:
+                logging.error('\n'.join(err_msg))
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': '<br>'.join(err_msg)})
+                return
+            # the acks are committed with the first claim, later polls only claim
+            res = self._get_messages(values['subscriber_id'], values['wait_ms'],
+                                     'group_fetch',
+                                     (values['subscriber_id'], partitions, offsets, values['num_messages'], values['lease_ms']),
+                                     (values['subscriber_id'], [], [], values['num_messages'], values['lease_ms']))
+            logging.info('Acked %d and claimed %d messages for subscriber %s', len(offsets), len(res),
+                         values['subscriber_id'], extra=PER_REQUEST)
+            self._send_messages(res)
+        else:
+            self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                            {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': "Missing parameter: subscriber_id"})
+    
+    # consumer group ack route: /group_ack?subscriber_id=<subscriber_id>&partitions=<partition>&offsets=<offset>&partitions=<partition>&offsets=<offset>...
+    def do_group_ack(self):
+        subscriber_id = self._query_params.get('subscriber_id')
+        if subscriber_id:
+            err_msg = []
+            try:
+                subscriber_id = int(subscriber_id[0] if isinstance(subscriber_id, (list, tuple)) else subscriber_id)
+            except ValueError:
+                err_msg.append(f'Expected integer value for the subscriber_id parameter. Got [{subscriber_id}].')
+            try:
+                partitions, offsets = self._partition_offsets()
+            except ValueError as e:
+                err_msg.append(str(e))
+            if err_msg:
+                logging.error('\n'.join(err_msg))
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': '<br>'.join(err_msg)})
+                return
+            res = self._store('group_ack', subscriber_id, partitions, offsets)
+            if res is None:
+                err_msg = f'Subscriber {subscriber_id} is not a member of a consumer group'
+                logging.error(err_msg)
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
+                return
+            self._send_json({'subscriber_id': subscriber_id, 'acked': len(offsets), 'group_offsets': res})
+        else:
+            self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                            {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': "Missing parameter: subscriber_id"})
+    
+    # ack_message route: /ack_message?subscriber_id=<subscriber_id>&offset=<offset>&partition=<partition>&ack_mode=<durable|coalesced>
+    # a coalesced ack is answered before it is committed, see queue_acks.py
     def do_ack_message(self):
         subscriber_id = self._query_params.get('subscriber_id')
         offset = self._query_params.get('offset')
+        partition = self._query_params.get('partition', 0)
         err_msg = []
         if subscriber_id and offset:
             try:
@@ -326,17 +1312,29 @@ class QRequestHandler(BaseHTTPRequestHandler):
                 offset = int(offset[0] if isinstance(offset, (list, tuple)) else offset)
             except ValueError:
                 err_msg.append(f'Expected integer value for the offset parameter. Got [{offset}].')
+            try:
+                partition = int(partition[0] if isinstance(partition, (list, tuple)) else partition)
+            except ValueError:
+                err_msg.append(f'Expected integer value for the partition parameter. Got [{partition}].')
+            try:
+                ack_mode = self._ack_mode()
+            except ValueError as e:
+                err_msg.append(str(e))
             if err_msg:
                 logging.error('\n'.join(err_msg))
-                send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
-                           {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': '<br>'.join(err_msg)})
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
+                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': '<br>'.join(err_msg)})
                 return
-            with db_connect(DB_URI, cursor_factory=RealDictCursor) as conn:
-                with conn.cursor() as cur:
-                    cur.execute("""select * from ack_message(%s, %s);""", (subscriber_id, offset))
-                    res = cur.fetchone()
-            self._set_response()
-            self.wfile.write(json.dumps(res, default=str).encode('utf-8'))
+            coalescer = self.server.acks.coalescer
+            res = None if ack_mode == 'durable' else coalescer.ack(subscriber_id, partition, offset, ack_mode)
+            if res is None:
+                res = self._store('ack', subscriber_id, offset, partition, ack_mode)
+                # the row tells the coalescer the subscriber's topic, partitions and ack mode for its next acks
+                coalescer.learn(res)
+                coalescer.settle(subscriber_id, [partition], [offset])
+            if res is not None:
+                self.server.streams.acked(subscriber_id, [partition], [offset])
+            self._send_json(res)
         else:
             self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
                             {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': "Missing parameter: topic"})
@@ -355,23 +1353,15 @@ class QRequestHandler(BaseHTTPRequestHandler):
                 self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
                 return
-            try:
-                with db_connect(DB_URI, cursor_factory=RealDictCursor) as conn:
-                    with conn.cursor() as cur:
-                        cur.execute("""select topic_reset(%s, %s);""", (target_topic, offset - 1))
-                        res = cur.fetchone()
-            except psycopg2.errors.IntegrityError as e:
-                conn.rollback()
-                err_msg = f'The topic "{new_topic}" does not exist'
-                logging.error(err_msg)
-                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, 
-                                {'http_status': HTTPStatus.UNPROCESSABLE_ENTITY, 'error_message': err_msg})
-                return
+            # coalesced acks made before the reset must not land after it
+            self.server.acks.flush()
+            res = self._store('topic_reset', target_topic, offset - 1)
+            self.server.tail_cache.invalidate(target_topic)
+            self.server.acks.coalescer.discard_topic(target_topic)
             
-            logging.info(f'Set {res["topic_reset"]} subscribers of topic {target_topic} to reprocess any messages starting at offset {offset}')
+            logging.info(f'Set {res} subscribers of topic {target_topic} to reprocess any messages starting at offset {offset}')
             if self.command == 'GET':
-                self._set_response()
-                self.wfile.write(json.dumps({'topic': target_topic, 'offset': offset, 'subscriber_count': res['topic_reset']}, default=str).encode('utf-8'))
+                self._send_json({'topic': target_topic, 'offset': offset, 'subscriber_count': res})
             else:
                 self._set_response(headers={})
         else:
@@ -381,10 +1371,44 @@ class QRequestHandler(BaseHTTPRequestHandler):
         
         
 
-def run(server_class=ThreadingHTTPServer, handler_class=QRequestHandler, port=DEFAULT_PORT):
-    logging.basicConfig(level=logging.INFO)
+def run_worker(index: int, metrics_dir: str, server_class=QHTTPServer, handler_class=QRequestHandler, port=DEFAULT_PORT,
+               storage_backend: str=None):
+    """
+    One pre-fork worker: serves until SIGTERM, then drains and returns its exit status.
+    """
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    threading.current_thread().name = f'worker-{index}'
+    setup_logging()
+    # the pool, listener and background threads are created here, after the fork
+    httpd = server_class(('', port), handler_class, reuse_port=True, storage_backend=storage_backend)
+    httpd.worker_metrics = QWorkerMetrics(metrics_dir, httpd.metrics)
+    httpd.worker_metrics.start()
+    threading.Thread(target=httpd.serve_forever, name='serve', daemon=True).start()
+    logging.info('Worker %d (pid %d) serving on port %d', index, os.getpid(), port)
+    while not stop.wait(1.0):
+        pass
+    logging.info('Worker %d draining...', index)
+    if not httpd.drain():
+        logging.warning('Worker %d stopped with requests still running', index)
+    httpd.server_close()
+    httpd.worker_metrics.stop()
+    stop_logging()
+    return 0
+
+
+def run(server_class=QHTTPServer, handler_class=QRequestHandler, port=DEFAULT_PORT, storage: QStorage=None,
+        workers: int=1, storage_backend: str=None):
+    if workers > 1:
+        # the supervisor only logs synchronously, so no logging thread is lost across fork()
+        setup_logging(async_mode=False)
+        target = lambda index, metrics_dir: run_worker(index, metrics_dir, server_class, handler_class, port,
+                                                       storage_backend)
+        QPreforkSupervisor(target, workers).run()
+        return
+    setup_logging()
     server_address = ('', port)
-    httpd = server_class(server_address, handler_class)
+    httpd = server_class(server_address, handler_class, storage=storage, storage_backend=storage_backend)
     logging.info('Starting httpd...\n')
     try:
         httpd.serve_forever()
@@ -392,13 +1416,36 @@ def run(server_class=ThreadingHTTPServer, handler_class=QRequestHandler, port=DE
         pass
     httpd.server_close()
     logging.info('Stopping httpd...\n')
+    stop_logging()
 
 if __name__ == '__main__':
-    from sys import argv
+    import argparse
     
-    if len(argv) == 2:
-        run(port=int(argv[1]))
-    else:
-        run()
+    parser = argparse.ArgumentParser(description='Queue HTTP server')
+    parser.add_argument('port', nargs='?', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--engine', choices=['threaded', 'asyncio'], default=os.environ.get('QUEUE_SERVER_ENGINE', 'threaded'),
+                        help='threaded: one OS thread per connection (ThreadingHTTPServer), asyncio: event loop with an asyncpg pool')
+    parser.add_argument('--storage', choices=STORAGE_BACKENDS, default=QUEUE_STORAGE,
+                        help='postgres: the database at DB_URI, segment_log: embedded segment files in --data-dir (threaded engine only)')
+    parser.add_argument('--data-dir', default=SEGMENT_LOG_DIR, help='Directory of the segment_log storage')
+    parser.add_argument('--workers', type=int, default=QUEUE_WORKERS,
+                        help='Pre-forked worker processes sharing the port with SO_REUSEPORT (threaded engine, postgres storage)')
+    args = parser.parse_args()
     
-
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.engine == 'asyncio':
+        if args.storage != 'postgres':
+            parser.error('the asyncio engine only runs on the postgres storage')
+        if args.workers > 1:
+            parser.error('--workers only applies to the threaded engine')
+        import queue_async_server
+        queue_async_server.run(port=args.port)
+    elif args.workers > 1:
+        if args.storage != 'postgres':
+            # segment files have a single writer, the process that opened them
+            parser.error('--workers needs the postgres storage')
+        run(port=args.port, workers=args.workers, storage_backend=args.storage)
+    else:
+        run(port=args.port, storage=QSegmentLogStorage(args.data_dir) if args.storage == 'segment_log' else None,
+            storage_backend=args.storage)
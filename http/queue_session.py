@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Shared requests.Session setup for the publisher and subscriber clients.
+
+A session keeps HTTP/1.1 connections to the queue server open between calls instead of
+opening a new TCP connection per request.
+
+The server answers 429 (a topic over its publish rate) or 503 (overloaded) with a Retry-After
+header only when it did nothing with the request (see queue_admission.py), so those responses
+are retried for every method, after the Retry-After delay plus up to half of it again. The
+jitter keeps clients that were turned away together from coming back together.
+"""
+import random
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+
+# methods that are safe to retry when the request may already have reached the server
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+# rejections the server sends before doing anything, retried for every method when they carry Retry-After
+RETRY_AFTER_STATUSES = frozenset([429, 503])
+
+
+def jittered(seconds: float) -> float:
+    """
+    seconds plus a random delay of up to half of it.
+    """
+    return seconds * (1.0 + random.random() * 0.5)
+
+
+class QRetry(Retry):
+    """
+    Retry policy that also retries rejected requests of any method, and adds jitter to every delay.
+    """
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if self.total and self.respect_retry_after_header and has_retry_after and status_code in RETRY_AFTER_STATUSES:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def parse_retry_after(self, retry_after):
+        return jittered(super().parse_retry_after(retry_after))
+
+    def get_backoff_time(self):
+        return jittered(super().get_backoff_time())
+
+
+def make_session(pool_size: int=DEFAULT_POOL_SIZE, retries: int=DEFAULT_RETRIES, backoff_factor: float=0.2) -> requests.Session:
+    """
+    Build a session with a connection pool of pool_size connections per host. Failures to
+    connect are retried for every method; read errors and 502/503/504 responses are only
+    retried for idempotent methods so a POSTed message is never published twice, unless the
+    server sent Retry-After.
+    """
+    retry_kwargs = {'total': retries,
+                    'connect': retries,
+                    'read': retries,
+                    'status': retries,
+                    'backoff_factor': backoff_factor,
+                    'status_forcelist': (502, 503, 504),
+                    'raise_on_status': False}
+    try:
+        retry = QRetry(allowed_methods=IDEMPOTENT_METHODS, **retry_kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        retry = QRetry(method_whitelist=IDEMPOTENT_METHODS, **retry_kwargs)
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
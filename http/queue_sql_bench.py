@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Per call latency of the hot route statements, run the way the threaded server ran them before
+(plain statements, parsed and planned by PostgreSQL on every call) and the way it runs them now
+(server-side prepared statements, see QConnectionPool.execute_prepared), against the stored
+functions as they were before and as they are now.
+
+The static functions are the save_message(), get_message() and ack_message() of
+init/10_create_schema.sql, whose inner statements are static SQL that plpgsql plans once per
+connection. The legacy functions (LEGACY_FUNCTIONS) do the same work the way the schema used
+to: every statement is built with quote_literal() and run with EXECUTE, so it is parsed and
+planned on every call, LIMIT included. They are installed under legacy_* names for the run and
+dropped afterwards.
+
+For each combination of functions and mode a topic is created, --calls messages are
+published one by one, then read and acked one by one by a subscriber, each call in its own
+transaction on a single connection like a request.
+
+Usage::
+    DB_URI=postgresql://queues@localhost:5432/queues ./queue_sql_bench.py [--calls 5000] [--modes plain prepared] [--functions static legacy]
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+from psycopg2 import connect as db_connect
+from psycopg2.extras import RealDictCursor
+
+from queue_db_pool import QConnectionPool
+from queue_statements import HOT_STATEMENTS
+
+DB_URI = os.environ.get('DB_URI', 'postgresql://queues@localhost:5432/queues')
+
+MODES = ('plain', 'prepared')
+FUNCTIONS = ('static', 'legacy')
+OPERATIONS = (('publish', 'q_save_message'), ('fetch', 'q_get_message'), ('ack', 'q_ack_message'))
+
+# the hot statements with the legacy functions in place of the static ones
+LEGACY_STATEMENTS = {**HOT_STATEMENTS,
+                     'q_save_message': """select * from legacy_save_message($1, $2, $3, $4::bytea, $5)""",
+                     'q_get_message': """select * from legacy_get_message($1, $2, $3::int[], $4::bigint[])""",
+                     'q_ack_message': """select * from legacy_ack_message($1, $2, $3)"""}
+
+LEGACY_FUNCTIONS = """
+create or replace function legacy_save_message(p_topic text, p_message text, p_key text = null, p_payload bytea = null,
+                                               p_encoding text = null) returns setof topic_message as $BODY$
+declare
+    v_partition int := topic_pick_partition(p_topic, p_key);
+    v_offset bigint := null::bigint;
+    v_segment_head bigint := null::bigint;
+begin
+    execute $$update "topic_partition" tp
+                 set head_offset = tp.head_offset + 1
+               where tp.topic = $$ || quote_literal(p_topic) || $$
+                 and tp._partition = $$ || quote_literal(v_partition) || $$
+              returning tp.head_offset, tp.segment_head;$$
+       into v_offset, v_segment_head;
+
+    if ( v_offset > v_segment_head ) then
+        perform topic_add_segments(p_topic, v_partition, v_offset);
+    end if;
+
+    return query execute $$insert into "topic_message" (topic, _partition, _offset, message, payload, encoding)
+                           values ($$ || quote_literal(p_topic) || $$, $$ || quote_literal(v_partition) || $$, $$
+                                     || quote_literal(v_offset) || $$, $$ || quote_nullable(p_message) || $$, $$
+                                     || quote_nullable(p_payload) || $$::bytea, $$ || quote_nullable(p_encoding) || $$)
+                           returning *;$$;
+
+    perform pg_notify('topic_publish',
+                      json_build_object('topic', p_topic, 'partition', v_partition, 'offset', v_offset)::text);
+end;
+$BODY$
+language plpgsql;
+
+create or replace function legacy_get_message(subscriber_id int, num_messages int = 1, p_partitions int[] = '{}',
+                                              p_offsets bigint[] = '{}') returns setof topic_message as $BODY$
+declare
+    v_group boolean := null::boolean;
+begin
+    if ( num_messages < 1 ) then
+        num_messages = 1;
+    end if;
+
+    if ( num_messages > 20 ) then
+        num_messages = 20;
+    end if;
+
+    execute $$select ts.group_id is not null
+                from "topic_subscriber" ts
+               where ts.id = $$ || quote_literal(subscriber_id) || $$;$$
+       into v_group;
+
+    if ( v_group ) then
+        return query select * from group_claim(legacy_get_message.subscriber_id, num_messages);
+        return;
+    end if;
+
+    return query execute $$select m.*
+                             from "topic_subscriber" ts
+                            cross
+                             join lateral unnest(ts.partitions) as p(_partition)
+                            cross
+                             join lateral (
+                                    select max(a._offset) as _offset
+                                      from unnest($$ || quote_literal(p_partitions) || $$::int[],
+                                                  $$ || quote_literal(p_offsets) || $$::bigint[]) as a(_partition, _offset)
+                                     where a._partition = p._partition
+                                  ) as pending
+                            cross
+                             join lateral (
+                                    select tm.*
+                                      from "topic_message" tm
+                                     where tm.topic = ts.topic
+                                       and tm._partition = p._partition
+                                       and tm._offset > greatest(ts._offsets[p._partition + 1], pending._offset)
+                                     order
+                                        by tm._offset
+                                     limit $$ || quote_literal(num_messages) || $$
+                                  ) as m
+                            where ts.id = $$ || quote_literal(subscriber_id) || $$
+                            order
+                               by m._offset, m._partition
+                            limit $$ || quote_literal(num_messages) || $$;$$;
+end;
+$BODY$
+language plpgsql returns null on null input;
+
+create or replace function legacy_ack_message(subscriber_id int, _offset int, _partition int = 0) returns setof topic_subscriber as $BODY$
+declare
+    v_group boolean := null::boolean;
+begin
+    execute $$select ts.group_id is not null
+                from "topic_subscriber" ts
+               where ts.id = $$ || quote_literal(subscriber_id) || $$;$$
+       into v_group;
+
+    if ( v_group ) then
+        perform group_ack(legacy_ack_message.subscriber_id, array[legacy_ack_message._partition],
+                          array[legacy_ack_message._offset]::bigint[]);
+        return query select * from "topic_subscriber" ts where ts.id = legacy_ack_message.subscriber_id;
+        return;
+    end if;
+
+    return query execute $$update "topic_subscriber" ts
+                              set _offsets[$$ || quote_literal(_partition + 1) || $$] = $$ || quote_literal(_offset) || $$,
+                                  action_ts = current_timestamp
+                            where ts.id = $$ || quote_literal(subscriber_id) || $$
+                              and $$ || quote_literal(_partition) || $$ = any(ts.partitions)
+                           returning ts.*;$$;
+end;
+$BODY$
+language plpgsql;
+"""
+
+
+def plain_sql(statements: dict, statement: str) -> str:
+    # $1, $2, ... are numbered in the order they are passed
+    return re.sub(r'\$\d+', '%s', statements[statement]) + ';'
+
+
+def timed_call(pool: QConnectionPool, mode: str, statement: str, args: tuple, samples: list):
+    start = time.perf_counter()
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            if mode == 'prepared':
+                pool.execute_prepared(cur, statement, args)
+            else:
+                cur.execute(plain_sql(pool.prepared, statement), args)
+            rows = cur.fetchall()
+    samples.append(time.perf_counter() - start)
+    return rows
+
+
+def summary(samples: list) -> dict:
+    samples = sorted(samples)
+    return {'calls': len(samples),
+            'mean_us': round(sum(samples) * 1e6 / len(samples), 1),
+            'p50_us': round(samples[len(samples) // 2] * 1e6, 1),
+            'p99_us': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6, 1)}
+
+
+def run_mode(functions: str, mode: str, topic: str, calls: int, message: str) -> dict:
+    statements = LEGACY_STATEMENTS if functions == 'legacy' else HOT_STATEMENTS
+    pool = QConnectionPool(DB_URI, min_size=1, max_size=1, prepared=statements, cursor_factory=RealDictCursor)
+    samples = {name: [] for name, _ in OPERATIONS}
+    try:
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""select topic_create(%s, %s);""", (topic, 'prepared statement benchmark'))
+                cur.execute("""select topic_subscribe(%s) as subscriber_id;""", (topic,))
+                subscriber_id = cur.fetchone()['subscriber_id']
+
+        for _ in range(calls):
+            timed_call(pool, mode, 'q_save_message', (topic, message, None, None, None), samples['publish'])
+        for _ in range(calls):
+            rows = timed_call(pool, mode, 'q_get_message', (subscriber_id, 1, [], []), samples['fetch'])
+            if not rows:
+                break
+            timed_call(pool, mode, 'q_ack_message', (subscriber_id, rows[0]['_offset'], rows[0]['_partition']),
+                       samples['ack'])
+    finally:
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""select topic_delete(%s);""", (topic,))
+        pool.close()
+    return {'functions': functions, 'mode': mode, **{name: summary(s) for name, s in samples.items() if s}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare plain and prepared hot route statements on static and legacy functions')
+    parser.add_argument('--calls', type=int, default=5000, help='Calls per operation and mode')
+    parser.add_argument('--message-size', type=int, default=100, help='Bytes per message')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES), help='Modes to run')
+    parser.add_argument('--functions', nargs='+', choices=FUNCTIONS, default=list(FUNCTIONS),
+                        help='Stored functions to run: static (current) or legacy (EXECUTE with quote_literal)')
+    parser.add_argument('--topic', default=f'sql-bench-{int(time.time())}', help='Topic prefix (created and deleted)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    legacy = 'legacy' in args.functions
+    if legacy:
+        with db_connect(DB_URI) as conn:
+            with conn.cursor() as cur:
+                cur.execute(LEGACY_FUNCTIONS)
+
+    rows = []
+    try:
+        for functions in args.functions:
+            for mode in args.modes:
+                rows.append(run_mode(functions, mode, f'{args.topic}-{functions}-{mode}', args.calls, 'x' * args.message_size))
+                if not args.json:
+                    r = rows[-1]
+                    print(f"{r['functions']:>6} {r['mode']:>9}  " +
+                          '  '.join(f"{name}: p50={r[name]['p50_us']:8.1f}us p99={r[name]['p99_us']:8.1f}us"
+                                    for name, _ in OPERATIONS if name in r))
+    finally:
+        if legacy:
+            with db_connect(DB_URI) as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""drop function if exists legacy_save_message, legacy_get_message, legacy_ack_message;""")
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+if __name__ == '__main__':
+    main()
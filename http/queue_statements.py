@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""
+SQL of the hot routes, run as server-side prepared statements by the threaded engine (see
+QConnectionPool.execute_prepared) and used as they are by the asyncio engine, whose asyncpg
+connections prepare and cache every statement they run anyway.
+
+Parameters are numbered ($1, $2, ...) and arrays are cast, so each statement is planned with
+the right parameter types the first time it is prepared on a connection.
+"""
+
+HOT_STATEMENTS = {
+    'q_save_message': """select * from save_message($1, $2, $3, $4::bytea, $5)""",
+    'q_save_messages': """select * from save_messages($1, $2::text[], $3, $4::bytea[], $5::text[])""",
+    'q_get_message': """select * from get_message($1, $2, $3::int[], $4::bigint[])""",
+    'q_ack_fetch': """select * from ack_fetch($1, $2::int[], $3::bigint[], $4)""",
+    'q_group_fetch': """select * from group_fetch($1, $2::int[], $3::bigint[], $4, $5)""",
+    'q_group_ack': """select group_ack($1, $2::int[], $3::bigint[])""",
+    'q_ack_message': """select * from ack_message($1, $2, $3)""",
+    'q_subscriber': """select topic, _offsets, partitions, group_id from topic_subscriber where id = $1""",
+    'q_subscriber_topic': """select topic from topic_subscriber where id = $1""",
+    'q_topic_compression': """select compression from topic where topic = $1""",
+}
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Storage interface behind the threaded server's message routes, and its PostgreSQL backend.
+
+The request handler parses and validates a request, then calls the storage for anything that
+reads or writes topics, messages and subscriber offsets. QPostgresStorage runs the stored
+functions of init/10_create_schema.sql through a QConnectionPool; QSegmentLogStorage
+(queue_segment_log.py) keeps everything in local files, for single node deployments and for
+running the server without a database.
+
+Rows are dicts shaped like the topic_message and topic_subscriber rows of the database, offsets
+of a subscriber are a list with the offset of partition p at index p. A message row of a topic
+with compression has either the text in message, or the compressed bytes in payload with their
+encoding (see queue_compression.py).
+
+Routes that only exist on the database (listings, retention policies, consumer groups, pool
+statistics) raise StorageNotSupportedError on other backends, which the server answers with
+501 Not Implemented.
+"""
+from contextlib import contextmanager
+import threading
+
+from queue_compression import encode_payload
+
+
+class StorageError(Exception):
+    pass
+
+
+class TopicExistsError(StorageError):
+    pass
+
+
+class TopicNotFoundError(StorageError):
+    pass
+
+
+class InvalidTopicError(StorageError):
+    pass
+
+
+class StorageNotSupportedError(StorageError):
+    pass
+
+
+class QStorage:
+    name = None
+    # the connection pool of a database backed storage, None otherwise
+    db_pool = None
+
+    def topic_create(self, topic: str, description: str, partitions: int=None, segment_size: int=None,
+                     retention_ms: int=None, retention_messages: int=None, retention_acked: bool=False,
+                     compression: str=None) -> str:
+        """
+        Returns the topic. Raises TopicExistsError, or InvalidTopicError for a name the backend cannot store.
+        """
+        raise NotImplementedError
+
+    def forget_topic(self, topic: str):
+        """
+        Drop what is cached about topic, after another server process deleted it.
+        """
+        pass
+
+    def topic_delete(self, topic: str) -> str:
+        """
+        Delete the topic with its messages and subscribers. Returns the topic, None if it did not exist.
+        """
+        raise NotImplementedError
+
+    def topic_reset(self, topic: str, offset: int) -> int:
+        """
+        Set every partition offset of the topic's subscribers to offset (the last processed one).
+        Returns the number of subscribers reset.
+        """
+        raise NotImplementedError
+
+    def append(self, topic: str, message: str, key: str=None) -> dict:
+        """
+        Publish one message. Returns its row. Raises TopicNotFoundError.
+        """
+        raise NotImplementedError
+
+    def append_batch(self, topic: str, messages: list, key: str=None) -> dict:
+        """
+        Publish messages to one partition in order. Returns {_partition, first_offset, last_offset}.
+        Raises TopicNotFoundError.
+        """
+        raise NotImplementedError
+
+    def subscribe(self, topic: str, group: str=None, partitions: list=None, ack_mode: str=None) -> int:
+        """
+        Returns the id of a new subscriber starting at the head of the topic. Raises
+        TopicNotFoundError, or ValueError for partitions the topic does not have.
+        """
+        raise NotImplementedError
+
+    def unsubscribe(self, subscriber_id: int) -> int:
+        raise NotImplementedError
+
+    def subscriber(self, subscriber_id: int) -> dict:
+        """
+        topic, _offsets, partitions and group_id of the subscriber, None if it does not exist.
+        """
+        raise NotImplementedError
+
+    def subscriber_topic(self, subscriber_id: int) -> str:
+        row = self.subscriber(subscriber_id)
+        return row['topic'] if row is not None else None
+
+    def fetch(self, subscriber_id: int, num_messages: int, pending_partitions: list=(), pending_offsets: list=()) -> list:
+        """
+        The next messages after the subscriber's offsets, raised to the pending (not yet stored)
+        acks, merged on offset. Does not move the offsets.
+        """
+        raise NotImplementedError
+
+    def ack(self, subscriber_id: int, offset: int, partition: int=0, ack_mode: str=None) -> dict:
+        """
+        Set the subscriber's offset of partition. Returns the subscriber row, None when the
+        subscriber does not consume that partition.
+        """
+        raise NotImplementedError
+
+    def ack_fetch(self, subscriber_id: int, partitions: list, offsets: list, num_messages: int) -> list:
+        """
+        Ack offsets[i] of partitions[i] and fetch the next messages in one step.
+        """
+        raise NotImplementedError
+
+    def group_fetch(self, subscriber_id: int, partitions: list, offsets: list, num_messages: int, lease_ms: int=None) -> list:
+        raise StorageNotSupportedError(f'Consumer groups need the postgres storage, not {self.name}')
+
+    def group_ack(self, subscriber_id: int, partitions: list, offsets: list) -> list:
+        raise StorageNotSupportedError(f'Consumer groups need the postgres storage, not {self.name}')
+
+    def lag(self, topic: str=None) -> list:
+        """
+        Rows like topic_lag(): per subscriber (of topic, or of every topic) and consumed partition
+        the head offset, committed offset, lag and publish time of the oldest unacked message.
+        """
+        raise NotImplementedError
+
+    def metrics(self) -> list:
+        """
+        Collector for QMetrics.register_collector().
+        """
+        return []
+
+    def close(self):
+        pass
+
+
+class QPostgresStorage(QStorage):
+    name = 'postgres'
+
+    def __init__(self, db_pool):
+        # imported here, so the other backends run without psycopg2 installed
+        import psycopg2.errors
+        self._errors = psycopg2.errors
+        self.db_pool = db_pool
+        # topic -> compression setting, which cannot change while the topic exists
+        self._compression = {}
+        self._compression_lock = threading.Lock()
+
+    @contextmanager
+    def _cursor(self):
+        with self.db_pool.connection() as conn:
+            with conn.cursor() as cur:
+                yield cur
+
+    def _execute(self, cur, statement: str, args: tuple):
+        # one of the HOT_STATEMENTS, prepared once per pool connection
+        self.db_pool.execute_prepared(cur, statement, args)
+
+    def topic_create(self, topic: str, description: str, partitions: int=None, segment_size: int=None,
+                     retention_ms: int=None, retention_messages: int=None, retention_acked: bool=False,
+                     compression: str=None) -> str:
+        try:
+            with self._cursor() as cur:
+                cur.execute("""select topic_create(%s, %s, %s, %s, %s, %s, %s, %s);""",
+                            (topic, description, segment_size, retention_ms, retention_messages, retention_acked, partitions,
+                             compression))
+                return cur.fetchone()['topic_create']
+        except self._errors.IntegrityError:
+            raise TopicExistsError(f'The topic "{topic}" already exists')
+
+    def forget_topic(self, topic: str):
+        with self._compression_lock:
+            self._compression.pop(topic, None)
+
+    def _topic_compression(self, cur, topic: str) -> str:
+        # looked up once per topic, a missing topic is not cached and fails the publish
+        compression = self._compression.get(topic, False)
+        if compression is False:
+            self._execute(cur, 'q_topic_compression', (topic,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            compression = row['compression']
+            with self._compression_lock:
+                self._compression[topic] = compression
+        return compression
+
+    def topic_delete(self, topic: str) -> str:
+        self.forget_topic(topic)
+        with self._cursor() as cur:
+            cur.execute("""select topic_delete(%s);""", (topic,))
+            return cur.fetchone()['topic_delete']
+
+    def topic_reset(self, topic: str, offset: int) -> int:
+        with self._cursor() as cur:
+            cur.execute("""select topic_reset(%s, %s);""", (topic, offset))
+            return cur.fetchone()['topic_reset']
+
+    def append(self, topic: str, message: str, key: str=None) -> dict:
+        try:
+            with self._cursor() as cur:
+                compression = self._topic_compression(cur, topic)
+                payload = encode_payload(message, compression) if compression else None
+                if payload is None:
+                    self._execute(cur, 'q_save_message', (topic, message, key, None, None))
+                else:
+                    self._execute(cur, 'q_save_message', (topic, None, key, payload, compression))
+                return cur.fetchone()
+        except self._errors.IntegrityError:
+            raise TopicNotFoundError(f'Topic "{topic}" does not exist')
+
+    def append_batch(self, topic: str, messages: list, key: str=None) -> dict:
+        try:
+            with self._cursor() as cur:
+                compression = self._topic_compression(cur, topic)
+                payloads = [encode_payload(m, compression) for m in messages] if compression else []
+                if any(p is not None for p in payloads):
+                    self._execute(cur, 'q_save_messages', (topic, [m if p is None else None for m, p in zip(messages, payloads)],
+                                                           key, payloads, [None if p is None else compression for p in payloads]))
+                else:
+                    self._execute(cur, 'q_save_messages', (topic, list(messages), key, None, None))
+                return cur.fetchone()
+        except self._errors.IntegrityError:
+            raise TopicNotFoundError(f'Topic "{topic}" does not exist')
+
+    def subscribe(self, topic: str, group: str=None, partitions: list=None, ack_mode: str=None) -> int:
+        try:
+            with self._cursor() as cur:
+                cur.execute("""select topic_subscribe(%s, %s, %s::int[], %s);""", (topic, group, partitions or None, ack_mode))
+                return cur.fetchone()['topic_subscribe']
+        except self._errors.IntegrityError:
+            raise TopicNotFoundError(f'The topic "{topic}" does not exist')
+        except self._errors.InvalidParameterValue as e:
+            raise ValueError(e.diag.message_primary)
+
+    def unsubscribe(self, subscriber_id: int) -> int:
+        with self._cursor() as cur:
+            cur.execute("""select unsubscribe(%s);""", (subscriber_id,))
+            return cur.fetchone()['unsubscribe']
+
+    def subscriber(self, subscriber_id: int) -> dict:
+        with self._cursor() as cur:
+            self._execute(cur, 'q_subscriber', (subscriber_id,))
+            return cur.fetchone()
+
+    def subscriber_topic(self, subscriber_id: int) -> str:
+        with self._cursor() as cur:
+            self._execute(cur, 'q_subscriber_topic', (subscriber_id,))
+            row = cur.fetchone()
+        return row['topic'] if row is not None else None
+
+    def fetch(self, subscriber_id: int, num_messages: int, pending_partitions: list=(), pending_offsets: list=()) -> list:
+        try:
+            with self._cursor() as cur:
+                self._execute(cur, 'q_get_message', (subscriber_id, num_messages, list(pending_partitions), list(pending_offsets)))
+                return cur.fetchall()
+        except self._errors.IntegrityError:
+            raise StorageError(f'Could not fetch messages for subscriber {subscriber_id}')
+
+    def ack(self, subscriber_id: int, offset: int, partition: int=0, ack_mode: str=None) -> dict:
+        # coalesced acks are held by the server's QAckCoalescer and never get here
+        with self._cursor() as cur:
+            self._execute(cur, 'q_ack_message', (subscriber_id, offset, partition))
+            return cur.fetchone()
+
+    def ack_fetch(self, subscriber_id: int, partitions: list, offsets: list, num_messages: int) -> list:
+        with self._cursor() as cur:
+            self._execute(cur, 'q_ack_fetch', (subscriber_id, partitions, offsets, num_messages))
+            return cur.fetchall()
+
+    def group_fetch(self, subscriber_id: int, partitions: list, offsets: list, num_messages: int, lease_ms: int=None) -> list:
+        with self._cursor() as cur:
+            self._execute(cur, 'q_group_fetch', (subscriber_id, partitions, offsets, num_messages, lease_ms))
+            return cur.fetchall()
+
+    def group_ack(self, subscriber_id: int, partitions: list, offsets: list) -> list:
+        with self._cursor() as cur:
+            self._execute(cur, 'q_group_ack', (subscriber_id, partitions, offsets))
+            return cur.fetchone()['group_ack']
+
+    def lag(self, topic: str=None) -> list:
+        with self._cursor() as cur:
+            cur.execute("""select * from topic_lag(%s);""", (topic,))
+            return cur.fetchall()
+
+    def close(self):
+        self.db_pool.close()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Push delivery for the /stream route, shared by the threaded and asyncio server engines.
+
+A stream is one long-lived response per subscriber. The server reads past the offsets it has
+delivered on the stream and writes each message as soon as it is published, as
+newline-delimited JSON rows (application/x-ndjson) or server-sent events (text/event-stream,
+with the event id partition:offset). The subscriber grants credits: at most that many messages
+(default STREAM_CREDITS, 100) are delivered and not acked. Acks come back through the usual
+/ack_message and /ack_fetch routes, best in coalesced mode. An ack of offset o of a partition
+settles every message of that partition up to o and wakes the stream. A stream out of credits
+also re-reads the committed offsets every STREAM_CREDIT_POLL_MS milliseconds (default 1000),
+because acks made through another server process do not reach it directly.
+
+While there is nothing to send, a heartbeat (an empty line, or an SSE comment) goes out every
+heartbeat_ms (default STREAM_HEARTBEAT_MS, 15000), so dead connections are noticed. The stream
+ends when the subscriber is deleted, or when its topic is reset or deleted. Clients reconnect,
+and a new stream starts after the committed offsets, so messages delivered and not acked are
+delivered again. Consumer group members claim messages with /group_fetch and cannot stream.
+"""
+import collections
+import json
+import os
+import threading
+
+STREAM_CREDITS = int(os.environ.get('STREAM_CREDITS', 100))
+STREAM_MAX_CREDITS = int(os.environ.get('STREAM_MAX_CREDITS', 10000))
+STREAM_HEARTBEAT_MS = int(os.environ.get('STREAM_HEARTBEAT_MS', 15000))
+STREAM_CREDIT_POLL_MS = int(os.environ.get('STREAM_CREDIT_POLL_MS', 1000))
+
+STREAM_FORMATS = {'ndjson': 'application/x-ndjson', 'sse': 'text/event-stream'}
+
+
+def stream_format(format_param: str, accept: str) -> str:
+    """
+    ndjson or sse, from the format parameter or else the Accept header. Raises ValueError.
+    """
+    if format_param:
+        if format_param not in STREAM_FORMATS:
+            raise ValueError(f'Expected one of {", ".join(STREAM_FORMATS)} for the format parameter. Got [{format_param}].')
+        return format_param
+    return 'sse' if accept and STREAM_FORMATS['sse'] in accept else 'ndjson'
+
+
+def encode_events(rows: list, fmt: str) -> bytes:
+    parts = []
+    for row in rows:
+        data = json.dumps(row, default=str)
+        if fmt == 'sse':
+            parts.append(f'id: {row.get("_partition", 0)}:{row["_offset"]}\nevent: message\ndata: {data}\n\n')
+        else:
+            parts.append(data + '\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def heartbeat(fmt: str) -> bytes:
+    return b': keepalive\n\n' if fmt == 'sse' else b'\n'
+
+
+class QStreamWindow:
+    """
+    The credit window of one stream: the offsets it delivered and that are not acked yet, per
+    partition. Thread safe.
+    """
+    def __init__(self, subscriber_id: int, topic: str, credits: int):
+        self.subscriber_id = subscriber_id
+        self.topic = topic
+        self.credits = credits
+        self.closed = False
+        self.sent = 0
+        self._lock = threading.Lock()
+        self._unacked = {}      # partition -> deque of offsets delivered and not acked, ascending
+        self._cursor = {}       # partition -> highest offset delivered
+
+    @property
+    def available(self) -> int:
+        with self._lock:
+            return self.credits - sum(len(offsets) for offsets in self._unacked.values())
+
+    def after(self) -> tuple:
+        """
+        The read cursor as parallel (partitions, offsets) lists.
+        """
+        with self._lock:
+            return list(self._cursor), list(self._cursor.values())
+
+    def delivered(self, rows: list):
+        with self._lock:
+            self.sent += len(rows)
+            for row in rows:
+                partition = row.get('_partition', 0)
+                self._unacked.setdefault(partition, collections.deque()).append(row['_offset'])
+                self._cursor[partition] = max(row['_offset'], self._cursor.get(partition, row['_offset']))
+
+    def acked(self, partition: int, offset: int) -> bool:
+        """
+        Settle the delivered offsets of partition up to offset. Returns True when that freed credits.
+        """
+        with self._lock:
+            offsets = self._unacked.get(partition)
+            freed = False
+            while offsets and offsets[0] <= offset:
+                offsets.popleft()
+                freed = True
+            return freed
+
+    def committed(self, offsets: list) -> bool:
+        """
+        acked() for every partition p at offsets[p], the subscriber's committed offsets.
+        """
+        freed = False
+        for partition, offset in enumerate(offsets):
+            if offset is not None:
+                freed = self.acked(partition, offset) or freed
+        return freed
+
+
+class QStreamRegistry:
+    """
+    The open streams of a server process, so acks and topic changes reach them. wake callbacks
+    are called with the registry lock held and must not block. Thread safe.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._streams = {}      # subscriber_id -> {window: wake}
+        self.opened = 0
+        self.delivered = 0
+
+    def register(self, window: QStreamWindow, wake):
+        with self._lock:
+            self._streams.setdefault(window.subscriber_id, {})[window] = wake
+            self.opened += 1
+
+    def unregister(self, window: QStreamWindow):
+        with self._lock:
+            streams = self._streams.get(window.subscriber_id, {})
+            streams.pop(window, None)
+            if not streams:
+                self._streams.pop(window.subscriber_id, None)
+
+    def count_delivered(self, count: int):
+        with self._lock:
+            self.delivered += count
+
+    def acked(self, subscriber_id: int, partitions: list, offsets: list):
+        with self._lock:
+            for window, wake in self._streams.get(subscriber_id, {}).items():
+                freed = False
+                for partition, offset in zip(partitions, offsets):
+                    freed = window.acked(partition, offset) or freed
+                if freed:
+                    wake()
+
+    def close_subscriber(self, subscriber_id: int):
+        with self._lock:
+            for window, wake in self._streams.get(subscriber_id, {}).items():
+                window.closed = True
+                wake()
+
+    def close_topic(self, topic: str):
+        """
+        End the streams of topic, e.g. after a reset, so their clients start again from the committed offsets.
+        """
+        with self._lock:
+            for streams in self._streams.values():
+                for window, wake in streams.items():
+                    if window.topic == topic:
+                        window.closed = True
+                        wake()
+
+    def metrics(self) -> list:
+        """
+        Collector for QMetrics.register_collector().
+        """
+        with self._lock:
+            open_streams = sum(len(streams) for streams in self._streams.values())
+        return [('queue_streams_open', 'gauge', 'Open /stream responses.', [({}, open_streams)]),
+                ('queue_streams_opened_total', 'counter', '/stream responses started.', [({}, self.opened)]),
+                ('queue_stream_messages_total', 'counter', 'Messages pushed on /stream responses.', [({}, self.delivered)])]
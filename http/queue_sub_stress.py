@@ -1,12 +1,24 @@
 #! /usr/bin/env python3
 
+import os
 import queue_subscriber as qsub
 import sys
 
 topic = sys.argv[1]
+wait_ms = int(os.environ.get('SUB_WAIT_MS', 1000))
+batch_size = int(os.environ.get('SUB_BATCH_SIZE', 20))
+group = os.environ.get('SUB_GROUP') or None
+partitions = [int(p) for p in os.environ.get('SUB_PARTITIONS', '').split(',') if p]
+workers = int(os.environ.get('SUB_WORKERS', 0))
+executor = os.environ.get('SUB_EXECUTOR', 'thread')
+# credits of a /stream subscription, 0 consumes by polling
+stream_credits = int(os.environ.get('SUB_STREAM_CREDITS', 0))
 
-qs = qsub.QSubscriber(topic, 0, 10)
-qs.consume()
+qs = qsub.QSubscriber(topic, 0, 10, wait_ms, batch_size, group, partitions=partitions, workers=workers, executor=executor)
+if stream_credits:
+    qs.stream(credits=stream_credits)
+else:
+    qs.consume()
 
 
     
@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 
+from concurrent import futures
 from http import HTTPStatus
 import json
 import logging
 import os
-import requests
 import sys
+import threading
 import time
 
+import requests
+
+from queue_session import make_session, DEFAULT_POOL_SIZE, DEFAULT_RETRIES
+from queue_watermark import QOffsetWatermark
+from queue_wire import ACCEPT_FRAMES, decode_rows, frames_version
+
 PUBLISHER_URL = os.environ.get('PUBLISHER_URL', 'http://queues-server:8888')
 
+EXECUTORS = {'thread': futures.ThreadPoolExecutor, 'process': futures.ProcessPoolExecutor}
+
 
 class ContentTypeError(Exception):
     pass
@@ -20,12 +29,38 @@ class UnsubscribedError(Exception):
 
 
 class QSubscriber:
-    def __init__(self, topic: str, sleep_time: int, exit_after: int):
+    def __init__(self, topic: str, sleep_time: int, exit_after: int, wait_ms: int=1000, batch_size: int=20,
+                 group: str=None, lease_ms: int=None, pool_size: int=DEFAULT_POOL_SIZE, retries: int=DEFAULT_RETRIES,
+                 partitions: list=None, ack_mode: str=None, frames: bool=True, workers: int=0, executor: str='thread',
+                 max_in_flight: int=None):
+        self._session = make_session(pool_size, retries)
         self.topic = topic
         self.sleep_time = sleep_time
         self.exit_after = exit_after
+        # long-poll wait on /get_message, sleep_time is only used between polls when this is 0
+        self.wait_ms = wait_ms
+        # messages fetched per round trip by consume(), which acks once per batch
+        self.batch_size = batch_size
+        # members of a consumer group share its offset and claim disjoint messages, leased for lease_ms
+        self.group = group
+        self.lease_ms = lease_ms
+        # partitions of the topic to consume, all of them when not given
+        self.partitions = list(partitions) if partitions else None
+        # 'coalesced' lets the server batch this subscriber's /ack_message writes, 'durable' (the default) commits each one
+        self.ack_mode = ack_mode
+        # ask for fetched messages in the binary framed format of queue_wire.py, servers without it answer with JSON
+        self.frames = frames
+        # with workers > 0 consume() hands messages to a pool of that many threads or processes, and at
+        # most max_in_flight messages are fetched and not handled yet
+        if executor not in EXECUTORS:
+            raise ValueError(f'executor must be one of {", ".join(EXECUTORS)}')
+        self.workers = workers
+        self.executor = executor
+        self.max_in_flight = max_in_flight or max(2 * workers, batch_size)
+        # partition -> QOffsetWatermark of the offsets handled, memory is bounded by the in-flight window
+        self._watermarks = {}
+        self._watermarks_lock = threading.Lock()
         self.subscribe()
-        self.processed = set()
         filename = f'{self.topic}_subscriber_{self.subscriber_id}.log'
         logging.basicConfig(filename=filename,
                             filemode='w',
@@ -33,12 +68,14 @@ class QSubscriber:
                             level=logging.INFO)
         self._log = logging.getLogger(filename)
     
-    def _handle_request(self, url: str, data: dict, request_type: str='get'):
-        rmethod = getattr(requests, request_type)
+    def _handle_request(self, url: str, data: dict, request_type: str='get', fetch: bool=False):
+        rmethod = getattr(self._session, request_type)
         if request_type == 'post':
             rargs = {'json': data}
         else:
             rargs = {'params': data}
+        if fetch and self.frames:
+            rargs['headers'] = {'Accept': ACCEPT_FRAMES}
         res = rmethod(url, **rargs)
         res.raise_for_status()
         
@@ -46,69 +83,387 @@ class QSubscriber:
             if res.headers and 'Content-type' in res.headers:
                 if res.headers['Content-type'] == 'application/json':
                     return res.json()
+                elif frames_version(res.headers['Content-type']):
+                    return decode_rows(res.content, self.topic, frames_version(res.headers['Content-type']))
                 else:
                     raise ContentTypeError(f'Expected "application/json" but got {res.headers["Content-type"]}')
 
+    def close(self):
+        self._session.close()
+    
     def subscribe(self):
-        data = self._handle_request(f'{PUBLISHER_URL}/subscribe', {'topic': self.topic})
+        params = {'topic': self.topic}
+        if self.group:
+            params['group'] = self.group
+        if self.partitions:
+            params['partitions'] = self.partitions
+        if self.ack_mode:
+            params['ack_mode'] = self.ack_mode
+        data = self._handle_request(f'{PUBLISHER_URL}/subscribe', params)
         if data:
             self.subscriber_id = data['subscriber_id']
     
     def unsubscribe(self):
         data = self._handle_request(f'{PUBLISHER_URL}/unsubscribe', {'subscriber_id': self.subscriber_id}, 'post')
     
-    def ack_message(self, _offset: int):
-        data = self._handle_request(f'{PUBLISHER_URL}/ack_message', {'subscriber_id': self.subscriber_id, 'offset': _offset}, 'post')
+    def ack_message(self, _offset: int, partition: int=0, ack_mode: str=None):
+        # ack_mode overrides the subscriber's mode for this ack
+        params = {'subscriber_id': self.subscriber_id, 'offset': _offset, 'partition': partition}
+        if ack_mode:
+            params['ack_mode'] = ack_mode
+        data = self._handle_request(f'{PUBLISHER_URL}/ack_message', params, 'post')
 
+    def get_messages(self, after: dict=None, num_messages: int=None, wait_ms: int=None) -> list:
+        """
+        Fetch up to num_messages (default batch_size) messages, reading past after (the highest offset
+        already delivered per partition) without acking anything.
+        """
+        if not self.subscriber_id:
+            raise UnsubscribedError(f"Not subscribed to topic {self.topic}")
+        
+        params = {'subscriber_id': self.subscriber_id, 'num_messages': num_messages or self.batch_size}
+        wait_ms = self.wait_ms if wait_ms is None else wait_ms
+        if wait_ms:
+            params['wait_ms'] = wait_ms
+        if after:
+            params['after_partitions'] = list(after)
+            params['after_offsets'] = list(after.values())
+        data = self._handle_request(f'{PUBLISHER_URL}/get_message', params, fetch=True)
+        # a single message comes back on its own in JSON
+        return [data] if isinstance(data, dict) else data or []
+    
     def get_message(self):
         # candidate for async
         if not self.subscriber_id:
             raise UnsubscribedError(f"Not subscribed to topic {self.topic}")
         
-        return self._handle_request(f'{PUBLISHER_URL}/get_message', {'subscriber_id': self.subscriber_id})
+        params = {'subscriber_id': self.subscriber_id}
+        if self.wait_ms:
+            params['wait_ms'] = self.wait_ms
+        data = self._handle_request(f'{PUBLISHER_URL}/get_message', params, fetch=True)
+        # a single message comes back on its own, like the JSON response
+        if isinstance(data, list) and len(data) == 1:
+            data = data[0]
+        return data
     
-    def process_message(self, message_data: dict):
-        if message_data['_offset'] not in self.processed:
-            self.processed.add(message_data['_offset'])
-            label = 'Processed'
-        else:
-            label = 'Re-Processed'
+    def ack_fetch(self, ack_offsets: dict=None) -> list:
+        """
+        Ack ack_offsets, the last processed offset per partition (if given), and fetch the next
+        batch_size messages in one request
+        """
+        if not self.subscriber_id:
+            raise UnsubscribedError(f"Not subscribed to topic {self.topic}")
+        
+        params = {'subscriber_id': self.subscriber_id, 'num_messages': self.batch_size}
+        if ack_offsets:
+            params['partitions'] = list(ack_offsets)
+            params['offsets'] = list(ack_offsets.values())
+        if self.wait_ms:
+            params['wait_ms'] = self.wait_ms
+        return self._handle_request(f'{PUBLISHER_URL}/ack_fetch', params, 'post', fetch=True) or []
+    
+    def group_fetch(self, ack_offsets: list=None, num_messages: int=None, wait_ms: int=None) -> list:
+        """
+        Ack ack_offsets, a list of (partition, offset) pairs, and claim up to num_messages (default batch_size)
+        messages that no other member of the group holds
+        """
+        if not self.subscriber_id:
+            raise UnsubscribedError(f"Not subscribed to topic {self.topic}")
+        
+        ack_offsets = ack_offsets or []
+        params = {'subscriber_id': self.subscriber_id, 'num_messages': num_messages or self.batch_size,
+                  'partitions': [p for p, _ in ack_offsets], 'offsets': [o for _, o in ack_offsets]}
+        if self.lease_ms:
+            params['lease_ms'] = self.lease_ms
+        wait_ms = self.wait_ms if wait_ms is None else wait_ms
+        if wait_ms:
+            params['wait_ms'] = wait_ms
+        return self._handle_request(f'{PUBLISHER_URL}/group_fetch', params, 'post', fetch=True) or []
+    
+    def group_ack(self, offsets: list):
+        """
+        Ack offsets, a list of (partition, offset) pairs
+        """
+        params = {'subscriber_id': self.subscriber_id, 'partitions': [p for p, _ in offsets], 'offsets': [o for _, o in offsets]}
+        data = self._handle_request(f'{PUBLISHER_URL}/group_ack', params, 'post')
+    
+    def _watermark(self, partition: int) -> QOffsetWatermark:
+        # called with self._watermarks_lock held
+        watermark = self._watermarks.get(partition)
+        if watermark is None:
+            watermark = self._watermarks[partition] = QOffsetWatermark()
+        return watermark
+    
+    def _delivered(self, partition: int, offset: int):
+        with self._watermarks_lock:
+            self._watermark(partition).deliver(offset)
+    
+    def _completed(self, partition: int, offset: int) -> bool:
+        """
+        Mark a message handled. Returns True when the partition's low watermark moved.
+        """
+        with self._watermarks_lock:
+            return self._watermark(partition).complete(offset)
+    
+    def process_message(self, message_data: dict, ack: bool=True):
+        partition = message_data.get('_partition', 0)
+        with self._watermarks_lock:
+            label = 'Re-Processed' if self._watermark(partition).is_done(message_data['_offset']) else 'Processed'
+        self._completed(partition, message_data['_offset'])
         
-        self._log.info(f'{label} {message_data["_offset"]: 5d} : "{message_data["message"]}"{os.linesep}')
-        self.ack_message(message_data['_offset'])
+        self._log.info(f'{label} {partition: 3d}:{message_data["_offset"]: 5d} : "{message_data["message"]}"{os.linesep}')
+        if ack:
+            self.ack_message(message_data['_offset'], partition)
     
-    def consume(self):
+    def consume(self, handler=None):
         """
-        Loop to consume messages, sleep between calls by a specified amount and unsubscribe and exit after a certain number of detected empty responses
+        Loop to consume messages and unsubscribe and exit after a certain number of detected empty responses.
+        Empty responses are long-polled on the server for wait_ms, or followed by a sleep of sleep_time when wait_ms is 0.
+        Messages are fetched batch_size at a time and the processed offsets are acked with the next fetch
+        (only the last one of each partition, unless in a consumer group where every message is acked)
+        
+        With workers, handler(message) (process_message by default, which needs the thread executor) runs
+        in the pool, see _consume_pool().
         """
+        if self.workers:
+            return self._consume_pool(handler)
         tries = 0
+        processed = []
         try:
             while tries < self.exit_after:
-                data = self.get_message()
-                if data:
+                if self.group:
+                    batch = self.group_fetch(processed)
+                else:
+                    # messages of a partition arrive in offset order, so the last one wins
+                    batch = self.ack_fetch(dict(processed))
+                processed = []
+                if batch:
                     tries = 0
-                    # candidate for async
-                    self.process_message(data)
+                    for data in batch:
+                        # candidate for async
+                        if handler is not None:
+                            handler(data)
+                            self._completed(data.get('_partition', 0), data['_offset'])
+                        else:
+                            self.process_message(data, ack=False)
+                        processed.append((data.get('_partition', 0), data['_offset']))
                 else:
                     tries += 1
                 
                 # candidate for async
+                if not self.wait_ms:
+                    time.sleep(self.sleep_time)
+        finally:
+            try:
+                if processed and self.group:
+                    self.group_ack(processed)
+                elif processed:
+                    for partition, _offset in dict(processed).items():
+                        self.ack_message(_offset, partition)
+                self.unsubscribe()
+            finally:
+                self.close()
+    
+    def _consume_pool(self, handler=None):
+        """
+        consume() with a pool of workers. Batches are fetched while up to max_in_flight messages are
+        being handled, long-polling only when nothing is in flight. Plain subscribers read past the
+        offsets already fetched (/get_message with after_partitions/after_offsets) and ack the low
+        watermark of each partition, the highest offset below which every message is handled, as it
+        moves. Group members claim with /group_fetch and ack each handled message with the next one.
+        
+        Only partitions with messages fetched and not acked are read past the fetch cursor, the others
+        read past the committed offset. So a /topic_reset shows up as a message at or below the
+        partition's committed offset once its messages in flight are acked, and the partition starts
+        over from there.
+        
+        A handler that raises stops consuming: the messages in flight are finished and acked up to the
+        watermark, so the failed one is delivered again, and the error is raised.
+        """
+        if handler is None:
+            if self.executor == 'process':
+                raise ValueError('The process executor needs a handler function that can be pickled')
+            handler = lambda data: self.process_message(data, ack=False)
+        in_flight = {}      # future -> (partition, offset)
+        cursor = {}         # partition -> highest offset fetched
+        acked = {}          # partition -> offset committed
+        handled = []        # (partition, offset) handled since the last group fetch
+        errors = []
+        
+        def collect(done):
+            for future in done:
+                partition, _offset = in_flight.pop(future)
+                error = future.exception()
+                if error is not None:
+                    self._log.error(f'Handling {partition}:{_offset} failed: {error}')
+                    errors.append(error)
+                    continue
+                # process_message() marked it already, marking it again is a no-op
+                self._completed(partition, _offset)
+                handled.append((partition, _offset))
+        
+        def ack_watermarks():
+            with self._watermarks_lock:
+                lows = {p: self._watermarks[p].low for p in acked if self._watermarks[p].low > acked[p]}
+            for partition, _offset in lows.items():
+                self.ack_message(_offset, partition)
+                acked[partition] = _offset
+        
+        tries = 0
+        with EXECUTORS[self.executor](max_workers=self.workers) as pool:
+            try:
+                while tries < self.exit_after and not errors:
+                    batch = []
+                    room = self.max_in_flight - len(in_flight)
+                    if room > 0:
+                        # park on the server only when there is nothing else to wait for
+                        wait_ms = None if not in_flight else 0
+                        if self.group:
+                            batch = self.group_fetch(handled, num_messages=min(self.batch_size, room), wait_ms=wait_ms)
+                            handled = []
+                        else:
+                            after = {p: o for p, o in cursor.items() if o > acked[p]}
+                            batch = self.get_messages(after, min(self.batch_size, room), wait_ms)
+                        for data in batch:
+                            partition = data.get('_partition', 0)
+                            if not self.group and partition in acked and data['_offset'] <= acked[partition]:
+                                # the topic was reset, the partition starts over below what was acked
+                                self._log.info(f'Partition {partition} was reset to offset {data["_offset"] - 1}')
+                                del cursor[partition], acked[partition]
+                                with self._watermarks_lock:
+                                    self._watermarks.pop(partition, None)
+                            cursor[partition] = max(data['_offset'], cursor.get(partition, 0))
+                            # the offset before the first one fetched was committed already
+                            acked.setdefault(partition, data['_offset'] - 1)
+                            self._delivered(partition, data['_offset'])
+                            in_flight[pool.submit(handler, data)] = (partition, data['_offset'])
+                        if batch:
+                            tries = 0
+                        elif not in_flight:
+                            tries += 1
+                            if not self.wait_ms:
+                                time.sleep(self.sleep_time)
+                            continue
+                    # block for a completion when the window is full or the topic is drained
+                    done, _ = futures.wait(in_flight, timeout=0 if batch and room > len(batch) else None,
+                                           return_when=futures.FIRST_COMPLETED)
+                    collect(done)
+                    if not self.group:
+                        ack_watermarks()
+            finally:
+                try:
+                    collect(futures.wait(in_flight)[0])
+                    if self.group and handled:
+                        self.group_ack(handled)
+                    elif not self.group:
+                        ack_watermarks()
+                    self.unsubscribe()
+                finally:
+                    self.close()
+        if errors:
+            raise errors[0]
+    
+    def stream(self, handler=None, credits: int=None, heartbeat_ms: int=1000):
+        """
+        Consume from /stream, where the server pushes messages as they are published instead of being
+        polled, with at most credits (default max_in_flight) of them delivered and not acked.
+        handler(message) (process_message by default) runs for each message in order. The last handled
+        offset of each partition is acked with /ack_message, on another pooled connection, once half
+        the credits are used, when the stream goes idle (a heartbeat comes every heartbeat_ms) and
+        before reconnecting.
+        
+        A stream that breaks or is ended by the server is opened again after sleep_time seconds and
+        resumes after the committed offsets, so messages handled and not acked are delivered again.
+        Unsubscribes and returns after exit_after heartbeats or failed connections in a row without messages.
+        """
+        if self.group:
+            raise ValueError('Consumer group members claim messages with group_fetch, they cannot stream')
+        if not self.subscriber_id:
+            raise UnsubscribedError(f"Not subscribed to topic {self.topic}")
+        credits = credits or self.max_in_flight
+        params = {'subscriber_id': self.subscriber_id, 'credits': credits, 'heartbeat_ms': heartbeat_ms}
+        handled = {}        # partition -> last offset handled and not acked
+        unacked = 0
+        tries = 0
+        
+        def ack_handled():
+            nonlocal unacked
+            for partition, _offset in list(handled.items()):
+                self.ack_message(_offset, partition)
+                del handled[partition]
+            unacked = 0
+        
+        try:
+            while tries < self.exit_after:
+                try:
+                    # the read timeout notices a server that went away when its heartbeats stop
+                    with self._session.get(f'{PUBLISHER_URL}/stream', params=params, stream=True,
+                                           headers={'Accept': 'application/x-ndjson'},
+                                           timeout=(None, 3 * heartbeat_ms / 1000.0)) as res:
+                        res.raise_for_status()
+                        for line in res.iter_lines(chunk_size=None):
+                            if not line:
+                                # a heartbeat, nothing was published since the last one
+                                if handled:
+                                    ack_handled()
+                                tries += 1
+                                if tries >= self.exit_after:
+                                    break
+                                continue
+                            tries = 0
+                            data = json.loads(line)
+                            partition = data.get('_partition', 0)
+                            self._delivered(partition, data['_offset'])
+                            if handler is not None:
+                                handler(data)
+                                self._completed(partition, data['_offset'])
+                            else:
+                                self.process_message(data, ack=False)
+                            handled[partition] = data['_offset']
+                            unacked += 1
+                            if unacked >= max(1, credits // 2):
+                                ack_handled()
+                    if tries >= self.exit_after:
+                        break
+                    self._log.info('Stream ended by the server, reconnecting')
+                except requests.HTTPError as e:
+                    # the request itself is wrong, e.g. an unknown subscriber
+                    if e.response is not None and e.response.status_code < HTTPStatus.INTERNAL_SERVER_ERROR:
+                        raise
+                    self._log.warning(f'Stream failed: {e}')
+                    tries += 1
+                except requests.RequestException as e:
+                    self._log.warning(f'Stream broke: {e}')
+                    tries += 1
+                try:
+                    ack_handled()
+                except requests.RequestException as e:
+                    self._log.warning(f'Acking before reconnecting failed, the messages will be delivered again: {e}')
                 time.sleep(self.sleep_time)
         finally:
-            self.unsubscribe()
+            try:
+                if handled:
+                    ack_handled()
+                self.unsubscribe()
+            finally:
+                self.close()
         
             
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         print(f"""
-Usage: {os.path.basename(sys.argv[0])} <topic-name> <sleep-time-in-seconds> <exit-after-tries>
+Usage: {os.path.basename(sys.argv[0])} <topic-name> <sleep-time-in-seconds> <exit-after-tries> [<wait-ms> [<batch-size> [<group> [<partition,...>]]]]
 """, file=sys.stderr)
         sys.exit(1)
     else:
         topic = sys.argv[1]
         sleep_time = int((sys.argv[2:3] or [1])[0])
         exit_after = int((sys.argv[3:4] or [10])[0])
-        QSubscriber(topic, sleep_time, exit_after).consume()
+        wait_ms = int((sys.argv[4:5] or [1000])[0])
+        batch_size = int((sys.argv[5:6] or [20])[0])
+        group = (sys.argv[6:7] or [None])[0] or None
+        partitions = [int(p) for p in (sys.argv[7:8] or [''])[0].split(',') if p]
+        QSubscriber(topic, sleep_time, exit_after, wait_ms, batch_size, group, partitions=partitions).consume()
         
     
     
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Completion tracking for the offsets of one topic partition, used by QSubscriber to ack in offset
+order while messages are handled out of order, and to tell redelivered messages apart.
+
+The low watermark is the highest offset such that it and every offset below it are done, which
+is what may be acked. Offsets done above it are bits of an integer used as a bitmap, so memory
+is one bit per offset between the watermark and the highest offset delivered, the in-flight
+window, however many messages were consumed before. Offsets skipped between two deliveries
+(claimed by other consumer group members, or dropped by retention) never need handling, so they
+count as done.
+"""
+
+
+class QOffsetWatermark:
+    def __init__(self):
+        self.low = None     # every offset up to this one is done, None before the first delivery
+        self.high = None    # highest offset delivered
+        self._done = 0      # bit i set: offset low + 1 + i is done
+
+    def deliver(self, offset: int):
+        """
+        Note that offset was handed out for handling.
+        """
+        if self.low is None:
+            # everything before the first delivery was acked before this consumer started
+            self.low = self.high = offset - 1
+        if offset > self.high + 1:
+            skipped = offset - 1 - self.high
+            self._done |= ((1 << skipped) - 1) << (self.high - self.low)
+        if offset > self.high:
+            self.high = offset
+        self._advance()
+
+    def complete(self, offset: int) -> bool:
+        """
+        Mark offset done. Returns True when that moved the low watermark.
+        """
+        self.deliver(offset)
+        if offset <= self.low:
+            return False
+        self._done |= 1 << (offset - self.low - 1)
+        return self._advance()
+
+    def is_done(self, offset: int) -> bool:
+        if self.low is None:
+            return False
+        if offset <= self.low:
+            return True
+        return offset <= self.high and bool(self._done >> (offset - self.low - 1) & 1)
+
+    @property
+    def pending(self) -> int:
+        """
+        Offsets delivered above the low watermark, done or not: the span the bitmap covers.
+        """
+        return self.high - self.low if self.low is not None else 0
+
+    def _advance(self) -> bool:
+        # length of the run of set bits at the bottom
+        run = (~self._done & (self._done + 1)).bit_length() - 1
+        if run:
+            self.low += run
+            self._done >>= run
+        return run > 0
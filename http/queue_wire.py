@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Compact binary framing for publishing and fetching messages, shared by the server engines and
+the clients. JSON stays the default; the framed format is used when a request is sent with
+Content-type application/x-queue-frames (publish) or a response is asked for with that type in
+the Accept header (get_message, ack_fetch, group_fetch).
+
+All integers are big endian.
+
+Request body, messages to publish:
+
+    count uint32, then per message: length uint32, UTF-8 bytes
+
+Response body, fetched messages:
+
+    count uint32, then per message: id int64, partition int32, offset int64,
+    publish_ts int64 (microseconds since the Unix epoch, UTC), length uint32, UTF-8 bytes
+
+Version 2 of the response (Content-type application/x-queue-frames;v=2, sent to clients that
+list it in Accept) adds an encoding uint8 before the length: 0 for UTF-8 bytes, 1 for gzip and
+2 for deflate compressed UTF-8 bytes. Messages stored compressed (see queue_compression.py) are
+sent as they are stored, without being decompressed by the server.
+
+The topic is not repeated per message, the subscriber knows which topic it reads.
+"""
+from datetime import datetime, timedelta, timezone
+import re
+import struct
+import zlib
+
+from queue_compression import row_message
+
+FRAMES_CONTENT_TYPE = 'application/x-queue-frames'
+# content types a POST body may have, announced to clients in the Accept-Post response header
+ACCEPT_POST = f'application/json, {FRAMES_CONTENT_TYPE}'
+ENCODED_FRAMES_CONTENT_TYPE = f'{FRAMES_CONTENT_TYPE};v=2'
+# what clients send to get framed fetch responses from servers that support them, JSON otherwise
+ACCEPT_FRAMES = f'{ENCODED_FRAMES_CONTENT_TYPE}, {FRAMES_CONTENT_TYPE};q=0.9, application/json;q=0.5'
+
+_COUNT = struct.Struct('>I')
+_LENGTH = struct.Struct('>I')
+_ROW = struct.Struct('>qiqqI')
+_ENCODED_ROW = struct.Struct('>qiqqBI')
+
+# encoding byte of a version 2 row
+_ENCODING_IDS = {None: 0, 'gzip': 1, 'deflate': 2}
+_WBITS_BY_ID = {1: 31, 2: 15}
+_ENCODED_FRAMES = re.compile(re.escape(FRAMES_CONTENT_TYPE) + r'\s*;\s*v=2')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def accepts_frames(accept: str) -> bool:
+    return bool(accept) and FRAMES_CONTENT_TYPE in accept
+
+
+def accepts_encoded_frames(accept: str) -> bool:
+    return bool(accept) and _ENCODED_FRAMES.search(accept) is not None
+
+
+def frames_version(content_type: str) -> int:
+    """
+    1 or 2 for a framed response's Content-type, 0 for anything else.
+    """
+    if not content_type or not content_type.startswith(FRAMES_CONTENT_TYPE):
+        return 0
+    return 2 if _ENCODED_FRAMES.match(content_type) else 1
+
+
+def encode_messages(messages: list) -> bytes:
+    parts = [_COUNT.pack(len(messages))]
+    for message in messages:
+        data = message.encode('utf-8')
+        parts.append(_LENGTH.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def decode_messages(body: bytes) -> list:
+    """
+    Raises ValueError for a malformed body.
+    """
+    try:
+        count, = _COUNT.unpack_from(body, 0)
+        pos = _COUNT.size
+        messages = []
+        for _ in range(count):
+            length, = _LENGTH.unpack_from(body, pos)
+            pos += _LENGTH.size
+            if pos + length > len(body):
+                raise ValueError('Message frame runs past the end of the body')
+            messages.append(body[pos:pos + length].decode('utf-8'))
+            pos += length
+    except struct.error as e:
+        raise ValueError(f'Truncated message frame: {e}')
+    if pos != len(body):
+        raise ValueError(f'{len(body) - pos} bytes after the last message frame')
+    return messages
+
+
+def _micros(ts) -> int:
+    if ts is None:
+        return 0
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return (ts - EPOCH) // MICROSECOND
+
+
+def encode_rows(rows: list, version: int=1) -> bytes:
+    """
+    Frame topic_message rows (mappings with the topic_message columns). Version 1 decompresses
+    the messages stored compressed, version 2 sends them as they are.
+    """
+    parts = [_COUNT.pack(len(rows))]
+    if version == 2:
+        pack = _ENCODED_ROW.pack
+        for row in rows:
+            encoding = row.get('encoding')
+            data = row['payload'] if encoding else row['message'].encode('utf-8')
+            parts.append(pack(row['id'], row['_partition'], row['_offset'], _micros(row['publish_ts']),
+                              _ENCODING_IDS[encoding], len(data)))
+            parts.append(data)
+        return b''.join(parts)
+    pack = _ROW.pack
+    for row in rows:
+        data = row_message(row).encode('utf-8')
+        parts.append(pack(row['id'], row['_partition'], row['_offset'], _micros(row['publish_ts']), len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def decode_rows(body: bytes, topic: str=None, version: int=1) -> list:
+    """
+    Messages of a framed response as dicts shaped like the JSON rows, except that publish_ts is
+    a timezone aware datetime. Raises ValueError for a malformed body.
+    """
+    encoded = version == 2
+    unpack = (_ENCODED_ROW if encoded else _ROW).unpack_from
+    row_size = (_ENCODED_ROW if encoded else _ROW).size
+    end = len(body)
+    view = memoryview(body)
+    encoding = 0
+    try:
+        count, = _COUNT.unpack_from(body, 0)
+        pos = _COUNT.size
+        rows = []
+        for _ in range(count):
+            if encoded:
+                message_id, partition, offset, micros, encoding, length = unpack(body, pos)
+            else:
+                message_id, partition, offset, micros, length = unpack(body, pos)
+            pos += row_size
+            if pos + length > end:
+                raise ValueError('Message frame runs past the end of the body')
+            if encoding:
+                message = zlib.decompress(view[pos:pos + length], _WBITS_BY_ID[encoding]).decode('utf-8')
+            else:
+                message = str(view[pos:pos + length], 'utf-8')
+            rows.append({'id': message_id, 'topic': topic, '_partition': partition, '_offset': offset,
+                         'message': message, 'publish_ts': EPOCH + timedelta(microseconds=micros)})
+            pos += length
+    except struct.error as e:
+        raise ValueError(f'Truncated message frame: {e}')
+    except (KeyError, zlib.error) as e:
+        raise ValueError(f'Undecodable message frame: {e}')
+    return rows
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Compare the JSON and the binary framed wire formats (queue_wire.py).
+
+Without --url only the codecs are measured: encoding topic_message rows the way the server
+does and decoding them the way the clients do, per message and in bytes on the wire. With
+--url the same number of messages is also published with /publish_batch and read back with
+/ack_fetch against a running server, once per format, so the cost of both ends is included.
+
+Usage::
+    ./queue_wire_bench.py [--messages 100000] [--message-size 100] [--url http://localhost:8888]
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+import time
+
+from queue_session import make_session
+from queue_wire import ACCEPT_FRAMES, FRAMES_CONTENT_TYPE, decode_rows, encode_messages, encode_rows, frames_version
+
+FORMATS = ('json', 'frames')
+
+
+def bench_codec(fmt: str, rows: list, batch_size: int) -> dict:
+    batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+    size = 0
+    start = time.perf_counter()
+    encoded = []
+    for batch in batches:
+        body = json.dumps(batch, default=str).encode('utf-8') if fmt == 'json' else encode_rows(batch)
+        size += len(body)
+        encoded.append(body)
+    encode_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for body in encoded:
+        if fmt == 'json':
+            json.loads(body.decode('utf-8'))
+        else:
+            decode_rows(body, 'bench')
+    decode_seconds = time.perf_counter() - start
+    return {'format': fmt, 'messages': len(rows),
+            'encode_us_per_message': encode_seconds * 1e6 / len(rows),
+            'decode_us_per_message': decode_seconds * 1e6 / len(rows),
+            'bytes_per_message': size / len(rows)}
+
+
+def bench_server(fmt: str, url: str, topic: str, messages: list, batch_size: int) -> dict:
+    session = make_session()
+    try:
+        res = session.get(f'{url}/subscribe', params={'topic': topic})
+        res.raise_for_status()
+        subscriber_id = res.json()['subscriber_id']
+
+        start = time.perf_counter()
+        for i in range(0, len(messages), batch_size):
+            batch = messages[i:i + batch_size]
+            if fmt == 'json':
+                res = session.post(f'{url}/publish_batch', json={'topic': topic, 'messages': batch})
+            else:
+                res = session.post(f'{url}/publish_batch', params={'topic': topic}, data=encode_messages(batch),
+                                   headers={'Content-type': FRAMES_CONTENT_TYPE})
+            res.raise_for_status()
+        publish_seconds = time.perf_counter() - start
+
+        received = 0
+        acks = {}
+        headers = {'Accept': ACCEPT_FRAMES} if fmt == 'frames' else {}
+        start = time.perf_counter()
+        while received < len(messages):
+            params = {'subscriber_id': subscriber_id, 'num_messages': batch_size,
+                      'partitions': list(acks), 'offsets': list(acks.values())}
+            res = session.post(f'{url}/ack_fetch', json=params, headers=headers)
+            res.raise_for_status()
+            version = frames_version(res.headers.get('Content-type'))
+            if version:
+                rows = decode_rows(res.content, topic, version)
+            else:
+                rows = res.json()
+            if not rows:
+                break
+            received += len(rows)
+            for row in rows:
+                acks[row['_partition']] = row['_offset']
+        fetch_seconds = time.perf_counter() - start
+        session.post(f'{url}/unsubscribe', json={'subscriber_id': subscriber_id})
+    finally:
+        session.close()
+    return {'format': fmt, 'messages': len(messages), 'received': received,
+            'publish_per_second': len(messages) / publish_seconds if publish_seconds else 0.0,
+            'fetch_per_second': received / fetch_seconds if fetch_seconds else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the JSON and binary framed wire formats')
+    parser.add_argument('--messages', type=int, default=100000, help='Messages per format')
+    parser.add_argument('--message-size', type=int, default=100, help='Bytes per message')
+    parser.add_argument('--batch-size', type=int, default=500, help='Messages per request (capped by the server at 1000)')
+    parser.add_argument('--url', help='Also publish and fetch through the server at this URL')
+    parser.add_argument('--topic', default=f'wire-bench-{int(time.time())}', help='Topic to use with --url (created and deleted)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    payload = 'x' * args.message_size
+    now = datetime.now(timezone.utc)
+    rows = [{'id': i, 'topic': args.topic, '_partition': 0, '_offset': i, 'message': payload, 'publish_ts': now}
+            for i in range(1, args.messages + 1)]
+    results = {'codec': [bench_codec(fmt, rows, args.batch_size) for fmt in FORMATS]}
+    if not args.json:
+        for r in results['codec']:
+            print(f"codec  {r['format']:>6}  encode={r['encode_us_per_message']:7.2f}us/msg  "
+                  f"decode={r['decode_us_per_message']:7.2f}us/msg  size={r['bytes_per_message']:7.1f}B/msg")
+
+    if args.url:
+        session = make_session()
+        try:
+            session.post(f'{args.url}/topic', json={'topic': args.topic, 'description': 'wire format benchmark'}).raise_for_status()
+            messages = [payload] * args.messages
+            results['server'] = [bench_server(fmt, args.url, args.topic, messages, args.batch_size) for fmt in FORMATS]
+        finally:
+            session.delete(f'{args.url}/topic_delete', params={'topic': args.topic})
+            session.close()
+        if not args.json:
+            for r in results['server']:
+                print(f"server {r['format']:>6}  publish={r['publish_per_second']:10.1f} msgs/s  "
+                      f"fetch={r['fetch_per_second']:10.1f} msgs/s  received={r['received']}")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,30 +3,107 @@ create table topic
 (
     topic       text primary key check (topic <> ''),
     description text not null check ( description <> '' ),
+    partitions  int not null default 1 check (partitions between 1 and 1024),
+    storage_id  serial not null unique,
+    segment_size bigint not null default 100000 check (segment_size > 0),
+    retention_ms bigint check (retention_ms > 0),
+    retention_messages bigint check (retention_messages > 0),
+    retention_acked boolean not null default false,
+    compression text check (compression in ('gzip', 'deflate')),
     create_ts   timestamptz not null default current_timestamp
 );
 
 comment on table topic is 'Define a topic';
 comment on column topic.topic is 'Name of the topic';
 comment on column topic.description is 'Description of the topic';
+comment on column topic.partitions is 'Number of partitions of the topic. Each partition has its own offset sequence';
+comment on column topic.storage_id is 'Names the topic_message partition of the topic, topic_message_<storage_id>';
+comment on column topic.segment_size is 'Number of offsets stored per segment (sub-partition) of each topic partition';
+comment on column topic.retention_ms is 'Segments whose newest message is older than this are dropped. Null keeps messages regardless of age';
+comment on column topic.retention_messages is 'Segments entirely older than the newest retention_messages messages of their partition are dropped. Null keeps any number';
+comment on column topic.retention_acked is 'Drop segments once every subscriber and consumer group has acked them';
+comment on column topic.compression is 'Codec the server compresses large messages of the topic with before storing them. Null stores every message as text';
+
+
+\echo Creating table "topic_partition"...
+create table topic_partition
+(
+    topic        text not null references topic (topic) on delete cascade,
+    _partition   int not null check (_partition >= 0),
+    head_offset  bigint not null default 0 check (head_offset >= 0),
+    segment_head bigint not null default 0 check (segment_head >= 0),
+    primary key (topic, _partition)
+);
+
+comment on table topic_partition is 'Partitions of a topic. Publishes to different partitions never wait on each other';
+comment on column topic_partition.head_offset is 'Offset of the newest message published to the partition. Advanced atomically on every publish';
+comment on column topic_partition.segment_head is 'Last offset covered by the existing segments of the partition';
+
+-- spreads publishes without a key over the partitions of a topic
+create sequence publish_round_robin;
 
 
 \echo Creating table "topic_message"...
+-- partitioned per topic (created by topic_create()), and each topic partition by ranges of
+-- segment_size offsets per topic partition (created by topic_add_segments()), so expired messages
+-- are removed by dropping whole segments and every topic gets its own small heaps and indexes
 create table topic_message
 (
-    id          bigserial primary key,
-    topic       text not null check (topic <> '') references topic (topic) on delete cascade on update cascade deferrable initially deferred,
+    id          bigserial,
+    topic       text not null check (topic <> '') references topic (topic) on delete cascade deferrable initially deferred,
+    _partition  int not null default 0,
     _offset     bigint not null check (_offset > 0),
-    message     text not null,
-    publish_ts  timestamptz not null default current_timestamp
-);
-
-create unique index topic_message_topic_offset_desc on topic_message (topic, _offset desc);
+    message     text,
+    publish_ts  timestamptz not null default current_timestamp,
+    payload     bytea,
+    encoding    text check (encoding in ('gzip', 'deflate')),
+    -- a message is stored either as text or compressed
+    check ((encoding is null and message is not null and payload is null) or
+           (encoding is not null and message is null and payload is not null)),
+    -- ascending so keyset pagination on (topic, _partition, _offset) is a forward index range scan
+    primary key (topic, _partition, _offset)
+) partition by list (topic);
 
 comment on table topic_message is 'Messages posted to a topic';
 comment on column topic_message.topic is 'Reference to the topic to which this message applies. Part 1 of the primary key';
-comment on column topic_message._offset is 'Offset identifier for the topic message. Part 2 of the primary key';
-comment on column topic_message.message is 'Payload of the message';
+comment on column topic_message._partition is 'Partition of the topic the message was published to. Part 2 of the primary key';
+comment on column topic_message._offset is 'Offset identifier for the message within its partition. Part 3 of the primary key';
+comment on column topic_message.message is 'Payload of the message, null when it is stored compressed';
+comment on column topic_message.payload is 'UTF-8 payload of the message compressed with encoding, null when it is stored as text';
+comment on column topic_message.encoding is 'Codec of payload (gzip or deflate), null for a message stored as text';
+
+
+\echo Creating table "topic_segment"...
+create table topic_segment
+(
+    topic        text not null references topic (topic) on delete cascade,
+    _partition   int not null,
+    first_offset bigint not null,
+    last_offset  bigint not null,
+    table_name   text not null,
+    create_ts    timestamptz not null default current_timestamp,
+    primary key (topic, _partition, first_offset)
+);
+
+comment on table topic_segment is 'Segments (offset range sub-partitions of topic_message) of a topic partition. The oldest one starts right after the last dropped offset';
+
+
+\echo Creating table "consumer_group"...
+create table consumer_group
+(
+    id          serial primary key,
+    topic       text not null check (topic <> '') references topic (topic) on delete cascade deferrable initially deferred,
+    group_name  text not null check (group_name <> ''),
+    _offsets    bigint[] not null,
+    lease_ms    int not null default 30000 check (lease_ms > 0),
+    action_ts   timestamptz not null default current_timestamp,
+    unique (topic, group_name)
+);
+
+comment on table consumer_group is 'Subscribers sharing one committed offset per partition of a topic and receiving disjoint messages';
+comment on column consumer_group.group_name is 'Name of the group, unique per topic';
+comment on column consumer_group._offsets is 'Committed offset of the group per partition (partition p at index p + 1). Every message up to it has been acked';
+comment on column consumer_group.lease_ms is 'Default time a claimed message stays invisible to the other group members before it is redelivered';
 
 
 \echo Creating table "topic_subscriber"...
@@ -34,23 +111,70 @@ create table topic_subscriber
 (
     id          serial primary key,
     topic       text not null check (topic <> '') references topic (topic) on delete cascade deferrable initially deferred,
-    _offset     bigint not null default 0,
+    _offsets    bigint[] not null,
+    partitions  int[] not null,
+    group_id    int references consumer_group (id) on delete cascade,
+    ack_mode    text not null default 'durable' check (ack_mode in ('durable', 'coalesced')),
     action_ts   timestamptz not null default current_timestamp
 );
 
 comment on table topic_subscriber is 'Define a topic subscriber';
 comment on column topic_subscriber.id is 'Primary key for a topic subscriber';
 comment on column topic_subscriber.topic is 'Foreign key eference to the subscribed topic.';
-comment on column topic_subscriber._offset is 'Last processed offset of subscribed topic.';
+comment on column topic_subscriber._offsets is 'Last processed offset of each partition of the subscribed topic (partition p at index p + 1).';
+comment on column topic_subscriber.partitions is 'Partitions of the topic the subscriber consumes.';
+comment on column topic_subscriber.group_id is 'Consumer group of the subscriber. Group members read from the group offsets instead of _offsets';
+comment on column topic_subscriber.ack_mode is 'Default for the acks of the subscriber: durable acks are committed before they are answered, coalesced acks are batched by the server';
+
+
+\echo Creating table "consumer_group_lease"...
+create table consumer_group_lease
+(
+    group_id      int not null references consumer_group (id) on delete cascade,
+    _partition    int not null,
+    _offset       bigint not null,
+    subscriber_id int references topic_subscriber (id) on delete set null,
+    lease_until   timestamptz not null,
+    acked         boolean not null default false,
+    deliveries    int not null default 1,
+    primary key (group_id, _partition, _offset)
+);
+
+create index consumer_group_lease_expiry on consumer_group_lease (group_id, lease_until) where not acked;
+
+comment on table consumer_group_lease is 'Messages above the group offset of their partition that have been claimed by a group member';
+comment on column consumer_group_lease.subscriber_id is 'Group member currently holding the lease';
+comment on column consumer_group_lease.lease_until is 'The message is redelivered to another member when it is not acked by this time';
+comment on column consumer_group_lease.acked is 'Acked leases are kept until the group offset moves past them';
+comment on column consumer_group_lease.deliveries is 'Number of times the message has been handed out';
 
 
 \echo Creating function create topic...
-create or replace function topic_create( p_topic text, p_description text ) returns text as 
+create or replace function topic_create( p_topic text, p_description text, p_segment_size bigint = null,
+                                         p_retention_ms bigint = null, p_retention_messages bigint = null,
+                                         p_retention_acked boolean = false, p_partitions int = 1,
+                                         p_compression text = null ) returns text as 
 $BODY$
 declare
     v_topic text := null::text;
+    v_storage_id int := null::int;
+    v_partitions int := null::int;
 begin
-    insert into topic (topic, description) values (p_topic, p_description) returning topic into v_topic;
+    insert into topic (topic, description, partitions, segment_size, retention_ms, retention_messages, retention_acked,
+                       compression)
+    values (p_topic, p_description, coalesce(p_partitions, 1), coalesce(p_segment_size, 100000), p_retention_ms,
+            p_retention_messages, coalesce(p_retention_acked, false), p_compression)
+    returning topic, storage_id, partitions into v_topic, v_storage_id, v_partitions;
+    
+    insert into "topic_partition" (topic, _partition)
+    select p_topic, p
+      from generate_series(0, v_partitions - 1) as p;
+    
+    execute format('create table %I partition of "topic_message" for values in (%L) partition by range (_partition, _offset)',
+                   format('topic_message_%s', v_storage_id), p_topic);
+    for p in 0 .. v_partitions - 1 loop
+        perform topic_add_segments(p_topic, p, 1);
+    end loop;
     
     return v_topic;
 end;
@@ -58,17 +182,212 @@ $BODY$
 language plpgsql;
 
 
+\echo Creating function set topic retention...
+create or replace function topic_set_retention( p_topic text, p_retention_ms bigint, p_retention_messages bigint,
+                                                p_retention_acked boolean ) returns setof topic as 
+$BODY$
+begin
+    return query update "topic" t
+                    set retention_ms = p_retention_ms,
+                        retention_messages = p_retention_messages,
+                        retention_acked = coalesce(p_retention_acked, false)
+                  where t.topic = p_topic
+                 returning t.*;
+end;
+$BODY$
+language plpgsql;
+
+
+\echo Creating function add topic segments...
+create or replace function topic_add_segments( p_topic text, p_partition int, p_upto_offset bigint ) returns int as 
+$BODY$
+declare
+    v_topic "topic"%rowtype;
+    v_first bigint;
+    v_table text;
+    v_count int := 0;
+begin
+    select t.*
+      into v_topic
+      from "topic" t
+     where t.topic = p_topic;
+    
+    -- publishers needing the new segment wait on the partition row instead of racing to create it
+    select tp.segment_head + 1
+      into v_first
+      from "topic_partition" tp
+     where tp.topic = p_topic
+       and tp._partition = p_partition
+       for update;
+    
+    if ( v_topic.topic is null or v_first is null ) then
+        return 0;
+    end if;
+    
+    while ( v_first <= p_upto_offset ) loop
+        v_table := format('topic_message_%s_p%s_%s', v_topic.storage_id, p_partition, v_first);
+        execute format('create table %I partition of %I for values from (%s, %s) to (%s, %s)',
+                       v_table, format('topic_message_%s', v_topic.storage_id),
+                       p_partition, v_first, p_partition, v_first + v_topic.segment_size);
+        insert into "topic_segment" (topic, _partition, first_offset, last_offset, table_name)
+        values (p_topic, p_partition, v_first, v_first + v_topic.segment_size - 1, v_table);
+        v_first := v_first + v_topic.segment_size;
+        v_count := v_count + 1;
+    end loop;
+    
+    if ( v_count > 0 ) then
+        update "topic_partition" tp
+           set segment_head = v_first - 1
+         where tp.topic = p_topic
+           and tp._partition = p_partition;
+    end if;
+    
+    return v_count;
+end;
+$BODY$
+language plpgsql;
+
+
+\echo Creating retention function...
+create or replace function topic_retention( p_topic text, p_max_segments int = 10 )
+  returns table (segments_dropped int, rows_reclaimed bigint, bytes_reclaimed bigint) as 
+$BODY$
+declare
+    v_topic "topic"%rowtype;
+    v_partition "topic_partition"%rowtype;
+    v_cutoff bigint;
+    v_acked bigint := null::bigint;
+    v_segment "topic_segment"%rowtype;
+    v_last_ts timestamptz;
+begin
+    segments_dropped := 0;
+    rows_reclaimed := 0;
+    bytes_reclaimed := 0;
+    
+    -- skip work that would have to wait on publishers or readers, the next run retries it
+    perform set_config('lock_timeout', '100ms', true);
+    
+    select t.*
+      into v_topic
+      from "topic" t
+     where t.topic = p_topic;
+    
+    if ( v_topic.topic is null ) then
+        return;
+    end if;
+    
+    for v_partition in select tp.*
+                         from "topic_partition" tp
+                        where tp.topic = p_topic
+                        order 
+                           by tp._partition
+    loop
+        -- keep a spare segment ahead of the head so publishes rarely have to create one
+        begin
+            perform topic_add_segments(p_topic, v_partition._partition, v_partition.head_offset + v_topic.segment_size);
+        exception when lock_not_available then
+            null;
+        end;
+        
+        exit when segments_dropped >= p_max_segments;
+        
+        v_cutoff := 0;
+        if ( v_topic.retention_messages is not null ) then
+            v_cutoff := greatest(v_cutoff, v_partition.head_offset - v_topic.retention_messages);
+        end if;
+        
+        if ( v_topic.retention_acked ) then
+            select min(acked._offset)
+              into v_acked
+              from (
+                     select ts._offsets[v_partition._partition + 1] as _offset
+                       from "topic_subscriber" ts
+                      where ts.topic = p_topic
+                        and ts.group_id is null
+                        and v_partition._partition = any(ts.partitions)
+                      union all
+                     select cg._offsets[v_partition._partition + 1]
+                       from "consumer_group" cg
+                      where cg.topic = p_topic
+                   ) as acked;
+            -- without any subscribers nothing counts as acked
+            v_cutoff := greatest(v_cutoff, coalesce(v_acked, 0));
+        end if;
+        
+        -- oldest first, and never the segment still being written
+        for v_segment in select s.*
+                           from "topic_segment" s
+                          where s.topic = p_topic
+                            and s._partition = v_partition._partition
+                            and s.last_offset <= v_partition.head_offset
+                          order 
+                             by s.first_offset
+                          limit p_max_segments - segments_dropped
+        loop
+            if ( v_segment.last_offset > v_cutoff ) then
+                if ( v_topic.retention_ms is null ) then
+                    exit;
+                end if;
+                execute format('select publish_ts from %I order by topic desc, _partition desc, _offset desc limit 1',
+                               v_segment.table_name)
+                   into v_last_ts;
+                if ( v_last_ts >= current_timestamp - make_interval(secs => v_topic.retention_ms / 1000.0) ) then
+                    exit;
+                end if;
+            end if;
+            
+            begin
+                bytes_reclaimed := bytes_reclaimed + pg_total_relation_size(format('%I', v_segment.table_name)::regclass);
+                execute format('drop table %I', v_segment.table_name);
+                delete
+                  from "topic_segment" s
+                 where s.topic = p_topic
+                   and s._partition = v_segment._partition
+                   and s.first_offset = v_segment.first_offset;
+            exception when lock_not_available then
+                exit;
+            end;
+            segments_dropped := segments_dropped + 1;
+            rows_reclaimed := rows_reclaimed + v_segment.last_offset - v_segment.first_offset + 1;
+        end loop;
+    end loop;
+    
+    if ( segments_dropped > 0 ) then
+        -- cached copies of the dropped messages must not outlive them
+        perform pg_notify('topic_change', json_build_object('topic', p_topic, 'event', 'retention')::text);
+    end if;
+    
+    return next;
+end;
+$BODY$
+language plpgsql;
+
+
 \echo Creating function delete topic...
 create or replace function topic_delete( topic text ) returns text as 
 $BODY$
 declare
     v_topic text := null::text;
+    v_storage_id int := null::int;
 begin
-    execute $$delete
-                from topic
-               where topic.topic = $$ || quote_literal(topic) || $$
-              returning topic.topic$$
-       into v_topic;
+    -- dropping the topic partition (and its segments) is cheaper than cascading the delete row by row
+    select t.storage_id
+      into v_storage_id
+      from "topic" t
+     where t.topic = topic_delete.topic;
+    
+    if ( v_storage_id is not null ) then
+        execute format('drop table if exists %I', format('topic_message_%s', v_storage_id));
+    end if;
+    
+    delete
+      from "topic" t
+     where t.topic = topic_delete.topic
+    returning t.topic
+      into v_topic;
+    
+    -- the server tail caches drop what they hold of the topic
+    perform pg_notify('topic_change', json_build_object('topic', topic_delete.topic, 'event', 'delete')::text);
     
     return v_topic;
 end;
@@ -76,55 +395,177 @@ $BODY$
 language plpgsql;
 
 
+\echo Creating publish partition function...
+create or replace function topic_pick_partition(p_topic text, p_key text = null) returns int as $BODY$
+declare
+    v_partitions int := null::int;
+begin
+    select t.partitions
+      into v_partitions
+      from "topic" t
+     where t.topic = p_topic;
+
+    if ( v_partitions is null ) then
+        raise exception using errcode = 'foreign_key_violation', message = format('Topic "%s" does not exist', p_topic);
+    end if;
+
+    -- messages with the same key always land in the same partition and stay in order, the rest are spread evenly
+    if ( v_partitions = 1 ) then
+        return 0;
+    elsif ( p_key is not null ) then
+        return (hashtextextended(p_key, 0) & 9223372036854775807) % v_partitions;
+    end if;
+    return nextval('publish_round_robin') % v_partitions;
+end;
+$BODY$
+language plpgsql;
+
+
 \echo Creating save_message function...
-create or replace function save_message(p_topic text, p_message text) returns int as $BODY$
+-- a message compressed by the server (see topic.compression) is passed as p_payload with its p_encoding and a null p_message
+create or replace function save_message(p_topic text, p_message text, p_key text = null, p_payload bytea = null,
+                                        p_encoding text = null) returns setof topic_message as $BODY$
 declare
-    v_offset int := null::int;
+    v_partition int := topic_pick_partition(p_topic, p_key);
+    v_offset bigint := null::bigint;
+    v_segment_head bigint := null::bigint;
+    v_message "topic_message"%rowtype;
 begin
-    execute $$select _offset 
-                from "topic_message" tm
-               where tm.topic = $$ || quote_literal(p_topic) || $$
-                 and tm._offset = (select coalesce(max(tm1._offset), 0)
-                                     from "topic_message" tm1
-                                    where tm1.topic = $$ || quote_literal(p_topic) || $$)
-                 for update;$$
-       into v_offset;
+    update "topic_partition" tp
+       set head_offset = tp.head_offset + 1
+     where tp.topic = p_topic
+       and tp._partition = v_partition
+    returning tp.head_offset, tp.segment_head into v_offset, v_segment_head;
 
-    insert into "topic_message" (topic, _offset, message)
-    values (p_topic, coalesce(v_offset, 0) + 1, p_message)
-    returning _offset into v_offset;
+    -- the retention worker normally creates segments ahead of time
+    if ( v_offset > v_segment_head ) then
+        perform topic_add_segments(p_topic, v_partition, v_offset);
+    end if;
+
+    insert into "topic_message" (topic, _partition, _offset, message, payload, encoding)
+    values (p_topic, v_partition, v_offset, p_message, p_payload, p_encoding)
+    returning * into v_message;
+    
+    -- delivered on commit to the server notification dispatchers to wake long-polling subscribers
+    -- and to move the heads of their tail caches
+    perform pg_notify('topic_publish',
+                      json_build_object('topic', p_topic, 'partition', v_partition, 'offset', v_offset)::text);
     
-    return v_offset;
+    -- the whole row, so the server can cache it for subscribers reading the tail of the topic
+    return next v_message;
+end;
+$BODY$
+language plpgsql;
+
+
+\echo Creating save_messages function...
+-- p_payloads and p_encodings are parallel to p_messages, a compressed message is null in p_messages
+create or replace function save_messages(p_topic text, p_messages text[], p_key text = null, p_payloads bytea[] = null,
+                                         p_encodings text[] = null)
+  returns table (_partition int, first_offset bigint, last_offset bigint) as $BODY$
+declare
+    v_partition int := null::int;
+    v_offset bigint := null::bigint;
+    v_segment_head bigint := null::bigint;
+    v_count int := coalesce(array_length(p_messages, 1), 0);
+begin
+    if ( v_count = 0 ) then
+        return;
+    end if;
+
+    -- the whole batch goes to one partition so it keeps its order
+    v_partition := topic_pick_partition(p_topic, p_key);
+
+    update "topic_partition" tp
+       set head_offset = tp.head_offset + v_count
+     where tp.topic = p_topic
+       and tp._partition = v_partition
+    returning tp.head_offset - v_count, tp.segment_head into v_offset, v_segment_head;
+
+    if ( v_offset + v_count > v_segment_head ) then
+        perform topic_add_segments(p_topic, v_partition, v_offset + v_count);
+    end if;
+
+    -- unnest() pads the shorter (or null) arrays with nulls
+    insert into "topic_message" (topic, _partition, _offset, message, payload, encoding)
+    select p_topic, v_partition, v_offset + m.ord, m.message, m.payload, m.encoding
+      from unnest(p_messages, p_payloads, p_encodings) with ordinality as m(message, payload, encoding, ord);
+
+    _partition := v_partition;
+    first_offset := v_offset + 1;
+    last_offset := v_offset + v_count;
+    perform pg_notify('topic_publish',
+                      json_build_object('topic', p_topic, 'partition', v_partition, 'offset', last_offset)::text);
+    return next;
 end;
 $BODY$
 language plpgsql;
 
 
 \echo Creating subscribe function...
-create or replace function topic_subscribe(p_topic text) returns int as 
+create or replace function topic_subscribe(p_topic text, p_group text = null, p_partitions int[] = null,
+                                           p_ack_mode text = 'durable') returns int as 
 $BODY$
 declare
     v_subscriber_id int := null::int;
-    v_offset int := null::int;
+    v_partitions int := null::int;
+    v_offsets bigint[] := null::bigint[];
+    v_group_id int := null::int;
 begin
-    execute $$select coalesce(max(tm._offset), 0)
-                from "topic_message" tm
-               where tm.topic = $$ || quote_literal(p_topic) || $$;$$
-       into v_offset;
+    select t.partitions
+      into v_partitions
+      from "topic" t
+     where t.topic = p_topic;
+    
+    if ( v_partitions is null )
+    then
+        raise exception using errcode = 'foreign_key_violation', message = format('Topic "%s" does not exist', p_topic);
+    end if;
     
-    insert into "topic_subscriber" (topic, _offset)
-    values (p_topic, v_offset)
+    -- a subscriber consumes every partition unless it asks for a subset
+    if ( coalesce(array_length(p_partitions, 1), 0) = 0 )
+    then
+        select array_agg(p order by p) into p_partitions from generate_series(0, v_partitions - 1) as p;
+    elsif ( exists (select 1 from unnest(p_partitions) as p where p is null or p < 0 or p >= v_partitions) )
+    then
+        raise exception using errcode = 'invalid_parameter_value',
+                              message = format('Topic "%s" has partitions 0 to %s', p_topic, v_partitions - 1);
+    else
+        select array_agg(distinct p order by p) into p_partitions from unnest(p_partitions) as p;
+    end if;
+    
+    select array_agg(tp.head_offset order by tp._partition)
+      into v_offsets
+      from "topic_partition" tp
+     where tp.topic = p_topic;
+    
+    if ( p_group is not null )
+    then
+        -- a new group starts at the head of the topic like a new subscriber, later members join its offsets
+        insert into "consumer_group" (topic, group_name, _offsets)
+        values (p_topic, p_group, v_offsets)
+        on conflict (topic, group_name) do nothing;
+        
+        select cg.id
+          into v_group_id
+          from "consumer_group" cg
+         where cg.topic = p_topic
+           and cg.group_name = p_group;
+    end if;
+    
+    insert into "topic_subscriber" (topic, _offsets, partitions, group_id, ack_mode)
+    values (p_topic, v_offsets, p_partitions, v_group_id, coalesce(p_ack_mode, 'durable'))
     returning id into v_subscriber_id;
     
     if ( v_subscriber_id is null )
     then
-        raise exception 'Could not create a subscriber for topic %', topic;
+        raise exception 'Could not create a subscriber for topic %', p_topic;
     end if;
     
     return v_subscriber_id;
 end;
 $BODY$
-language plpgsql returns null on null input;
+language plpgsql;
 
 
 \echo Creating unsubscribe procedure...
@@ -133,11 +574,17 @@ $BODY$
 declare 
     v_subscriber_id int := null::int;
 begin
-    execute $$delete 
-                from "topic_subscriber"
-               where id = $$ || quote_literal(subscriber_id) || $$
-              returning id;$$
-       into v_subscriber_id;
+    -- hand the messages claimed by a leaving group member to the rest of the group right away
+    update "consumer_group_lease" l
+       set lease_until = clock_timestamp()
+     where l.subscriber_id = unsubscribe.subscriber_id
+       and not l.acked;
+    
+    delete
+      from "topic_subscriber" ts
+     where ts.id = unsubscribe.subscriber_id
+    returning ts.id
+      into v_subscriber_id;
     
     return v_subscriber_id;
 end;
@@ -145,8 +592,277 @@ $BODY$
 language plpgsql;
 
 
+\echo Creating partition offsets function...
+create or replace function partition_offsets_set(p_current bigint[], p_partitions int[], p_offsets bigint[]) returns bigint[] as 
+$BODY$
+    -- p_current with the offset of partition p_partitions[i] replaced by p_offsets[i]
+    select array_agg(coalesce((select max(a._offset)
+                                 from unnest(p_partitions, p_offsets) as a(_partition, _offset)
+                                where a._partition + 1 = cur.idx), cur._offset)
+                     order by cur.idx)
+      from unnest(p_current) with ordinality as cur(_offset, idx);
+$BODY$
+language sql immutable;
+
+
+\echo Creating subscriber fetch function...
+create or replace function subscriber_fetch(p_subscriber_id int, p_num_messages int, p_partitions int[] = '{}',
+                                            p_offsets bigint[] = '{}') returns setof topic_message as 
+$BODY$
+begin
+    -- the next messages of every partition of the subscriber, merged on offset. Each partition
+    -- contributes a gapless run above its own offset so acking its last message is always safe.
+    -- p_partitions and p_offsets are acks the server holds but has not flushed yet
+    return query select m.*
+                   from "topic_subscriber" ts
+                  cross 
+                   join lateral unnest(ts.partitions) as p(_partition)
+                  cross 
+                   join lateral (
+                          select max(a._offset) as _offset
+                            from unnest(p_partitions, p_offsets) as a(_partition, _offset)
+                           where a._partition = p._partition
+                        ) as pending
+                  cross 
+                   join lateral (
+                          select tm.*
+                            from "topic_message" tm
+                           where tm.topic = ts.topic
+                             and tm._partition = p._partition
+                             and tm._offset > greatest(ts._offsets[p._partition + 1], pending._offset)
+                           order 
+                              by tm._offset
+                           limit p_num_messages
+                        ) as m
+                  where ts.id = p_subscriber_id
+                  order 
+                     by m._offset, m._partition
+                  limit p_num_messages;
+end;
+$BODY$
+language plpgsql;
+
+
+\echo Creating group claim function...
+create or replace function group_claim(p_subscriber_id int, p_num_messages int = 1, p_lease_ms int = null) returns setof topic_message as 
+$BODY$
+declare
+    v_group "consumer_group"%rowtype;
+    v_partitions int[];
+    v_lease interval;
+    v_claimed_partitions int[];
+    v_claimed_offsets bigint[];
+    v_needed int;
+begin
+    if ( p_num_messages < 1 ) then
+        p_num_messages = 1;
+    end if;
+    
+    if ( p_num_messages > 1000 ) then
+        p_num_messages = 1000;
+    end if;
+    
+    select cg.*
+      into v_group
+      from "consumer_group" cg
+      join "topic_subscriber" ts
+        on ts.group_id = cg.id
+     where ts.id = p_subscriber_id;
+    
+    if ( v_group.id is null ) then
+        return;
+    end if;
+    
+    -- a member only claims messages of the partitions it subscribed to
+    select ts.partitions
+      into v_partitions
+      from "topic_subscriber" ts
+     where ts.id = p_subscriber_id;
+    
+    v_lease := make_interval(secs => coalesce(p_lease_ms, v_group.lease_ms) / 1000.0);
+    
+    -- redeliver messages whose lease expired before handing out new ones
+    with expired as (
+        select l._partition, l._offset
+          from "consumer_group_lease" l
+         where l.group_id = v_group.id
+           and l._partition = any(v_partitions)
+           and not l.acked
+           and l.lease_until < clock_timestamp()
+         order 
+            by l._offset, l._partition
+           for update skip locked
+         limit p_num_messages
+    ), claimed as (
+        update "consumer_group_lease" l
+           set subscriber_id = p_subscriber_id,
+               lease_until = clock_timestamp() + v_lease,
+               deliveries = l.deliveries + 1
+          from expired e
+         where l.group_id = v_group.id
+           and l._partition = e._partition
+           and l._offset = e._offset
+        returning l._partition, l._offset
+    )
+    select array_agg(c._partition), array_agg(c._offset)
+      into v_claimed_partitions, v_claimed_offsets
+      from claimed c;
+    
+    v_needed := p_num_messages - coalesce(array_length(v_claimed_offsets, 1), 0);
+    if ( v_needed > 0 ) then
+        -- rows being claimed by other members are skipped instead of waited for. The group offsets are
+        -- read in the same statement as the leases so an ack moving them cannot be seen half way
+        with fresh as (
+            select m._partition, m._offset
+              from unnest(v_partitions) as p(_partition)
+             cross 
+              join lateral (
+                     select tm._partition, tm._offset
+                       from "topic_message" tm
+                      where tm.topic = v_group.topic
+                        and tm._partition = p._partition
+                        and tm._offset > (select cg._offsets[p._partition + 1] from "consumer_group" cg where cg.id = v_group.id)
+                        and not exists (select 1
+                                          from "consumer_group_lease" l
+                                         where l.group_id = v_group.id
+                                           and l._partition = tm._partition
+                                           and l._offset = tm._offset)
+                      order 
+                         by tm._offset
+                        for update of tm skip locked
+                      limit v_needed
+                   ) as m
+             order 
+                by m._offset, m._partition
+             limit v_needed
+        ), claimed as (
+            insert into "consumer_group_lease" (group_id, _partition, _offset, subscriber_id, lease_until)
+            select v_group.id, f._partition, f._offset, p_subscriber_id, clock_timestamp() + v_lease
+              from fresh f
+            on conflict (group_id, _partition, _offset) do nothing
+            returning _partition, _offset
+        )
+        select coalesce(v_claimed_partitions, '{}') || coalesce(array_agg(c._partition), '{}'),
+               coalesce(v_claimed_offsets, '{}') || coalesce(array_agg(c._offset), '{}')
+          into v_claimed_partitions, v_claimed_offsets
+          from claimed c;
+    end if;
+    
+    return query select tm.*
+                   from "topic_message" tm
+                   join unnest(v_claimed_partitions, v_claimed_offsets) as c(_partition, _offset)
+                     on tm._partition = c._partition
+                    and tm._offset = c._offset
+                  where tm.topic = v_group.topic
+                  order 
+                     by tm._offset, tm._partition;
+end;
+$BODY$
+language plpgsql;
+
+
+\echo Creating group ack function...
+create or replace function group_ack(p_subscriber_id int, p_partitions int[], p_offsets bigint[]) returns bigint[] as 
+$BODY$
+declare
+    v_group "consumer_group"%rowtype;
+    v_offsets bigint[] := null::bigint[];
+    v_partition int;
+    v_offset bigint;
+begin
+    select cg.*
+      into v_group
+      from "consumer_group" cg
+      join "topic_subscriber" ts
+        on ts.group_id = cg.id
+     where ts.id = p_subscriber_id;
+    
+    if ( v_group.id is null ) then
+        return null;
+    end if;
+    
+    if ( coalesce(array_length(p_offsets, 1), 0) > 0 ) then
+        -- a late ack from a member whose lease already expired still counts
+        update "consumer_group_lease" l
+           set acked = true
+          from unnest(p_partitions, p_offsets) as a(_partition, _offset)
+         where l.group_id = v_group.id
+           and l._partition = a._partition
+           and l._offset = a._offset
+           and not l.acked;
+    end if;
+    
+    -- one ack at a time moves the group offsets
+    select cg._offsets
+      into v_offsets
+      from "consumer_group" cg
+     where cg.id = v_group.id
+       for update;
+    
+    for v_partition in select distinct a._partition
+                         from unnest(p_partitions) as a(_partition)
+                        where a._partition between 0 and array_length(v_offsets, 1) - 1
+    loop
+        -- offsets in segments dropped by retention can never be acked
+        select greatest(v_offsets[v_partition + 1], min(s.first_offset) - 1)
+          into v_offset
+          from "topic_segment" s
+         where s.topic = v_group.topic
+           and s._partition = v_partition;
+        
+        -- the offset only moves over the contiguous run of acked leases right above it
+        select coalesce(max(acked._offset), v_offset)
+          into v_offset
+          from (
+                 select l._offset,
+                        row_number() over (order by l._offset) as rn
+                   from "consumer_group_lease" l
+                  where l.group_id = v_group.id
+                    and l._partition = v_partition
+                    and l._offset > v_offset
+                    and l.acked
+               ) as acked
+         where acked._offset = v_offset + acked.rn;
+        
+        v_offsets[v_partition + 1] := v_offset;
+    end loop;
+    
+    update "consumer_group" cg
+       set _offsets = v_offsets,
+           action_ts = current_timestamp
+     where cg.id = v_group.id
+       and cg._offsets <> v_offsets;
+    
+    delete
+      from "consumer_group_lease" l
+     where l.group_id = v_group.id
+       and l._partition = any(p_partitions)
+       and l._offset <= v_offsets[l._partition + 1];
+    
+    return v_offsets;
+end;
+$BODY$
+language plpgsql;
+
+
+\echo Creating group ack and claim function...
+create or replace function group_fetch(p_subscriber_id int, p_partitions int[], p_offsets bigint[], p_num_messages int = 1,
+                                       p_lease_ms int = null) returns setof topic_message as 
+$BODY$
+begin
+    if ( coalesce(array_length(p_offsets, 1), 0) > 0 ) then
+        perform group_ack(p_subscriber_id, p_partitions, p_offsets);
+    end if;
+    
+    return query select * from group_claim(p_subscriber_id, p_num_messages, p_lease_ms);
+end;
+$BODY$
+language plpgsql;
+
+
 \echo Creating getter function...
-create or replace function get_message(subscriber_id int, num_messages int = 1) returns setof topic_message as 
+create or replace function get_message(subscriber_id int, num_messages int = 1, p_partitions int[] = '{}',
+                                       p_offsets bigint[] = '{}') returns setof topic_message as 
 $BODY$
 begin 
     if ( num_messages < 1 ) then
@@ -157,29 +873,104 @@ begin
         num_messages = 20;
     end if;
     
-    return query execute $$select tm.*
-                             from "topic_message" tm
-                             join "topic_subscriber" ts
-                               on ts.topic = tm.topic
-                            where ts.id = $$ || quote_literal(subscriber_id) || $$
-                              and tm._offset > ts._offset
-                            order 
-                               by tm._offset
-                            limit $$ || quote_literal(num_messages) || $$;$$;
+    if ( select ts.group_id is not null from "topic_subscriber" ts where ts.id = get_message.subscriber_id ) then
+        return query select * from group_claim(get_message.subscriber_id, num_messages);
+        return;
+    end if;
+    
+    return query select * from subscriber_fetch(get_message.subscriber_id, num_messages, p_partitions, p_offsets);
 end;
 $BODY$
 language plpgsql returns null on null input;
 
 
 \echo Creating ack function...
-create or replace function ack_message(subscriber_id int, _offset int) returns setof topic_subscriber as 
+create or replace function ack_message(subscriber_id int, _offset int, _partition int = 0) returns setof topic_subscriber as 
 $BODY$
 begin
-    return query execute $$update "topic_subscriber"
-                              set _offset = $$ || quote_literal(_offset) || $$,
-                                  action_ts = current_timestamp
-                            where id = $$ || quote_literal(subscriber_id) || $$
-                           returning *;$$;
+    if ( select ts.group_id is not null from "topic_subscriber" ts where ts.id = ack_message.subscriber_id ) then
+        -- group members ack single messages, the group offset moves once every earlier message is acked too
+        perform group_ack(ack_message.subscriber_id, array[ack_message._partition], array[ack_message._offset]::bigint[]);
+        return query select * from "topic_subscriber" ts where ts.id = ack_message.subscriber_id;
+        return;
+    end if;
+    
+    return query update "topic_subscriber" ts
+                    set _offsets[ack_message._partition + 1] = ack_message._offset,
+                        action_ts = current_timestamp
+                  where ts.id = ack_message.subscriber_id
+                    and ack_message._partition = any(ts.partitions)
+                 returning ts.*;
+end;
+$BODY$
+language plpgsql;
+
+
+\echo Creating ack flush function...
+create or replace function ack_flush(p_subscriber_ids int[], p_partitions int[], p_offsets bigint[]) returns int as 
+$BODY$
+declare
+    v_record_count int = 0::int;
+begin
+    -- commits the acks a server coalesced in memory (p_subscriber_ids[i] acked p_offsets[i] of
+    -- partition p_partitions[i]) with one update. Acks only move offsets forward, so a flush never
+    -- undoes a newer durable ack of the same subscriber
+    perform 1
+       from "topic_subscriber" ts
+      where ts.id = any(p_subscriber_ids)
+      order 
+         by ts.id
+        for update;
+    
+    update "topic_subscriber" ts
+       set _offsets = (
+                        select partition_offsets_set(ts._offsets, array_agg(a._partition),
+                                                     array_agg(greatest(a._offset, ts._offsets[a._partition + 1])))
+                          from unnest(p_subscriber_ids, p_partitions, p_offsets) as a(subscriber_id, _partition, _offset)
+                         where a.subscriber_id = ts.id
+                           and a._partition = any(ts.partitions)
+                      ),
+           action_ts = current_timestamp
+     where ts.id = any(p_subscriber_ids)
+       and ts.group_id is null;
+    
+    get diagnostics v_record_count = row_count;
+    return v_record_count;
+end;
+$BODY$
+language plpgsql;
+
+
+\echo Creating ack and fetch function...
+create or replace function ack_fetch(p_subscriber_id int, p_partitions int[], p_offsets bigint[], p_num_messages int = 1)
+  returns setof topic_message as 
+$BODY$
+begin
+    -- acks the offset of each partition in p_partitions (when given) and returns the next messages in one transaction
+    if ( p_num_messages < 1 ) then
+        p_num_messages = 1;
+    end if;
+    
+    if ( p_num_messages > 1000 ) then
+        p_num_messages = 1000;
+    end if;
+    
+    if ( select ts.group_id is not null from "topic_subscriber" ts where ts.id = p_subscriber_id ) then
+        if ( coalesce(array_length(p_offsets, 1), 0) > 0 ) then
+            perform group_ack(p_subscriber_id, p_partitions, p_offsets);
+        end if;
+        return query select * from group_claim(p_subscriber_id, p_num_messages);
+        return;
+    end if;
+    
+    if ( coalesce(array_length(p_offsets, 1), 0) > 0 ) then
+        update "topic_subscriber" ts
+           set _offsets = partition_offsets_set(ts._offsets, p_partitions, p_offsets),
+               action_ts = current_timestamp
+         where ts.id = p_subscriber_id;
+    end if;
+    
+    return query select * from subscriber_fetch(p_subscriber_id, p_num_messages);
 end;
 $BODY$
 language plpgsql;
@@ -191,19 +982,70 @@ $BODY$
 declare
     v_record_count int = 0::int;
 begin
-    execute $$update "topic_subscriber" ts
-                 set _offset = $$ || quote_literal(_offset) || $$
-                from (
-                       select ts1.id
-                         from "topic_subscriber" ts1
-                        where ts1.topic = $$ || quote_literal(topic) || $$ 
-                          for update
-                     ) as targets
-               where ts.id = targets.id;$$;
+    -- every partition of the topic goes back to the same offset
+    update "topic_subscriber" ts
+       set _offsets = array_fill(topic_reset._offset::bigint, array[array_length(ts._offsets, 1)])
+      from (
+             select ts1.id
+               from "topic_subscriber" ts1
+              where ts1.topic = topic_reset.topic
+                for update
+           ) as targets
+     where ts.id = targets.id;
     GET DIAGNOSTICS v_record_count = ROW_COUNT;
+    
+    update "consumer_group" cg
+       set _offsets = array_fill(topic_reset._offset::bigint, array[array_length(cg._offsets, 1)]),
+           action_ts = current_timestamp
+     where cg.topic = topic_reset.topic;
+    
+    delete
+      from "consumer_group_lease" l
+     using "consumer_group" cg
+     where l.group_id = cg.id
+       and cg.topic = topic_reset.topic;
+    
+    perform pg_notify('topic_change', json_build_object('topic', topic_reset.topic, 'event', 'reset')::text);
+    
     return v_record_count;
 end;
 $BODY$
 language plpgsql;
 
 
+\echo Creating lag function...
+-- one row per subscriber and consumed partition, from the maintained head offsets and the committed
+-- offsets (a group member's are its group's). The oldest unacked message is the first one after the
+-- committed offset, found with one primary key range lookup and only for partitions that lag
+create or replace function topic_lag(p_topic text = null)
+  returns table (topic text, subscriber_id int, group_name text, _partition int, head_offset bigint,
+                 committed_offset bigint, lag bigint, oldest_unacked_ts timestamptz) as
+$BODY$
+    select ts.topic,
+           ts.id,
+           cg.group_name,
+           tp._partition,
+           tp.head_offset,
+           c.committed,
+           greatest(tp.head_offset - c.committed, 0),
+           case when tp.head_offset > c.committed then
+               (select tm.publish_ts
+                  from "topic_message" tm
+                 where tm.topic = ts.topic
+                   and tm._partition = tp._partition
+                   and tm._offset > c.committed
+                 order by tm._offset
+                 limit 1)
+           end
+      from "topic_subscriber" ts
+      left join "consumer_group" cg on cg.id = ts.group_id
+      join "topic_partition" tp on tp.topic = ts.topic and tp._partition = any (ts.partitions)
+     cross join lateral (
+             select coalesce(case when cg.id is null then ts._offsets[tp._partition + 1]
+                                  else cg._offsets[tp._partition + 1] end, 0) as committed
+           ) c
+     where p_topic is null
+        or ts.topic = p_topic
+     order by ts.topic, ts.id, tp._partition;
+$BODY$
+language sql stable;